@@ -1,12 +1,13 @@
+from functools import lru_cache
 import logging
 import os
 import random
 import subprocess
 
-from twilio.rest import Client as TwilioClient
 from werkzeug.middleware.proxy_fix import ProxyFix
 
 from flask import (
+    current_app,
     Flask,
     redirect,
     request,
@@ -14,12 +15,30 @@ from flask import (
 )
 
 from calls import commands
-from calls.models import db
+from calls.models import (
+    db,
+    UserCodeConfigCache,
+    VolunteerSchedule,
+)
+from calls.notifications import PostgresListener
+from calls.twilio_client import (
+    LazyTwilioClient,
+    TwilioHttpStats,
+)
 from calls.utils import (
+    CircuitBreaker,
+    LazyString,
     parse_sip_address,
+    PhoneLookupCache,
     protected,
-    render_xml,
+    protected_url_for,
+    render_call_twiml,
+    render_static_xml,
     sanitize_phone_number,
+    start_latency_budget,
+    StaticXmlCache,
+    UrlRootCache,
+    warm_opt_in_hours_cache,
 )
 from calls.views import (
     broadcast,
@@ -31,109 +50,163 @@ from calls.views import (
 )
 
 
-# Set up Flask app
-app = Flask(__name__)
 BASE_DIR = os.path.dirname(__file__)
 
-# Load config files
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-app.config.from_pyfile(os.path.join(BASE_DIR, 'base_config.py'))
-site_config_path = os.path.join(BASE_DIR, '..', 'config.py')
-if os.path.exists(site_config_path):  # skip coverage
-    app.config.from_pyfile(site_config_path)
-
-# Register extensions
-db.init_app(app)
-commands.register_commands(app)
-
-# Set up Twilio client globally on app
-app.twilio = TwilioClient(
-    app.config['TWILIO_ACCOUNT_SID'],
-    app.config['TWILIO_AUTH_TOKEN'],
-)
-
-# Register blueprints
-app.register_blueprint(broadcast)
-app.register_blueprint(panel)
-app.register_blueprint(volunteers)
-app.register_blueprint(weirdness)
-
-# Make sure reverse proxying from an https URL to http is considered secure.
-# Gunicorn does this automatically, but Flask's development server does not.
-if app.debug:
-    app.wsgi_app = ProxyFix(app.wsgi_app, x_proto=1, x_host=1)
-
-# Unless we're running from flask cli, enable gunicorn loggers
-if not os.environ.get('FLASK_RUN_FROM_CLI'):
-    gunicorn_logger = logging.getLogger('gunicorn.error')
-    app.logger.handlers = gunicorn_logger.handlers
-    app.logger.setLevel(gunicorn_logger.level)
 
+@lru_cache()
+def get_songs():
+    return sorted(os.listdir(os.path.join(BASE_DIR, 'static', 'songs')))
+
+
+@lru_cache()
+def get_git_rev():
+    """Revision being served: from the GIT_REV environment variable or a REVISION
+    file written at build time, falling back to asking git."""
+    if os.environ.get('GIT_REV'):
+        return os.environ['GIT_REV']
+
+    revision_path = os.path.join(BASE_DIR, '..', 'REVISION')
+    if os.path.exists(revision_path):  # skip coverage
+        with open(revision_path) as revision_file:
+            return revision_file.read().strip()
+
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=BASE_DIR).decode().strip()
+    except (OSError, subprocess.CalledProcessError):  # skip coverage
+        return 'unknown'
+
+
+def create_app():
+    app = Flask(__name__)
+
+    # Load config files
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    app.config.from_pyfile(os.path.join(BASE_DIR, 'base_config.py'))
+    site_config_path = os.path.join(BASE_DIR, '..', 'config.py')
+    if os.path.exists(site_config_path):  # skip coverage
+        app.config.from_pyfile(site_config_path)
+
+    # Register extensions
+    db.init_app(app)
+    commands.register_commands(app)
+
+    # Set up Twilio client globally on app, built (and the twilio package
+    # imported) the first time it's used
+    app.twilio = LazyTwilioClient(app)
+    app.twilio_http_stats = TwilioHttpStats()
+    app.phone_lookup_cache = PhoneLookupCache(
+        app.config['PHONE_LOOKUP_CACHE_SIZE'],
+        app.config['PHONE_LOOKUP_CACHE_TTL'],
+        app.config['PHONE_LOOKUP_NEGATIVE_TTL'],
+    )
+    app.lookup_circuit_breaker = CircuitBreaker(
+        app.config['LOOKUP_BREAKER_FAILURES'],
+        app.config['LOOKUP_BREAKER_SLOW'],
+        app.config['LOOKUP_BREAKER_RESET'],
+    )
+    app.postgres_listener = PostgresListener(app)
+    app.user_code_config_cache = UserCodeConfigCache()
+    warm_opt_in_hours_cache(app.config['OPT_IN_HOURS_WARM_TIMEZONES'])
+    app.volunteer_schedule = (
+        VolunteerSchedule(app.config['VOLUNTEER_SCHEDULE_MAX_AGE'])
+        if app.config['VOLUNTEER_SCHEDULE_INDEX'] else None
+    )
+
+    # Register blueprints and routes
+    app.register_blueprint(broadcast)
+    app.register_blueprint(panel)
+    app.register_blueprint(volunteers)
+    app.register_blueprint(weirdness)
+    app.add_url_rule('/health', view_func=health)
+    app.add_url_rule('/', view_func=form_redirect)
+    app.add_url_rule('/outgoing', view_func=outgoing, methods=('POST',))
+    app.before_request(start_latency_budget)
+    app.after_request(add_git_rev_header)
+    app.after_request(commit_session)
+
+    # Make sure reverse proxying from an https URL to http is considered secure.
+    # Gunicorn does this automatically, but Flask's development server does not.
+    if app.debug:
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_proto=1, x_host=1)
+
+    # Unless we're running from flask cli, enable gunicorn loggers
+    if not os.environ.get('FLASK_RUN_FROM_CLI'):
+        gunicorn_logger = logging.getLogger('gunicorn.error')
+        app.logger.handlers = gunicorn_logger.handlers
+        app.logger.setLevel(gunicorn_logger.level)
+
+    app.song_urls = UrlRootCache(lambda: [
+        url_for('static', filename='songs/{}'.format(song), _external=True) for song in get_songs()])
+    app.static_xml_cache = StaticXmlCache(app.song_urls)
+
+    # Template globals cost nothing per render, and song_url is only picked if it's used
+    app.jinja_env.globals.update({
+        'song_url': LazyString(lambda: random.choice(app.song_urls.get())),
+        'protected_url_for': protected_url_for,
+    })
+    app.context_processor(extra_template_context)
+
+    return app
 
-SONGS = os.listdir(os.path.join(BASE_DIR, 'static', 'songs'))
 
-
-@app.context_processor
 def extra_template_context():
     return {
-        'song_url': url_for('static', filename='songs/{}'.format(
-            random.choice(SONGS)), _external=True),
-        'recording_enabled_globally': app.config['RECORDING_ENABLED'],
-        'protected_url_for': lambda *args, **kwargs: url_for(
-            *args, **kwargs, password=app.config['API_PASSWORD']),
+        'recording_enabled_globally': current_app.config['RECORDING_ENABLED'],
     }
 
 
-try:
-    GIT_REV = subprocess.check_output(
-        ['git', 'rev-parse', '--short', 'HEAD']).strip()
-except subprocess.CalledProcessError:  # skip coverage
-    GIT_REV = 'unknown'
+def add_git_rev_header(response):
+    response.headers['X-Calls-Git-Rev'] = get_git_rev()
+    return response
 
 
-@app.after_request
-def add_git_rev_header(response):
-    response.headers['X-Calls-Git-Rev'] = GIT_REV
+def commit_session(response):
+    """Views and models only flush, and a request's changes are committed here
+    all at once, or rolled back if it failed."""
+    if response.status_code >= 400:
+        db.session.rollback()
+    else:
+        db.session.commit()
     return response
 
 
-@app.route('/health')
 def health():
-    return 'There are forty people in this world, and five of them are hamburgers.'
+    return 'There are forty people in this world, and five of them are hamburgers.\nTwilio Lookup: {}'.format(
+        current_app.lookup_circuit_breaker.state)
 
 
-@app.route('/')
 def form_redirect():
-    return redirect(app.config['WEIRDNESS_SIGNUP_GOOGLE_FORM_URL'])
+    return redirect(current_app.config['WEIRDNESS_SIGNUP_GOOGLE_FORM_URL'])
 
 
 # SIP domains on Twilio route to the same URL, so basic routing done here
-@app.route('/outgoing', methods=('POST',))
 @protected
 def outgoing():
     from_address = parse_sip_address(request.values.get('From'))
-    if from_address == app.config['BROADCAST_SIP_USERNAME']:
+    if from_address == current_app.config['BROADCAST_SIP_USERNAME']:
         return outgoing_broadcast()
     elif (
-        from_address == app.config['WEIRDNESS_SIP_USERNAME']
-        or from_address in app.config['WEIRDNESS_SIP_ALT_USERNAMES']
+        from_address == current_app.config['WEIRDNESS_SIP_USERNAME']
+        or from_address in current_app.config['WEIRDNESS_SIP_ALT_USERNAMES']
     ):
         return outgoing_weirdness()
-    elif from_address == app.config['OUTGOING_SIP_USERNAME']:
+    elif from_address == current_app.config['OUTGOING_SIP_USERNAME']:
         to_number = parse_sip_address(request.values.get('To'))
         if to_number == '*':
             return outgoing_weirdness()
         else:
             to_number = sanitize_phone_number(to_number)
             if to_number:
-                return render_xml(
-                    'call.xml',
-                    from_number=app.config['WEIRDNESS_NUMBER'],
+                return render_call_twiml(
+                    from_number=current_app.config['WEIRDNESS_NUMBER'],
                     to_number=to_number,
                 )
             else:
-                return render_xml('hang_up.xml', message=(
-                    'Your call cannot be completed as dialed. You dialed an invalid number. Please eat some cabbage, bring '
-                    'in your dry cleaning and try your call again. Good bye.'))
+                return render_static_xml('hang_up.xml', message=(
+                    'Your call cannot be completed as dialed. You dialed an invalid number. '
+                    'Please eat some cabbage, bring in your dry cleaning and try your call again. Good bye.'))
+
+    return render_static_xml('hang_up.xml', message='Invalid SIP address.')
+
 
-    return render_xml('hang_up.xml', message='Invalid SIP address.')
+app = create_app()
@@ -5,8 +5,19 @@ SQLALCHEMY_DATABASE_NAME_TESTING = 'testing'
 
 TWILIO_ACCOUNT_SID = 'ACXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXX'
 TWILIO_AUTH_TOKEN = 'hackme'
+TWILIO_FAKE = False  # Log Twilio REST requests instead of making them, for offline development
 RECORDING_ENABLED = True  # Save money during development
 
+# Twilio REST requests share a keep-alive pool of at most TWILIO_HTTP_POOL_SIZE
+# connections per process, and give up after (connect, read) timeouts in
+# seconds, by Twilio subdomain. Idempotent requests, like lookups and fetching
+# recordings, are retried with jittered exponential backoff.
+TWILIO_HTTP_POOL_SIZE = 10
+TWILIO_HTTP_TIMEOUTS = {'lookups': (3.05, 5), 'api': (3.05, 10)}
+TWILIO_HTTP_DEFAULT_TIMEOUT = (3.05, 15)
+TWILIO_HTTP_MAX_RETRIES = 2
+TWILIO_HTTP_RETRY_BACKOFF = 0.25
+
 TWILIO_SIP_DOMAIN = 'example.sip.us1.twilio.com'
 
 BROADCAST_NUMBER = '+15555554321'
@@ -18,3 +29,69 @@ WEIRDNESS_SIP_USERNAME = 'weirdness'
 WEIRDNESS_SIP_ALT_USERNAMES = {'weirdness-alt1', 'weirdness-alt2'}
 
 OUTGOING_SIP_USERNAME = 'outgoing'
+
+# Twilio Lookup results are cached in-process (LRU) and in the phone_lookups table
+PHONE_LOOKUP_CACHE_SIZE = 4096
+PHONE_LOOKUP_CACHE_TTL = 60 * 60 * 24 * 30  # seconds
+# Numbers Twilio says are invalid are only remembered in-process, and not for long
+PHONE_LOOKUP_NEGATIVE_TTL = 5 * 60  # seconds
+
+# Twilio Lookup is skipped, guessing at phone numbers locally instead, for
+# LOOKUP_BREAKER_RESET seconds after LOOKUP_BREAKER_FAILURES consecutive failed
+# lookups (or ones slower than LOOKUP_BREAKER_SLOW seconds)
+LOOKUP_BREAKER_FAILURES = 5
+LOOKUP_BREAKER_SLOW = 2
+LOOKUP_BREAKER_RESET = 30
+# Guessed numbers are looked up again by a job this many seconds later
+PHONE_VERIFY_DELAY = 60
+
+# Answer webhooks within WEBHOOK_LATENCY_BUDGET seconds, well inside Twilio's 15
+# second timeout: Twilio requests are cut short to fit, and lookups are skipped
+# with less than LOOKUP_MIN_BUDGET seconds left
+WEBHOOK_LATENCY_BUDGET = 8
+LOOKUP_MIN_BUDGET = 1
+
+# Answer volunteer picks from an in-process index of volunteers by hour, reloaded
+# from the database at least every VOLUNTEER_SCHEDULE_MAX_AGE seconds
+VOLUNTEER_SCHEDULE_INDEX = False
+VOLUNTEER_SCHEDULE_MAX_AGE = 60
+
+# Form submissions' opt in hours are converted to server hours through an
+# in-process table, filled in for these zones at startup (others are added as
+# they're seen)
+OPT_IN_HOURS_WARM_TIMEZONES = ('US/Pacific', 'US/Mountain', 'US/Central', 'US/Eastern')
+
+# Use Postgres LISTEN/NOTIFY to invalidate process-local caches across workers
+POSTGRES_LISTEN = True
+# Maximum age of cached cheat code values (seconds) when not listening
+USER_CODE_CONFIG_CACHE_MAX_AGE = 10
+
+# Push panel updates over server-sent events, instead of the panel polling. Each
+# open panel holds a worker the whole time, so only enable this with a threaded
+# or async gunicorn worker class (eg. --worker-class gthread --threads 16), or
+# a few panels will starve the sync workers Twilio's webhooks need.
+PANEL_STREAM = False
+# Panel event streams send a keepalive this often (seconds), and end after the
+# max duration (keep it under gunicorn's worker timeout). Browsers reconnect
+# and resume from the last event they saw.
+PANEL_STREAM_KEEPALIVE = 15
+PANEL_STREAM_MAX_DURATION = 25
+
+# sms-blast sends from this many threads, making at most SMS_BLAST_RATE API calls
+# a second. Twilio queues messages beyond the sending number's throughput, so
+# this is bounded by the account's API concurrency, not the number's MPS.
+SMS_BLAST_WORKERS = 10
+SMS_BLAST_RATE = 25
+
+# flask run-worker polls for jobs at least this often (seconds), waking up
+# immediately on new jobs when listening. Failed jobs are retried with
+# exponential backoff, starting at JOB_RETRY_DELAY seconds. A job is handed to
+# another worker if it's been running longer than JOB_LEASE seconds.
+JOB_POLL_SECONDS = 5
+JOB_MAX_ATTEMPTS = 5
+JOB_RETRY_DELAY = 10
+JOB_LEASE = 5 * 60
+
+# Voicemail durations Twilio doesn't send us are looked up in batches, after
+# waiting this many seconds for more voicemails to arrive
+VOICEMAIL_DURATION_BACKFILL_DELAY = 30
@@ -0,0 +1,290 @@
+import datetime
+import os
+import random
+import re
+import statistics
+import subprocess
+import sys
+import time
+from xml.etree import ElementTree
+
+import click
+
+from flask import (
+    current_app,
+    render_template,
+    url_for,
+)
+
+from calls import constants
+from calls.models import (
+    db,
+    OPT_IN_MASK_BACKFILL_SQL,
+    Submission,
+    Text,
+    Volunteer,
+    Voicemail,
+)
+from calls.utils import (
+    render_call_twiml,
+    render_sms_twiml,
+    render_whisper_twiml,
+)
+
+
+def legacy_serialize(obj):
+    """BaseMixin.serialize() and Voicemail.serialize() as they were before
+    serializers were built per model, for comparison."""
+    data = {col.name: getattr(obj, col.name) for col in obj.__table__.columns}
+
+    for column in obj.__table__.columns:
+        if isinstance(column.type, db.DateTime):
+            value = data[column.name]
+            if value:
+                data[column.name] = value.astimezone(constants.SERVER_TZ).strftime(
+                    constants.SERIALIZE_STRFTIME)
+
+    if isinstance(obj, Voicemail):
+        if not data['transcription']:
+            data['transcription'] = '[Unable to transcribe]'
+
+        if data['duration'] >= datetime.timedelta(hours=1):
+            data['duration'] = str(data['duration'])
+        else:
+            data['duration'] = '{}:{:02d}'.format(
+                data['duration'].seconds // 60,
+                data['duration'].seconds % 60)
+
+    return data
+
+
+def generate_rows(count):
+    """Unsaved rows of every serialized model, with times spread over a year."""
+    start = datetime.datetime(2019, 1, 1, tzinfo=datetime.timezone.utc)
+
+    def random_time():
+        return start + datetime.timedelta(seconds=random.randrange(365 * 24 * 60 * 60))
+
+    rows = []
+    for n in range(count):
+        kwargs = {'id': n, 'created': random_time(), 'phone_number': '+1416967{:04d}'.format(n % 10000)}
+        model = (Submission, Volunteer, Text, Voicemail)[n % 4]
+        if model is Volunteer:
+            kwargs.update(submission_id=n, last_called=random.choice((None, random_time())),
+                          updated=random_time(), opt_in_hours=list(range(n % 24)))
+        elif model is Text:
+            kwargs['body'] = 'message'
+        elif model is Voicemail:
+            kwargs.update(url='http://example.com', transcription=random.choice((None, 'voicemail')),
+                          duration=datetime.timedelta(seconds=random.randrange(2 * 60 * 60)))
+        rows.append(model(**kwargs))
+    return rows
+
+
+# (template, TwiML builder, arguments to both)
+TWIML_CASES = (
+    ('call.xml', render_call_twiml, {'from_number': '+15555551234', 'to_number': '+14169671111'}),
+    ('call.xml', render_call_twiml, {
+        'from_number': '+15555551234', 'to_numbers': ['+14169671111', '+14169672222'], 'record': True,
+        'timeout': 20, 'action_url': 'https://example.com/weirdness/outgoing?password=a&b="c"',
+        'whisper_url': 'https://example.com/weirdness/whisper?password=<hackme>'}),
+    ('call.xml', render_call_twiml, {
+        'from_number': '+15555554321', 'to_sip_address': 'broadcast@example.sip.twilio.com', 'record': True}),
+    ('whisper.xml', render_whisper_twiml, {
+        'confirmed': False, 'has_gathered': False, 'action_url': 'https://example.com/whisper?a=1&b=2'}),
+    ('whisper.xml', render_whisper_twiml, {'confirmed': False, 'has_gathered': True, 'action_url': ''}),
+    ('whisper.xml', render_whisper_twiml, {'confirmed': True, 'has_gathered': False, 'action_url': ''}),
+    ('sms.xml', render_sms_twiml, {'message': 'Text "GO AWAY" to stop receiving <calls> & such.'}),
+    ('sms.xml', render_sms_twiml, {'message': ('First message.', 'Second message.')}),
+)
+
+
+# Context for rendering each TwiML template
+TEMPLATE_CASES = (
+    ('call.xml', TWIML_CASES[1][2]),
+    ('hang_up.xml', {'message': 'Invalid SIP address.'}),
+    ('hang_up.xml', {'message': 'You lose.', 'with_song': True}),
+    ('incoming_weirdness.xml', {
+        'action_url': 'https://example.com/weirdness/incoming', 'confirm': False, 'enrolled': True,
+        'gather_times': 1}),
+    ('sms.xml', TWIML_CASES[6][2]),
+    ('verify.xml', {'action_url': 'https://example.com/verify', 'confirmed': False, 'gather_times': 1}),
+    ('verify.xml', {'confirmed': True}),
+    ('voicemail.xml', {
+        'action_url': 'https://example.com/broadcast/incoming', 'transcribe_callback_url': 'https://example.com/t'}),
+    ('whisper.xml', TWIML_CASES[3][2]),
+)
+
+
+def legacy_template_context():
+    """extra_template_context() as it was before its values were made lazy, for
+    comparison."""
+    # Avoid circular import
+    from calls import get_songs
+
+    return {
+        'song_url': url_for('static', filename='songs/{}'.format(
+            random.choice(get_songs())), _external=True),
+        'recording_enabled_globally': current_app.config['RECORDING_ENABLED'],
+        'protected_url_for': lambda *args, **kwargs: url_for(
+            *args, **kwargs, password=current_app.config['API_PASSWORD']),
+    }
+
+
+def twiml_tree(xml):
+    """Parsed TwiML as nested (tag, attributes, text, children) tuples, with
+    whitespace collapsed, for comparing output semantically."""
+    def element_tree(element):
+        return (element.tag, element.attrib, ' '.join((element.text or '').split()),
+                [element_tree(child) for child in element])
+    return element_tree(ElementTree.fromstring(xml))
+
+
+def time_queries(statements, repeat):
+    """Run each statement `repeat` times, returning the median wall time in ms."""
+    timings = []
+    for _ in range(repeat):
+        for statement in statements:
+            start = time.perf_counter()
+            db.session.execute(statement).fetchall()
+            timings.append((time.perf_counter() - start) * 1000)
+    return statistics.median(timings)
+
+
+def time_import(module):
+    """Import module in a fresh interpreter with -X importtime, returning
+    {module name: (nesting level, cumulative time in ms)}."""
+    output = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', 'import {}'.format(module)],
+        cwd=os.path.join(os.path.dirname(__file__), '..'), env=dict(os.environ, FLASK_RUN_FROM_CLI='1'),
+        stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, universal_newlines=True, check=True,
+    ).stderr
+
+    timings = {}
+    for match in re.finditer(r'^import time:\s+\d+ \|\s+(\d+) \| ( *)(\S+)$', output, re.MULTILINE):
+        cumulative, indent, name = match.groups()
+        timings[name] = (len(indent) // 2, int(cumulative) / 1000)
+    return timings
+
+
+def register_commands(app):
+    @app.cli.group('benchmark', help='Run performance benchmarks.')
+    def benchmark():
+        pass
+
+    @benchmark.command('opt-in-hours', help='Compare opt-in hour array and bitmask lookups.')
+    @click.option('--volunteers', default=100000, help='Number of volunteers to generate.')
+    @click.option('--repeat', default=20, help='Times to query each hour.')
+    def opt_in_hours(volunteers, repeat):
+        with app.app_context():
+            # Everything happens in a temporary table, dropped on rollback
+            print('Generating {} volunteers...'.format(volunteers))
+            for sql in (
+                """CREATE TEMPORARY TABLE benchmark_volunteers (
+                    id SERIAL PRIMARY KEY,
+                    opt_in_hours SMALLINT[] NOT NULL,
+                    opt_in_mask INTEGER,
+                    last_called TIMESTAMP WITH TIME ZONE
+                ) ON COMMIT DROP""",
+                """INSERT INTO benchmark_volunteers (opt_in_hours, last_called)
+                SELECT
+                    ARRAY(SELECT hour FROM generate_series(0, 23) AS hour WHERE random() < 0.5 + 0 * n),
+                    CASE WHEN random() < 0.3 THEN NULL ELSE now() - random() * INTERVAL '5 days' END
+                FROM generate_series(1, :volunteers) AS n""",
+                OPT_IN_MASK_BACKFILL_SQL.format(table='benchmark_volunteers'),
+                'CREATE INDEX ON benchmark_volunteers USING GIN (opt_in_hours)',
+                'CREATE INDEX ON benchmark_volunteers (last_called ASC NULLS FIRST)',
+            ) + tuple(
+                'CREATE INDEX ON benchmark_volunteers (last_called ASC NULLS FIRST) '
+                'WHERE (opt_in_mask & {}) <> 0'.format(1 << hour)
+                for hour in range(24)
+            ) + ('ANALYZE benchmark_volunteers',):
+                db.session.execute(db.text(sql), {'volunteers': volunteers})
+
+            query = ('SELECT id FROM benchmark_volunteers WHERE {} '
+                     'ORDER BY last_called ASC NULLS FIRST LIMIT 15')
+            lookups = (
+                ('SMALLINT[] @> ARRAY[hour]', [db.text(query.format(
+                    'opt_in_hours @> CAST(ARRAY[{}] AS SMALLINT[])'.format(hour))) for hour in range(24)]),
+                ('INTEGER & (1 << hour)', [db.text(query.format(
+                    '(opt_in_mask & {}) <> 0'.format(1 << hour))) for hour in range(24)]),
+            )
+            for name, statements in lookups:
+                print('{:>26}: {:.3f}ms median'.format(name, time_queries(statements, repeat)))
+
+            sizes = db.session.execute(db.text(
+                'SELECT SUM(pg_column_size(opt_in_hours)), SUM(pg_column_size(opt_in_mask)) '
+                'FROM benchmark_volunteers')).first()
+            print('Column storage: {} bytes (array) vs {} bytes (bitmask)'.format(*sizes))
+            db.session.rollback()
+
+    @benchmark.command('serialize', help='Compare per-model serializers against the old reflective one.')
+    @click.option('--rows', default=50000, help='Number of rows to serialize.')
+    @click.option('--repeat', default=5, help='Times to serialize every row.')
+    def serialize(rows, repeat):
+        rows = generate_rows(rows)
+        if [row.serialize() for row in rows] != [legacy_serialize(row) for row in rows]:
+            raise click.ClickException('Serializers disagree!')
+
+        for name, serialize in (('legacy', legacy_serialize), ('per-model', lambda row: row.serialize())):
+            timings = []
+            for _ in range(repeat):
+                start = time.perf_counter()
+                for row in rows:
+                    serialize(row)
+                timings.append((time.perf_counter() - start) * 1000)
+            print('{:>10}: {:.1f}ms median for {} rows'.format(name, statistics.median(timings), len(rows)))
+
+    @benchmark.command('twiml', help='Compare the TwiML builder against Jinja templates.')
+    @click.option('--repeat', default=2000, help='Times to render each response.')
+    def twiml(repeat):
+        with app.test_request_context():
+            for template, builder, kwargs in TWIML_CASES:
+                if twiml_tree(render_template(template, **kwargs)) != twiml_tree(builder(**kwargs).get_data()):
+                    raise click.ClickException('{} and {} disagree!'.format(template, builder.__name__))
+
+            for name, render in (
+                ('jinja', lambda template, builder, kwargs: render_template(template, **kwargs)),
+                ('builder', lambda template, builder, kwargs: builder(**kwargs).get_data()),
+            ):
+                start = time.perf_counter()
+                for _ in range(repeat):
+                    for case in TWIML_CASES:
+                        render(*case)
+                elapsed = time.perf_counter() - start
+                print('{:>8}: {:.1f}us per response'.format(
+                    name, elapsed / (repeat * len(TWIML_CASES)) * 1000000))
+
+    @benchmark.command('template-context', help='Profile each template with the old eager template context.')
+    @click.option('--repeat', default=2000, help='Times to render each template.')
+    def template_context(repeat):
+        processors = app.template_context_processors[None]
+        with app.test_request_context():
+            for template, kwargs in TEMPLATE_CASES:
+                timings = []
+                for eager in (True, False):
+                    if eager:
+                        processors.append(legacy_template_context)
+                    try:
+                        start = time.perf_counter()
+                        for _ in range(repeat):
+                            render_template(template, **kwargs)
+                        timings.append((time.perf_counter() - start) / repeat * 1000000)
+                    finally:
+                        if eager:
+                            processors.remove(legacy_template_context)
+                print('{:>22} ({}): {:.1f}us eager, {:.1f}us lazy'.format(
+                    template, ', '.join(sorted(kwargs)), *timings))
+
+    @benchmark.command('import-time', help='Time importing the app from a cold interpreter.')
+    @click.option('--repeat', default=5, help='Number of interpreters to start.')
+    @click.option('--top', default=10, help='Number of slowest direct imports to list.')
+    def import_time(repeat, top):
+        runs = [time_import('calls') for _ in range(repeat)]
+        print('calls: {:.1f}ms median'.format(statistics.median(run['calls'][1] for run in runs)))
+
+        # Modules imported directly while importing calls, slowest first
+        direct = {name: statistics.median(run[name][1] for run in runs if name in run)
+                  for name, (level, _) in runs[0].items() if level == 1}
+        for name, cumulative in sorted(direct.items(), key=lambda item: -item[1])[:top]:
+            print('{:>32}: {:.1f}ms'.format(name, cumulative))
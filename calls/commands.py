@@ -1,21 +1,105 @@
+import csv
+import itertools
+import json
 import os
 import pprint
+import time
 
-from twilio.base.exceptions import TwilioRestException
+import click
 
 from flask import request
 
+from calls import (
+    benchmarks,
+    jobs,
+)
 from calls.models import (
     db,
+    Job,
+    OPT_IN_MASK_BACKFILL_SQL,
+    PhoneLookup,
+    SmsBlast,
     Submission,
     Text,
     UserCodeConfig,
     Voicemail,
     Volunteer,
 )
+from calls.sms_blast import SmsBlaster
 from calls.utils import sanitize_phone_number
 
 
+# Google Forms exports name columns after the questions, so columns are found by
+# these words in their headers when they aren't named after the fields
+SUBMISSION_COLUMN_KEYWORDS = (
+    ('phone_number', 'phone'),
+    ('opt_in_hours', 'hour'),
+    ('timezone', 'zone'),
+)
+
+
+def get_submission_columns(headers, columns=None):
+    """Map of field => CSV header, from explicit FIELD=HEADER columns, headers
+    named after fields, or else headers with the field's keyword in them."""
+    found = {}
+    for field, header in (columns or {}).items():
+        if field not in dict(SUBMISSION_COLUMN_KEYWORDS):
+            raise click.ClickException('Unknown field {!r}, expected one of: {}'.format(
+                field, ', '.join(dict(SUBMISSION_COLUMN_KEYWORDS))))
+        if header not in headers:
+            raise click.ClickException('No column {!r} for {} in the file'.format(header, field))
+        found[field] = header
+
+    for field, keyword in SUBMISSION_COLUMN_KEYWORDS:
+        if field in found:
+            continue
+        if field in headers:
+            found[field] = field
+            continue
+        matches = [header for header in headers
+                   if keyword in header.lower() and header not in found.values()]
+        if len(matches) > 1:
+            raise click.ClickException('Several columns could be {}: {}. Pick one with --column {}=HEADER'.format(
+                field, ', '.join(map(repr, matches)), field))
+        elif matches:
+            found[field] = matches[0]
+
+    missing = [field for field in ('phone_number', 'opt_in_hours') if field not in found]
+    if missing:
+        raise click.ClickException('No column for {} in {}. Pick columns with --column FIELD=HEADER'.format(
+            ' or '.join(missing), ', '.join(map(repr, headers))))
+    return found
+
+
+def read_submissions(file, file_format, columns=None):
+    """Form responses from an export, as dicts like volunteers.submit gets."""
+    if file_format == 'csv':
+        reader = csv.DictReader(file)
+        columns = get_submission_columns(reader.fieldnames or [], columns)
+        # Google Forms exports checkbox answers joined by commas
+        for row in reader:
+            yield {
+                'phone_number': row[columns['phone_number']],
+                'opt_in_hours': [label for label in row[columns['opt_in_hours']].split(',') if label.strip()],
+                'timezone': row[columns['timezone']] if 'timezone' in columns else '',
+            }
+    else:
+        rows = json.load(file) if file_format == 'json' else (json.loads(line) for line in file if line.strip())
+        for row in rows:
+            yield {'phone_number': row['phone_number'], 'opt_in_hours': row.get('opt_in_hours') or [],
+                   'timezone': row.get('timezone', '')}
+
+
+def create_missing_indexes(*models):
+    # create_all() only creates indexes along with their tables
+    for model in models:
+        existing = {index['name'] for index in db.inspect(db.engine).get_indexes(model.__tablename__)}
+        for index in model.__table__.indexes:
+            if index.name not in existing:
+                print('Creating index {}...'.format(index.name))
+                index.create(db.engine)
+
+
 def register_commands(app):
     @app.cli.add_command
     @app.cli.command('init-db', help='Initialize the DB.')
@@ -34,43 +118,177 @@ def register_commands(app):
 
     @app.cli.add_command
     @app.cli.command('sms-blast', help='Blast volunteers with an SMS')
-    def sms_blast():
-        from calls.models import Volunteer
-
+    @click.option('--resume', type=int, metavar='BLAST_ID', help='Resume an interrupted blast.')
+    @click.option('--workers', type=int, help='Number of sending threads.')
+    @click.option('--rate', type=float, help='Maximum Twilio API calls per second.')
+    def sms_blast(resume, workers, rate):
         with app.app_context():
             print('Environment: {}'.format(app.config['ENV']))
-            print(' Volunteers: {}'.format(Volunteer.query.count()))
-            print()
-
-            body = input('What is your SMS (add \\n for newline)? ').replace('\\n', '\n').strip()
-            if not body:
-                print('Nothing entered.')
-                return
-
-            print(' {}/160 chars '.format(len(body)).center(60, '='))
-            print(body)
-            print('=' * 60)
-            if not input('Are you sure (y/n)? ').strip().lower().startswith('y'):
-                print('Aborting.')
-                return
-
-            volunteers = Volunteer.query.order_by(Volunteer.id).all()
-
-            for n, volunteer in enumerate(volunteers, 1):
-                try:
-                    app.twilio.messages.create(
-                        body=body, from_=app.config['WEIRDNESS_NUMBER'],
-                        to=volunteer.phone_number)
-                    failed = False
-                except TwilioRestException:
-                    failed = True
+
+            if resume:
+                blast = SmsBlast.query.get(resume)
+                if not blast:
+                    print('No blast with id {}.'.format(resume))
+                    return
+
+                counts = blast.get_counts()
+                print(' Recipients: {}'.format(', '.join(
+                    '{} {}'.format(count, status) for status, count in counts.items())))
+                print()
+                print(' Blast {} '.format(blast.id).center(60, '='))
+                print(blast.body)
+                print('=' * 60)
+                if counts['sending']:
+                    print('{} recipient(s) were being sent to when interrupted, and may have gotten '
+                          'the message. They will be skipped.'.format(counts['sending']))
+                if not input('Resume (y/n)? ').strip().lower().startswith('y'):
+                    print('Aborting.')
+                    return
+
+            else:
+                print(' Volunteers: {}'.format(Volunteer.query.count()))
+                print()
+
+                body = input('What is your SMS (add \\n for newline)? ').replace('\\n', '\n').strip()
+                if not body:
+                    print('Nothing entered.')
+                    return
+
+                print(' {}/160 chars '.format(len(body)).center(60, '='))
+                print(body)
+                print('=' * 60)
+                if not input('Are you sure (y/n)? ').strip().lower().startswith('y'):
+                    print('Aborting.')
+                    return
+
+                blast = SmsBlast.create(body)
+                db.session.commit()
+                print('Created blast {}. If interrupted, resume with --resume {}.'.format(blast.id, blast.id))
+
+            total = blast.get_counts()['pending']
+            num_sent = 0
+
+            def progress(phone_number, status, error):
+                nonlocal num_sent
+                num_sent += 1
                 print('{}/{}: {}{}'.format(
-                    n, len(volunteers), volunteer.phone_number, ' FAILED!' if failed else ''))
+                    num_sent, total, phone_number, '' if status == 'sent' else ' FAILED! {}'.format(error)))
+
+            start = time.monotonic()
+            SmsBlaster(
+                app, blast,
+                workers=workers or app.config['SMS_BLAST_WORKERS'],
+                rate=rate or app.config['SMS_BLAST_RATE'],
+            ).run(progress=progress)
+            print('Done in {:.1f}s: {}'.format(time.monotonic() - start, ', '.join(
+                '{} {}'.format(count, status) for status, count in blast.get_counts().items())))
+
+    @app.cli.add_command
+    @app.cli.command('import-submissions', help='Import form responses from a CSV, JSON or NDJSON export.')
+    @click.argument('file', type=click.File('r'))
+    @click.option('--format', 'file_format', type=click.Choice(('csv', 'json', 'ndjson')),
+                  help='File format (default: from the file extension, or csv).')
+    @click.option('--promote', is_flag=True,
+                  help='Update existing volunteers from their numbers\' rows. New numbers still need verifying.')
+    @click.option('--column', 'columns', multiple=True, metavar='FIELD=HEADER',
+                  help='CSV column for phone_number, opt_in_hours or timezone, if it can\'t be told from the headers.')
+    @click.option('--batch-size', default=1000, help='Rows per insert.')
+    def import_submissions(file, file_format, promote, columns, batch_size):
+        if not file_format:
+            extension = os.path.splitext(file.name)[1].lower().lstrip('.')
+            file_format = {'json': 'json', 'ndjson': 'ndjson', 'jsonl': 'ndjson'}.get(extension, 'csv')
+
+        if any('=' not in column for column in columns):
+            raise click.BadParameter('Expected FIELD=HEADER', param_hint='--column')
+        columns = dict(column.split('=', 1) for column in columns)
+
+        with app.app_context():
+            rows = read_submissions(file, file_format, columns)
+            num_submissions = num_volunteers = 0
+            start = time.monotonic()
+
+            while True:
+                batch = list(itertools.islice(rows, batch_size))
+                if not batch:
+                    break
+                imported = Submission.bulk_import(batch, promote=promote)
+                db.session.commit()
+                num_submissions += imported[0]
+                num_volunteers += imported[1]
+                print('Imported {} submissions...'.format(num_submissions))
+
+            elapsed = time.monotonic() - start
+            print('Imported {} submissions{} in {:.1f}s ({:.0f} rows/s).'.format(
+                num_submissions, ', {} volunteers updated'.format(num_volunteers) if promote else '',
+                elapsed, num_submissions / max(elapsed, 0.001)))
+
+    @app.cli.add_command
+    @app.cli.command('prune-phone-lookups', help='Delete expired cached Twilio Lookup results.')
+    def prune_phone_lookups():
+        with app.app_context():
+            deleted = PhoneLookup.prune(app.config['PHONE_LOOKUP_CACHE_TTL'])
+            db.session.commit()
+            print('Deleted {} expired phone lookups.'.format(deleted))
+
+    @app.cli.add_command
+    @app.cli.command('migrate-opt-in-mask', help='Add and backfill the opt-in hours bitmask.')
+    def migrate_opt_in_mask():
+        with app.app_context():
+            for model in (Submission, Volunteer):
+                table = model.__tablename__
+                print('Backfilling {}.opt_in_mask...'.format(table))
+                db.session.execute(db.text(
+                    'ALTER TABLE {} ADD COLUMN IF NOT EXISTS opt_in_mask INTEGER'.format(table)))
+                db.session.execute(db.text(OPT_IN_MASK_BACKFILL_SQL.format(table=table)))
+                db.session.execute(db.text(
+                    'ALTER TABLE {} ALTER COLUMN opt_in_mask SET NOT NULL'.format(table)))
+            db.session.commit()
+            create_missing_indexes(Volunteer)
+
+    @app.cli.add_command
+    @app.cli.command('migrate-voicemail-recording-sid', help='Add the recording sid used to backfill durations.')
+    def migrate_voicemail_recording_sid():
+        with app.app_context():
+            db.session.execute(db.text(
+                'ALTER TABLE voicemails ADD COLUMN IF NOT EXISTS recording_sid VARCHAR(34)'))
+            db.session.commit()
+            create_missing_indexes(Voicemail)
+
+    @app.cli.add_command
+    @app.cli.command('migrate-phone-guessed', help='Add the flag for phone numbers to look up again.')
+    def migrate_phone_guessed():
+        with app.app_context():
+            db.session.execute(db.text(
+                'ALTER TABLE submissions ADD COLUMN IF NOT EXISTS phone_guessed BOOLEAN NOT NULL DEFAULT false'))
+            # Earlier guesses can't be told apart from numbers Twilio had no country
+            # for, so both are looked up again
+            flagged = db.session.execute(db.text(
+                "UPDATE submissions SET phone_guessed = true WHERE valid_phone AND country_code = '??'")).rowcount
+            if flagged:
+                Job.enqueue('verify_phone_numbers')
+            db.session.commit()
+            create_missing_indexes(Submission)
+            print('Flagged {} phone numbers to look up again.'.format(flagged))
+
+    @app.cli.add_command
+    @app.cli.command('create-indexes', help='Create any indexes missing from existing tables.')
+    def create_indexes():
+        with app.app_context():
+            create_missing_indexes(Submission, Volunteer, Text, Voicemail)
+
+    @app.cli.add_command
+    @app.cli.command('run-worker', help='Run queued jobs, forever.')
+    def run_worker():
+        with app.app_context():
+            jobs.run_worker()
+
+    benchmarks.register_commands(app)
 
     @app.shell_context_processor
     def extra_shell_variables():
         return {'db': db, 'Submission': Submission, 'UserCodeConfig': UserCodeConfig,
                 'Volunteer': Volunteer, 'Text': Text, 'Voicemail': Voicemail,
+                'PhoneLookup': PhoneLookup, 'SmsBlast': SmsBlast, 'Job': Job,
                 'sanitize_phone_number': sanitize_phone_number}
 
     if app.debug and os.environ.get('PRINT_REQUESTS'):  # skip coverage
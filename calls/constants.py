@@ -8,11 +8,60 @@ SERVER_TZ = pytz.timezone('US/Pacific')
 # No known daylight savings changes in August, so let's pick a date during BM
 DATE_FOR_TZ_CONVERSION = datetime.date(2022, 8, 25)
 FORM_HOUR_CHUNK_SIZE = 3
+FORM_OPT_IN_HOURS_LABELS = ('midnight - 3am', '3am - 6am', '6am - 9am', '9am - noon',
+                            'noon - 3pm', '3pm - 6pm', '6pm - 9pm', '9pm - midnight')
+OPT_IN_HOURS_CACHE_SIZE = 4096
+ALL_HOURS_MASK = (1 << 24) - 1  # Bit n set = opted in for hour n
 
 VOLUNTEER_RANDOM_POOL_SIZE = 5
+VOLUNTEER_RECENTLY_CALLED_SECONDS = 5  # Only picked again this soon after a call if there's nobody else
 MULTIRING_COUNT = 3
 WEIRDNESS_RANDOM_CHANCE_OF_RINGING_BROADCAST = 50
 INCOMING_CALLERS_RANDOM_CHANCE_OF_WEIRDNESS = 15
 
 MAX_PANEL_ITEMS = 50
+PANEL_NOTIFY_CHANNEL = 'panel'
+PANEL_POLL_SECONDS = 5
 SERIALIZE_STRFTIME = '%a %b %d %Y %I:%M:%S %p'
+EXPORT_BATCH_SIZE = 1000
+VOICEMAIL_DURATION_BATCH_SIZE = 50
+PHONE_VERIFY_BATCH_SIZE = 50
+
+# Offline phone number normalization. NANP area codes default to US, except
+# these, which Twilio Lookup reports as another country.
+NANP_AREA_CODE_COUNTRIES = dict(
+    [(area_code, 'CA') for area_code in (
+        '204', '226', '236', '249', '250', '263', '289', '306', '343', '354', '365', '367', '368',
+        '382', '403', '416', '418', '428', '431', '437', '438', '450', '468', '474', '506', '514',
+        '519', '548', '579', '581', '584', '587', '600', '604', '613', '622', '639', '647', '672',
+        '683', '705', '709', '742', '753', '778', '780', '782', '807', '819', '825', '867', '873',
+        '879', '902', '905', '942')]
+    + [('242', 'BS'), ('246', 'BB'), ('264', 'AI'), ('268', 'AG'), ('284', 'VG'), ('340', 'VI'),
+       ('345', 'KY'), ('441', 'BM'), ('473', 'GD'), ('649', 'TC'), ('658', 'JM'), ('664', 'MS'),
+       ('670', 'MP'), ('671', 'GU'), ('684', 'AS'), ('721', 'SX'), ('758', 'LC'), ('767', 'DM'),
+       ('784', 'VC'), ('787', 'PR'), ('809', 'DO'), ('829', 'DO'), ('849', 'DO'), ('868', 'TT'),
+       ('869', 'KN'), ('876', 'JM'), ('939', 'PR')]
+)
+# Calling code => (country code, allowed national number lengths). Only countries
+# with an unambiguous calling code and fixed-length numbering are listed, anything
+# else is resolved by Twilio Lookup.
+INTERNATIONAL_CALLING_CODES = {
+    '27': ('ZA', {9}),
+    '31': ('NL', {9}),
+    '32': ('BE', {8, 9}),
+    '33': ('FR', {9}),
+    '34': ('ES', {9}),
+    '41': ('CH', {9}),
+    '44': ('GB', {10}),
+    '45': ('DK', {8}),
+    '47': ('NO', {8}),
+    '48': ('PL', {9}),
+    '52': ('MX', {10}),
+    '55': ('BR', {10, 11}),
+    '61': ('AU', {9}),
+    '81': ('JP', {9, 10}),
+    '86': ('CN', {11}),
+    '91': ('IN', {10}),
+    '351': ('PT', {9}),
+    '972': ('IL', {8, 9}),
+}
@@ -0,0 +1,183 @@
+import datetime
+
+from twilio.base.exceptions import TwilioRestException
+
+from flask import current_app as app
+
+from calls import constants
+from calls.models import (
+    db,
+    Job,
+    notify,
+    Submission,
+    Voicemail,
+    Volunteer,
+)
+from calls.notifications import Signal
+from calls.utils import fetch_phone_number
+
+
+HANDLERS = {}
+# Kinds that are safe to run again after any error. Others make a call or send
+# a text, and are only retried when Twilio can't have acted on the request.
+IDEMPOTENT_KINDS = set()
+
+
+def handler(kind, idempotent=False):
+    def register(func):
+        HANDLERS[kind] = func
+        if idempotent:
+            IDEMPOTENT_KINDS.add(kind)
+        return func
+    return register
+
+
+def is_retryable_error(exception):
+    """Whether Twilio certainly didn't act on the request: it never got there, or
+    was rate limited. A 5xx may come after a call or text was already sent."""
+    from calls.twilio_http import is_unsent_request_error  # Loaded with the Twilio client anyway
+
+    rate_limited = isinstance(exception, TwilioRestException) and exception.status == 429
+    return rate_limited or is_unsent_request_error(exception)
+
+
+@handler('call')
+def create_call(**kwargs):
+    app.twilio.calls.create(**kwargs)
+
+
+@handler('sms')
+def send_sms(**kwargs):
+    app.twilio.messages.create(**kwargs)
+
+
+@handler('voicemail_durations', idempotent=True)
+def backfill_voicemail_durations():
+    """Fill in durations for a batch of voicemails that came in without one,
+    from a single listing of recent recordings where possible."""
+    voicemails = Voicemail.query.filter(
+        Voicemail.duration.is_(None), Voicemail.recording_sid.isnot(None),
+    ).order_by(Voicemail.id).limit(constants.VOICEMAIL_DURATION_BATCH_SIZE).with_for_update(skip_locked=True).all()
+    if not voicemails:
+        return
+
+    # Recordings are created before their voicemail (after transcription), and
+    # other calls are recorded too, so list generously
+    durations = {recording.sid: recording.duration for recording in app.twilio.recordings.list(
+        date_created_after=min(voicemail.created for voicemail in voicemails) - datetime.timedelta(hours=1),
+        limit=constants.VOICEMAIL_DURATION_BATCH_SIZE * 4,
+    )}
+
+    num_pending = 0
+    for voicemail in voicemails:
+        duration = durations.get(voicemail.recording_sid)
+        if duration is None:
+            try:
+                duration = app.twilio.recordings.get(voicemail.recording_sid).fetch().duration
+            except TwilioRestException as e:
+                if e.status != 404:
+                    raise
+                app.logger.warning('Recording {} for voicemail {} is gone'.format(
+                    voicemail.recording_sid, voicemail.id))
+                duration = 0
+
+        # Twilio can't say while a recording is still processing
+        if str(duration).isdigit():
+            voicemail.duration = datetime.timedelta(seconds=int(duration))
+        else:
+            num_pending += 1
+
+    if num_pending:
+        Job.enqueue('voicemail_durations', delay=app.config['VOICEMAIL_DURATION_BACKFILL_DELAY'])
+    elif len(voicemails) == constants.VOICEMAIL_DURATION_BATCH_SIZE:
+        Job.enqueue('voicemail_durations')  # There may be more
+
+    # Have panels pick up the new durations
+    notify(constants.PANEL_NOTIFY_CHANNEL, 'voicemail')
+
+
+@handler('verify_phone_numbers', idempotent=True)
+def verify_phone_numbers():
+    """Look up a batch of phone numbers that were guessed at while Twilio Lookup
+    was unavailable. Raises, so the job's retried, if it still is."""
+    submissions = Submission.query.filter(Submission.phone_guessed).order_by(
+        Submission.id).limit(constants.PHONE_VERIFY_BATCH_SIZE).with_for_update(skip_locked=True).all()
+    if not submissions:
+        return
+
+    lookups = {}
+    for submission in submissions:
+        if submission.phone_number not in lookups:
+            lookups[submission.phone_number] = fetch_phone_number(submission.phone_number)
+        phone_number, country_code = lookups[submission.phone_number]
+        submission.phone_guessed = False
+        if phone_number:
+            submission.phone_number, submission.country_code = phone_number, country_code
+        else:
+            submission.valid_phone = False
+
+    # Volunteers answered a call or text at their number, so they're kept either
+    # way, and only get the country filled in
+    valid = {submission.id: submission for submission in submissions if submission.valid_phone}
+    for volunteer in Volunteer.query.filter(Volunteer.submission_id.in_(list(valid))):
+        volunteer.country_code = valid[volunteer.submission_id].country_code
+
+    if len(submissions) == constants.PHONE_VERIFY_BATCH_SIZE:
+        Job.enqueue('verify_phone_numbers')  # There may be more
+
+
+def run_job(job):
+    func = HANDLERS.get(job.kind)
+    if func is None:
+        app.logger.error('Unknown job kind: {}'.format(job.kind))
+        job.finish(error='Unknown job kind')
+        db.session.commit()
+        return
+
+    try:
+        func(**job.args)
+    except Exception as e:
+        db.session.rollback()
+        # Retrying after a timeout or server error could ring or text someone twice
+        retryable = job.kind in IDEMPOTENT_KINDS or is_retryable_error(e)
+        if not retryable or job.attempts >= app.config['JOB_MAX_ATTEMPTS']:
+            app.logger.exception('Job {} ({}) failed'.format(job.id, job.kind))
+            job.finish(error=repr(e))
+        else:
+            retry_delay = app.config['JOB_RETRY_DELAY'] * 2 ** (job.attempts - 1)
+            app.logger.warning('Job {} ({}) failed, retrying in {}s: {!r}'.format(
+                job.id, job.kind, retry_delay, e))
+            job.finish(error=repr(e), retry_delay=retry_delay)
+    else:
+        job.finish()
+    # Whatever the handler changed is committed along with the job's status
+    db.session.commit()
+
+
+def run_pending():
+    """Run jobs until none are due, returning how many were run."""
+    num_run = 0
+    while True:
+        job = Job.claim(app.config['JOB_LEASE'])
+        # Committed straight away, so other workers see it's taken
+        db.session.commit()
+        if job is None:
+            return num_run
+        run_job(job)
+        num_run += 1
+
+
+def run_worker():  # skip coverage
+    jobs_queued = Signal()
+    if app.config['POSTGRES_LISTEN']:
+        app.postgres_listener.subscribe(Job.NOTIFY_CHANNEL, jobs_queued)
+
+    app.logger.info('Worker started')
+    while True:
+        version = jobs_queued.version
+        num_run = run_pending()
+        if num_run:
+            app.logger.info('Ran {} job(s)'.format(num_run))
+        # Don't hold on to a database connection while waiting
+        db.session.close()
+        jobs_queued.wait(version, app.config['JOB_POLL_SECONDS'])
@@ -1,23 +1,108 @@
+import bisect
 from collections import namedtuple
 import datetime
+from functools import lru_cache
+import itertools
+from operator import attrgetter
 import random
+import threading
+import time
 
+from sqlalchemy import event
 from sqlalchemy.dialects import postgresql
-from sqlalchemy.sql.expression import (
-    cast,
-    nullsfirst,
+from sqlalchemy.orm import (
+    object_session,
+    Session,
 )
-import pytz
+from sqlalchemy.sql.expression import nullsfirst
 
+from flask import (
+    current_app as app,
+    has_app_context,
+)
 from flask_sqlalchemy import SQLAlchemy
 
 from calls import constants
-from calls.utils import sanitize_phone_number
+from calls.utils import (
+    convert_opt_in_hours,
+    opt_in_hours_to_mask,
+    sanitize_phone_number,
+    sanitize_phone_numbers,
+)
 
 
 db = SQLAlchemy()
 
 
+def notify(channel, payload=''):
+    # Postgres delivers this to listeners (see calls.notifications) on commit
+    db.session.execute(db.text('SELECT pg_notify(:channel, :payload)'),
+                       {'channel': channel, 'payload': payload})
+
+
+def call_after_commit(func):
+    # Requests commit once at the end (see calls.commit_session), so anything
+    # that must only happen once changes are durable waits for that
+    db.session.info.setdefault('after_commit_callbacks', []).append(func)
+
+
+@event.listens_for(Session, 'after_commit')
+def run_after_commit_callbacks(session):
+    for func in session.info.pop('after_commit_callbacks', ()):
+        func()
+
+
+@event.listens_for(Session, 'after_rollback')
+def discard_after_commit_callbacks(session):
+    session.info.pop('after_commit_callbacks', None)
+
+
+@lru_cache(maxsize=None)
+def server_tz_offset(utc_hour):
+    # Offsets only ever change on the hour, so every value in an hour shares one
+    # (there are under 9000 hours in a year, so letting this grow is fine)
+    return datetime.datetime.fromtimestamp(utc_hour * 3600, constants.SERVER_TZ).utcoffset()
+
+
+def serialize_datetime(value):
+    """Format a datetime in the server's time zone, like
+    value.astimezone(SERVER_TZ).strftime(SERIALIZE_STRFTIME) but without the
+    time zone lookup on each value."""
+    if not value:
+        return value
+    offset = value.utcoffset()
+    if offset is None:
+        return value.astimezone(constants.SERVER_TZ).strftime(constants.SERIALIZE_STRFTIME)
+    local = value.replace(tzinfo=None) + (server_tz_offset(int(value.timestamp() // 3600)) - offset)
+    return local.strftime(constants.SERIALIZE_STRFTIME)
+
+
+def serialize_duration(duration):
+    if duration is None:
+        return None  # Still waiting to hear from Twilio
+    if duration >= datetime.timedelta(hours=1):
+        return str(duration)
+    return '{}:{:02d}'.format(duration.seconds // 60, duration.seconds % 60)
+
+
+def build_serializer(model):
+    names = tuple(column.name for column in model.__table__.columns)
+    converters = tuple(
+        (column.name, model.serialize_converters.get(column.name, serialize_datetime))
+        for column in model.__table__.columns
+        if column.name in model.serialize_converters or isinstance(column.type, db.DateTime)
+    )
+    getter = attrgetter(*names)  # Every model has several columns, so this returns a tuple
+
+    def serializer(obj):
+        data = dict(zip(names, getter(obj)))
+        for name, convert in converters:
+            data[name] = convert(data[name])
+        return data
+
+    return serializer
+
+
 class BaseMixin:
     @db.validates('country_code', 'phone_number', 'timezone', 'name')
     def validate_code(self, key, value):
@@ -26,18 +111,15 @@ class BaseMixin:
             return value[:max_len]
         return value
 
-    def serialize(self):
-        data = {col.name: getattr(self, col.name) for col in self.__table__.columns}
-
-        # Make dates nice, and converted to server tz
-        for column in self.__table__.columns:
-            if isinstance(column.type, db.DateTime):
-                value = data[column.name]
-                if value:
-                    data[column.name] = value.astimezone(constants.SERVER_TZ).strftime(
-                        constants.SERIALIZE_STRFTIME)
+    # Column name -> function applied to its value by serialize()
+    serialize_converters = {}
 
-        return data
+    def serialize(self):
+        # Built once per model, rather than introspecting columns on every row
+        serializer = self.__class__.__dict__.get('_serializer')
+        if serializer is None:
+            serializer = self.__class__._serializer = build_serializer(self.__class__)
+        return serializer(self)
 
     def __repr__(self):
         return '<{} {}>'.format(
@@ -45,17 +127,43 @@ class BaseMixin:
 
 
 class VolunteerBase(BaseMixin):
+    change_resource = 'volunteers'
+
     id = db.Column(db.Integer, primary_key=True)
     created = db.Column(db.DateTime(timezone=True), server_default=db.func.now())
     phone_number = db.Column(db.String(20), nullable=False)
     opt_in_hours = db.Column(postgresql.ARRAY(db.SmallInteger, dimensions=1), nullable=False, default=list(range(24)))
+    # Bitmask mirror of opt_in_hours, kept in sync by validate_opt_in_hours
+    opt_in_mask = db.Column(db.Integer, nullable=False, default=constants.ALL_HOURS_MASK)
     country_code = db.Column(db.String(2), nullable=False, default='??')
 
+    @db.validates('opt_in_hours')
+    def validate_opt_in_hours(self, key, value):
+        self.opt_in_mask = opt_in_hours_to_mask(value or ())
+        return value
+
+
+# Recomputes opt_in_mask from opt_in_hours in SQL, for migrating existing rows
+OPT_IN_MASK_BACKFILL_SQL = """
+    UPDATE {table} SET opt_in_mask = (
+        SELECT COALESCE(SUM(1 << hour), 0) FROM unnest(opt_in_hours) AS hour
+    )
+"""
+
 
 class Submission(VolunteerBase, db.Model):
     __tablename__ = 'submissions'
     timezone = db.Column(db.String(255), nullable=False, default='')
     valid_phone = db.Column(db.Boolean, nullable=False, default=True)
+    # Guessed at while Twilio Lookup was unavailable, see jobs.verify_phone_numbers
+    phone_guessed = db.Column(db.Boolean, nullable=False, default=False)
+
+    __table_args__ = (
+        db.Index('submissions_valid_phone_number_key', 'phone_number',
+                 postgresql_where=db.text('valid_phone')),
+        db.Index('submissions_phone_guessed_key', 'id',
+                 postgresql_where=db.text('phone_guessed')),
+    )
 
     def get_volunteer_kwargs(self):
         kwargs = {
@@ -68,80 +176,126 @@ class Submission(VolunteerBase, db.Model):
         return kwargs
 
     @classmethod
-    def create_from_json(cls, json_data):
+    def from_json(cls, json_data, sanitized_phone_numbers=None):
+        """Unsaved submission from a form response. Phone numbers are looked up
+        in sanitized_phone_numbers (see sanitize_phone_numbers) when given."""
         kwargs = {
             # Strip user input
             key: val.strip() if isinstance(val, str) else val
             for key, val in json_data.items()
         }
 
-        user_tz = constants.SERVER_TZ
-        try:
-            user_tz_str = kwargs['timezone']
-            if user_tz_str:
-                # Last word in string, trim out brackets
-                user_tz = pytz.timezone(user_tz_str.split()[-1][1:-1])
-        except (pytz.UnknownTimeZoneError, IndexError):
-            pass
-
-        opt_in_hours = []
-        for opt_in_time_raw in (kwargs['opt_in_hours'] or ()):
-            hour = opt_in_time_raw.strip().lower().split(' - ')[0]
-            if hour == 'midnight':
-                hour = 0
-            elif hour == 'noon':
-                hour = 12
-            else:
-                suffix = hour[-2:]
-                hour = int(hour[:-2], 10)
-                if suffix == 'pm':
-                    hour += 12
-
-            # Localize hour on conversion date to user's timezone, then convert
-            # to server's timezone and take the hour
-            hour = user_tz.localize(datetime.datetime.combine(
-                constants.DATE_FOR_TZ_CONVERSION, datetime.time(hour=hour),
-            )).astimezone(constants.SERVER_TZ).hour
-
-            for i in range(constants.FORM_HOUR_CHUNK_SIZE):
-                opt_in_hours.append((hour + i) % 24)
-
         kwargs.update({
-            'opt_in_hours': sorted(opt_in_hours),
+            'opt_in_hours': convert_opt_in_hours(kwargs['timezone'], kwargs['opt_in_hours']),
             'valid_phone': False,
         })
 
-        phone_number, country_code = sanitize_phone_number(
-            kwargs['phone_number'], with_country_code=True)
+        if sanitized_phone_numbers is None:
+            phone_number, country_code = sanitize_phone_number(
+                kwargs['phone_number'], with_country_code=True)
+        else:
+            phone_number, country_code = sanitized_phone_numbers[kwargs['phone_number']]
         if phone_number:
             kwargs.update({
                 'phone_number': phone_number,
                 'valid_phone': True,
-                'country_code': country_code,
+                # Guesses have no country
+                'country_code': country_code or '??',
+                'phone_guessed': country_code is None,
             })
 
-        submission = cls(**kwargs)
+        return cls(**kwargs)
+
+    @classmethod
+    def create_from_json(cls, json_data):
+        submission = cls.from_json(json_data)
         db.session.add(submission)
-        db.session.commit()
+        db.session.flush()
+        if submission.phone_guessed:
+            cls.enqueue_phone_verification()
 
         return submission
 
+    @staticmethod
+    def enqueue_phone_verification():
+        # After the circuit breaker has had a chance to close again
+        Job.enqueue('verify_phone_numbers', delay=app.config['PHONE_VERIFY_DELAY'])
+
+    @classmethod
+    def bulk_import(cls, rows, promote=False):
+        """Insert a batch of form responses in one statement, and with promote,
+        update the volunteers whose phone numbers appear in another. New numbers
+        aren't verified, so they're left as submissions. Returns the number of
+        submissions and of volunteers updated."""
+        sanitized_phone_numbers = sanitize_phone_numbers(
+            row['phone_number'].strip() if isinstance(row['phone_number'], str) else row['phone_number']
+            for row in rows)
+        submissions = [cls.from_json(row, sanitized_phone_numbers) for row in rows]
+
+        columns = [cls.__table__.c[name] for name in (
+            'phone_number', 'opt_in_hours', 'opt_in_mask', 'country_code', 'timezone', 'valid_phone',
+            'phone_guessed')]
+        values = []
+        for submission in submissions:
+            row = {}
+            for column in columns:
+                value = getattr(submission, column.name)
+                # Column defaults, like the ORM would use
+                if value is None and column.default is not None:
+                    value = column.default.arg
+                row[column.name] = value
+            values.append(row)
+
+        ids = [id for id, in db.session.execute(
+            cls.__table__.insert().values(values).returning(cls.__table__.c.id))]
+
+        volunteers = {}
+        if promote:
+            for id, submission in zip(ids, submissions):
+                if submission.valid_phone and submission.opt_in_hours:
+                    # Later submissions for the same number win
+                    submission.id = id
+                    volunteers[submission.phone_number] = submission.get_volunteer_kwargs()
+
+        if volunteers:
+            # Existing volunteers were verified by call or text. They're locked so
+            # none can be removed in the meantime, and every row conflicts below.
+            verified = {phone_number for phone_number, in db.session.query(Volunteer.phone_number).filter(
+                Volunteer.phone_number.in_(list(volunteers))).with_for_update()}
+            volunteers = {phone_number: kwargs for phone_number, kwargs in volunteers.items()
+                          if phone_number in verified}
+
+        if volunteers:
+            insert = postgresql.insert(Volunteer.__table__).values(list(volunteers.values()))
+            db.session.execute(insert.on_conflict_do_update(
+                index_elements=['phone_number'],
+                set_=dict({name: insert.excluded[name] for name in (
+                    'submission_id', 'opt_in_hours', 'opt_in_mask', 'country_code')}, updated=db.func.now()),
+            ))
+            if app.volunteer_schedule:
+                app.volunteer_schedule.invalidate()
+
+        if any(submission.phone_guessed for submission in submissions):
+            cls.enqueue_phone_verification()
+
+        # Core statements skip the usual flush hooks
+        ChangeVersion.mark(cls.change_resource)
+        return len(ids), len(volunteers)
+
     def create_volunteer(self):
-        if all([
-            # Make sure we have a valid phone, with no existing volunteer
-            self.opt_in_hours, self.valid_phone,
-            not bool(Volunteer.query.filter_by(phone_number=self.phone_number).first()),
-        ]):
-            volunteer = Volunteer(**self.get_volunteer_kwargs())
-            db.session.add(volunteer)
-            db.session.commit()
-            return volunteer
-        else:
-            return False
+        # Make sure we have a valid phone. An existing volunteer is left alone, and
+        # checked for by the insert itself so concurrent sign ups can't both win.
+        if self.opt_in_hours and self.valid_phone:
+            volunteer = Volunteer.create_from_submission(self)
+            if volunteer:
+                return volunteer
+        return False
 
 
 class Volunteer(VolunteerBase, db.Model):
     __tablename__ = 'volunteers'
+    # Bumped by last_called stamps instead of change_resource, so calls don't refresh the panel
+    calls_change_resource = 'volunteer_calls'
     submission_id = db.Column(db.Integer, nullable=False)
     updated = db.Column(db.DateTime(timezone=True), server_default=db.func.now(),
                         onupdate=db.func.now())
@@ -151,45 +305,297 @@ class Volunteer(VolunteerBase, db.Model):
         db.Index('volunteers_phone_number_key', 'phone_number', unique=True),
         db.Index('volunteers_last_called_key', last_called,
                  postgresql_ops={'last_called': 'ASC NULLS FIRST'})
+    ) + tuple(
+        # One partial index per hour, so picking the least recently called volunteers
+        # for an hour is a short index scan
+        db.Index('volunteers_opt_in_hour_{}_key'.format(hour), 'last_called',
+                 postgresql_ops={'last_called': 'ASC NULLS FIRST'},
+                 postgresql_where=db.text('(opt_in_mask & {}) <> 0'.format(1 << hour)))
+        for hour in range(24)
     )
 
+    # Picks from the N least recently called volunteers and stamps them in a single
+    # statement. Rows locked by a concurrent pick are skipped, so two simultaneous
+    # calls never ring the same volunteer. A row stamped by a pick that committed
+    # after this statement started isn't locked any more, but Postgres rechecks
+    # the WHERE clause against its latest version, so the cooldown rejects it.
+    PICK_AND_STAMP_SQL = """
+        UPDATE volunteers SET last_called = now(), updated = now()
+        WHERE id IN (
+            SELECT pool.id FROM (
+                SELECT id FROM volunteers
+                WHERE (opt_in_mask & :hour_bit) <> 0
+                    AND (last_called IS NULL OR last_called < now() - :cooldown * INTERVAL '1 second')
+                ORDER BY last_called ASC NULLS FIRST
+                LIMIT :limit
+                FOR UPDATE SKIP LOCKED
+            ) AS pool
+            ORDER BY random()
+            LIMIT :count
+        )
+        RETURNING *
+    """
+
+    # Create or update a volunteer from a submission in one round trip, keyed on
+    # the volunteers_phone_number_key unique index
+    CREATE_SQL = """
+        INSERT INTO volunteers (submission_id, phone_number, opt_in_hours, opt_in_mask, country_code)
+        VALUES (:submission_id, :phone_number, CAST(:opt_in_hours AS SMALLINT[]), :opt_in_mask, :country_code)
+        ON CONFLICT (phone_number) DO NOTHING
+        RETURNING *
+    """
+    UPDATE_SQL = """
+        UPDATE volunteers SET submission_id = :submission_id, opt_in_hours = CAST(:opt_in_hours AS SMALLINT[]),
+            opt_in_mask = :opt_in_mask, country_code = :country_code, updated = now()
+        WHERE phone_number = :phone_number
+        RETURNING *
+    """
+
+    @classmethod
+    def create_from_submission(cls, submission):
+        """Insert a volunteer for submission, unless its phone number already is one,
+        in which case returns None. Not committed."""
+        return cls._upsert(cls.CREATE_SQL, submission)
+
+    @classmethod
+    def update_from_submission(cls, submission):
+        """Update the existing volunteer with submission's phone number, returning
+        None if there isn't one. Not committed."""
+        return cls._upsert(cls.UPDATE_SQL, submission)
+
+    @classmethod
+    def _upsert(cls, sql, submission):
+        volunteer = cls.query.from_statement(db.text(sql)).params(
+            **submission.get_volunteer_kwargs()).populate_existing().first()
+        if volunteer:
+            # Text statements skip the usual flush hooks
+            record_volunteer_schedule_change(volunteer, volunteer.opt_in_mask)
+            ChangeVersion.mark(cls.change_resource)
+        return volunteer
+
     @classmethod
     def get_random_opted_in(cls, update_last_called=True, current_hour=None, multiring=False):
         if current_hour is None:
             current_hour = datetime.datetime.now(constants.SERVER_TZ).hour
 
-        limit = constants.VOLUNTEER_RANDOM_POOL_SIZE
-        if multiring:
-            limit = limit * constants.MULTIRING_COUNT
+        count = constants.MULTIRING_COUNT if multiring else 1
+        limit = constants.VOLUNTEER_RANDOM_POOL_SIZE * count
+
+        schedule = app.volunteer_schedule
+        if schedule:
+            candidates = schedule.least_recently_called(current_hour, limit)
+            picks = cls.sample_rested_first(candidates, count)
+            if not picks:
+                return []
+            if not update_last_called:
+                return cls.query.filter(cls.id.in_([id for id, _ in picks])).all()
+
+            volunteers = cls.stamp_if_not_called_since(picks)
+            if len(volunteers) == len(picks):
+                return volunteers
+            # Another worker called or removed some of them, so the schedule is stale
+            schedule.invalidate()
+            if volunteers:
+                return volunteers
 
-        # Take the N least recently called volunteers, and pick one at random
+        if update_last_called:
+            volunteers = cls.pick_and_stamp(current_hour, limit, count, constants.VOLUNTEER_RECENTLY_CALLED_SECONDS)
+            if len(volunteers) < count:
+                # Nobody else, so ring whoever was just called (but not twice by us)
+                volunteers += cls.pick_and_stamp(current_hour, limit, count - len(volunteers), 0)
+            return volunteers
+
+        # Take the N least recently called volunteers, and pick at random
         volunteers = cls.query.filter(
-            # Finds a currently opted in volunteer, and performs on the gin index :)
-            cls.opt_in_hours.contains(cast([current_hour], db.ARRAY(db.SmallInteger))),
+            # Finds a currently opted in volunteer, using that hour's partial index
+            cls.opt_in_mask.op('&')(1 << current_hour) != 0,
         ).order_by(nullsfirst(cls.last_called)).limit(limit).all()
 
-        if not volunteers:
-            return []
+        return random.sample(volunteers, min(count, len(volunteers)))
 
-        if multiring:
-            volunteers = (
-                random.sample(volunteers, constants.MULTIRING_COUNT)
-                if len(volunteers) > constants.MULTIRING_COUNT
-                else volunteers
-            )
-        else:
-            volunteers = [random.choice(volunteers)]
+    @classmethod
+    def pick_and_stamp(cls, current_hour, limit, count, cooldown):
+        volunteers = cls.query.from_statement(db.text(cls.PICK_AND_STAMP_SQL)).params(
+            hour_bit=1 << current_hour, limit=limit, count=count, cooldown=cooldown,
+        ).populate_existing().all()
+        if volunteers:
+            ChangeVersion.mark(cls.calls_change_resource)
+        return volunteers
 
-        if update_last_called:
-            now = datetime.datetime.now(constants.SERVER_TZ)
-            for volunteer in volunteers:
-                volunteer.last_called = now
-                db.session.add(volunteer)
-                db.session.commit()
+    @staticmethod
+    def sample_rested_first(candidates, count):
+        """Random picks from (id, last_called) pairs, only taking volunteers called
+        in the last VOLUNTEER_RECENTLY_CALLED_SECONDS if there aren't enough others."""
+        cutoff = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(
+            seconds=constants.VOLUNTEER_RECENTLY_CALLED_SECONDS)
+        rested = [pick for pick in candidates if pick[1] is None or pick[1] < cutoff]
+        recent = [pick for pick in candidates if not (pick[1] is None or pick[1] < cutoff)]
+        picks = random.sample(rested, min(count, len(rested)))
+        return picks + random.sample(recent, min(count - len(picks), len(recent)))
 
+    @classmethod
+    def stamp_if_not_called_since(cls, picks):
+        """Set last_called for (id, last_called) pairs, skipping any volunteer whose
+        last_called no longer matches, ie someone else called them in the meantime."""
+        stamped_ids = [row.id for row in db.session.execute(
+            cls.__table__.update().where(db.or_(*(
+                db.and_(cls.id == id, cls.last_called.is_(None) if last_called is None
+                        else cls.last_called == last_called)
+                for id, last_called in picks
+            ))).values(last_called=db.func.now()).returning(cls.id))]
+
+        volunteers = []
+        if stamped_ids:
+            volunteers = cls.query.filter(cls.id.in_(stamped_ids)).populate_existing().all()
+            ChangeVersion.mark(cls.calls_change_resource)
+            for volunteer in volunteers:
+                record_volunteer_schedule_change(volunteer, volunteer.opt_in_mask)
         return volunteers
 
 
+class VolunteerSchedule:
+    """In-process index of volunteers by opted-in hour, with each hour's bucket
+    sorted least recently called first. The volunteers table stays the source of
+    truth: the schedule is reloaded after max_age seconds to pick up changes made
+    by other processes, and kept current for this process by the session hooks
+    below."""
+
+    def __init__(self, max_age):
+        self.max_age = max_age
+        self._lock = threading.Lock()
+        self._loaded = None
+        self._buckets = [[] for _ in range(24)]
+        self._entries = {}  # id => (sort key, opt_in_mask, last_called)
+
+    @property
+    def is_loaded(self):
+        return self._loaded is not None and time.monotonic() - self._loaded < self.max_age
+
+    def load(self):
+        rows = db.session.query(Volunteer.id, Volunteer.opt_in_mask, Volunteer.last_called).all()
+        with self._lock:
+            self._buckets = [[] for _ in range(24)]
+            self._entries = {}
+            for row in rows:
+                self._add(*row)
+            self._loaded = time.monotonic()
+
+    def invalidate(self):
+        self._loaded = None
+
+    def least_recently_called(self, hour, limit):
+        """Returns up to limit (id, last_called) pairs opted in for hour."""
+        if not self.is_loaded:
+            self.load()
+        with self._lock:
+            return [(key[-1], self._entries[key[-1]][2]) for key in self._buckets[hour][:limit]]
+
+    def update(self, *entries):
+        """Add or update (id, opt_in_mask, last_called) entries."""
+        with self._lock:
+            for entry in entries:
+                self._remove(entry[0])
+                self._add(*entry)
+
+    def remove(self, *ids):
+        with self._lock:
+            for id in ids:
+                self._remove(id)
+
+    def _add(self, id, opt_in_mask, last_called):
+        # Never called sorts first
+        key = (last_called is not None, last_called.timestamp() if last_called else 0, id)
+        self._entries[id] = (key, opt_in_mask, last_called)
+        for hour in range(24):
+            if opt_in_mask & (1 << hour):
+                bisect.insort(self._buckets[hour], key)
+
+    def _remove(self, id):
+        entry = self._entries.pop(id, None)
+        if entry:
+            key, opt_in_mask, _ = entry
+            for hour in range(24):
+                if opt_in_mask & (1 << hour):
+                    bucket = self._buckets[hour]
+                    del bucket[bisect.bisect_left(bucket, key)]
+
+
+# Collect volunteer changes as they're flushed, and apply them to this process's
+# schedule once (and only if) they're committed
+def record_volunteer_schedule_change(volunteer, opt_in_mask):
+    if has_app_context() and app.volunteer_schedule:
+        object_session(volunteer).info.setdefault('volunteer_schedule_changes', []).append(
+            (volunteer.id, opt_in_mask, volunteer.last_called))
+
+
+@event.listens_for(Volunteer, 'after_insert')
+@event.listens_for(Volunteer, 'after_update')
+def record_volunteer_saved(mapper, connection, volunteer):
+    record_volunteer_schedule_change(volunteer, volunteer.opt_in_mask)
+
+
+@event.listens_for(Volunteer, 'after_delete')
+def record_volunteer_deleted(mapper, connection, volunteer):
+    record_volunteer_schedule_change(volunteer, None)
+
+
+@event.listens_for(Session, 'after_commit')
+def apply_volunteer_schedule_changes(session):
+    changes = session.info.pop('volunteer_schedule_changes', ())
+    for id, opt_in_mask, last_called in changes:
+        if opt_in_mask is None:
+            app.volunteer_schedule.remove(id)
+        else:
+            app.volunteer_schedule.update((id, opt_in_mask, last_called))
+
+
+@event.listens_for(Session, 'after_rollback')
+def discard_volunteer_schedule_changes(session):
+    session.info.pop('volunteer_schedule_changes', None)
+
+
+class PhoneLookup(BaseMixin, db.Model):
+    __tablename__ = 'phone_lookups'
+
+    raw_phone_number = db.Column(db.String(255), primary_key=True)
+    phone_number = db.Column(db.String(20), nullable=False)
+    country_code = db.Column(db.String(2), nullable=False)
+    updated = db.Column(db.DateTime(timezone=True), nullable=False, server_default=db.func.now())
+
+    @classmethod
+    def get(cls, raw_phone_number, max_age):
+        lookup = cls.query.filter(
+            cls.raw_phone_number == raw_phone_number,
+            cls.updated > db.func.now() - datetime.timedelta(seconds=max_age),
+        ).first()
+        return (lookup.phone_number, lookup.country_code) if lookup else None
+
+    @classmethod
+    def get_many(cls, raw_phone_numbers, max_age):
+        return {lookup.raw_phone_number: (lookup.phone_number, lookup.country_code) for lookup in cls.query.filter(
+            cls.raw_phone_number.in_(raw_phone_numbers),
+            cls.updated > db.func.now() - datetime.timedelta(seconds=max_age),
+        )}
+
+    @classmethod
+    def set(cls, raw_phone_number, phone_number, country_code):
+        if len(raw_phone_number) > cls.__table__.c.raw_phone_number.type.length:
+            return
+
+        values = {'phone_number': phone_number, 'country_code': (country_code or '??')[:2],
+                  'updated': db.func.now()}
+        db.session.execute(postgresql.insert(cls.__table__).values(
+            raw_phone_number=raw_phone_number, **values,
+        ).on_conflict_do_update(index_elements=['raw_phone_number'], set_=values))
+
+    @classmethod
+    def prune(cls, max_age):
+        deleted = cls.query.filter(
+            cls.updated <= db.func.now() - datetime.timedelta(seconds=max_age),
+        ).delete(synchronize_session=False)
+        return deleted
+
+
 class UserCodeConfig(BaseMixin, db.Model):
     UserCode = namedtuple('UserCode', (
         'number', 'name', 'default', 'description'))
@@ -208,6 +614,7 @@ class UserCodeConfig(BaseMixin, db.Model):
     CODES_BY_NAME = {code.name: code for code in CODES}
 
     __tablename__ = 'user_code_config'
+    change_resource = 'panel'
 
     name = db.Column(db.String(40), primary_key=True)
     value = db.Column(db.Boolean(), nullable=False)
@@ -216,13 +623,37 @@ class UserCodeConfig(BaseMixin, db.Model):
     def get_code_by_number(cls, number):
         return cls.CODES_BY_NUMBER.get(number)
 
+    # Values are cached per app (see UserCodeConfigCache), and dropped whenever
+    # set() is called in any process, via NOTIFY
+    NOTIFY_CHANNEL = 'user_code_config'
+
+    @classmethod
+    def get_all(cls):
+        cache = app.user_code_config_cache
+        if app.config['POSTGRES_LISTEN']:
+            app.postgres_listener.subscribe(cls.NOTIFY_CHANNEL, cache.invalidate)
+
+        # Without a listener, other processes' changes are only seen once it expires
+        max_age = None if app.postgres_listener.connected.is_set() else app.config['USER_CODE_CONFIG_CACHE_MAX_AGE']
+        return cache.get(cls.load_all, max_age)
+
+    @classmethod
+    def load_all(cls):
+        values = {code.name: code.default for code in cls.CODES}
+        values.update({config.name: config.value for config in cls.query.all()
+                       if config.name in values})
+        return values
+
+    @classmethod
+    def invalidate_cache(cls):
+        app.user_code_config_cache.invalidate()
+
     @classmethod
     def get(cls, name):
         code = cls.CODES_BY_NAME.get(name)
         if not code:
             return None
-        config = cls.query.filter_by(name=code.name).first()
-        return config.value if config else code.default
+        return cls.get_all()[code.name]
 
     @classmethod
     def set(cls, name, value):
@@ -235,46 +666,246 @@ class UserCodeConfig(BaseMixin, db.Model):
             else:
                 config = cls(name=code.name, value=value)
             db.session.add(config)
-            db.session.commit()
+            notify(cls.NOTIFY_CHANNEL, code.name)
+            db.session.flush()
+            call_after_commit(cls.invalidate_cache)
 
     def __repr__(self):
         return '<UserCodeConfig {}={!r}>'.format(self.name, self.value)
 
 
+class UserCodeConfigCache:
+    """Process-local cache of every user code's value, held by the app. Values
+    read while an invalidation came in aren't kept."""
+
+    def __init__(self):
+        self.values = None
+        self._loaded = None
+        self._generation = 0
+
+    def get(self, load, max_age=None):
+        values = self.values
+        if values is None or (max_age is not None and time.monotonic() - self._loaded > max_age):
+            generation = self._generation
+            values = load()
+            if generation == self._generation:
+                self.values, self._loaded = values, time.monotonic()
+        return values
+
+    def invalidate(self, payload=None):
+        self._generation += 1
+        self.values = None
+
+
 class Text(BaseMixin, db.Model):
     __tablename__ = 'texts'
+    change_resource = 'panel'
 
     id = db.Column(db.Integer, primary_key=True)
     created = db.Column(db.DateTime(timezone=True), server_default=db.func.now())
     phone_number = db.Column(db.String(20), nullable=False)
     body = db.Column(db.Text, nullable=False)
 
-    __table_args__ = (db.Index('text_created_key', created),)
+    __table_args__ = (db.Index('text_created_key', created, id),)
 
 
 class Voicemail(BaseMixin, db.Model):
     __tablename__ = 'voicemails'
+    change_resource = 'panel'
 
     id = db.Column(db.Integer, primary_key=True)
     created = db.Column(db.DateTime(timezone=True), server_default=db.func.now())
     phone_number = db.Column(db.String(20), nullable=False)
-    duration = db.Column(db.Interval, default=datetime.timedelta(0))
+    # NULL until we know it, when Twilio doesn't send it (see calls.jobs)
+    duration = db.Column(db.Interval, nullable=True)
     transcription = db.Column(db.Text, nullable=True)
     url = db.Column(db.String, nullable=False)
+    recording_sid = db.Column(db.String(34), nullable=True)
 
-    __table_args__ = (db.Index('voicemail_created_key', created),)
+    __table_args__ = (
+        db.Index('voicemail_created_key', created, id),
+        db.Index('voicemail_pending_duration_key', id, postgresql_where=db.text('duration IS NULL')),
+    )
 
-    def serialize(self):
-        data = super(Voicemail, self).serialize()
+    serialize_converters = {
+        'duration': serialize_duration,
+        'transcription': lambda transcription: transcription or '[Unable to transcribe]',
+    }
+
+
+class SmsBlast(db.Model):
+    __tablename__ = 'sms_blasts'
+
+    id = db.Column(db.Integer, primary_key=True)
+    created = db.Column(db.DateTime(timezone=True), server_default=db.func.now())
+    body = db.Column(db.Text, nullable=False)
+
+    @classmethod
+    def create(cls, body):
+        # Recipients are fixed up front, so a resumed blast sends to the same people
+        blast = cls(body=body)
+        db.session.add(blast)
+        db.session.flush()
+        db.session.execute(SmsBlastRecipient.__table__.insert().from_select(
+            ['blast_id', 'phone_number'],
+            db.session.query(db.literal(blast.id), Volunteer.phone_number).order_by(Volunteer.id).statement,
+        ))
+        return blast
+
+    def get_counts(self):
+        counts = dict.fromkeys(SmsBlastRecipient.STATUSES, 0)
+        counts.update(db.session.query(SmsBlastRecipient.status, db.func.count()).filter_by(
+            blast_id=self.id).group_by(SmsBlastRecipient.status))
+        return counts
+
+    def __repr__(self):
+        return '<SmsBlast {}>'.format(self.id)
+
+
+class SmsBlastRecipient(db.Model):
+    __tablename__ = 'sms_blast_recipients'
+    # A recipient is marked sending before Twilio is asked to send, so one left
+    # in that state may or may not have received the message
+    STATUSES = ('pending', 'sending', 'sent', 'failed')
 
-        if not data['transcription']:
-            data['transcription'] = '[Unable to transcribe]'
+    id = db.Column(db.Integer, primary_key=True)
+    blast_id = db.Column(db.Integer, db.ForeignKey('sms_blasts.id', ondelete='CASCADE'), nullable=False)
+    phone_number = db.Column(db.String(20), nullable=False)
+    status = db.Column(db.Enum(*STATUSES, name='sms_blast_status'), nullable=False, default='pending')
+    attempts = db.Column(db.SmallInteger, nullable=False, default=0)
+    message_sid = db.Column(db.String(34))
+    error = db.Column(db.Text)
+    updated = db.Column(db.DateTime(timezone=True), server_default=db.func.now(),
+                        onupdate=db.func.now())
 
-        if data['duration'] >= datetime.timedelta(hours=1):
-            data['duration'] = str(data['duration'])
+    __table_args__ = (
+        db.Index('sms_blast_recipients_phone_number_key', blast_id, phone_number, unique=True),
+        db.Index('sms_blast_recipients_status_key', blast_id, status, id),
+    )
+
+    def __repr__(self):
+        return '<SmsBlastRecipient {} {}>'.format(self.phone_number, self.status)
+
+
+class Job(db.Model):
+    """Work for `flask run-worker`, usually Twilio REST calls that webhooks
+    shouldn't wait on. See calls.jobs for the kinds of job."""
+    __tablename__ = 'jobs'
+    NOTIFY_CHANNEL = 'jobs'
+    STATUSES = ('queued', 'done', 'failed')
+
+    # Claiming a job pushes run_after out by the lease, so if a worker dies
+    # mid-job, it gets picked up again once the lease is up
+    CLAIM_SQL = """
+        UPDATE jobs SET attempts = attempts + 1, updated = now(),
+            run_after = now() + :lease * INTERVAL '1 second'
+        WHERE id = (
+            SELECT id FROM jobs
+            WHERE status = 'queued' AND run_after <= now()
+            ORDER BY run_after, id
+            LIMIT 1
+            FOR UPDATE SKIP LOCKED
+        )
+        RETURNING *
+    """
+
+    id = db.Column(db.Integer, primary_key=True)
+    created = db.Column(db.DateTime(timezone=True), server_default=db.func.now())
+    updated = db.Column(db.DateTime(timezone=True), server_default=db.func.now(),
+                        onupdate=db.func.now())
+    kind = db.Column(db.String(40), nullable=False)
+    args = db.Column(postgresql.JSONB, nullable=False, default=dict)
+    status = db.Column(db.Enum(*STATUSES, name='job_status'), nullable=False, default='queued')
+    attempts = db.Column(db.SmallInteger, nullable=False, default=0)
+    run_after = db.Column(db.DateTime(timezone=True), nullable=False, server_default=db.func.now())
+    error = db.Column(db.Text)
+
+    __table_args__ = (
+        db.Index('jobs_queued_key', run_after, id, postgresql_where=db.text("status = 'queued'")),
+    )
+
+    @classmethod
+    def enqueue(cls, kind, delay=None, **args):
+        # Not committed, so the job is only queued if the caller's transaction is
+        job = cls(kind=kind, args=args)
+        if delay is not None:
+            job.run_after = db.func.now() + datetime.timedelta(seconds=delay)
+        db.session.add(job)
+        notify(cls.NOTIFY_CHANNEL, kind)
+        return job
+
+    @classmethod
+    def claim(cls, lease):
+        job = cls.query.from_statement(db.text(cls.CLAIM_SQL)).params(
+            lease=lease).populate_existing().first()
+        return job
+
+    def finish(self, error=None, retry_delay=None):
+        """Mark done, or failed if there's an error. With a retry delay, a
+        failed job is queued up to run again after that many seconds."""
+        self.error = error
+        if error is None:
+            self.status = 'done'
+        elif retry_delay is None:
+            self.status = 'failed'
         else:
-            data['duration'] = '{}:{:02d}'.format(
-                data['duration'].seconds // 60,
-                data['duration'].seconds % 60)
+            self.run_after = db.func.now() + datetime.timedelta(seconds=retry_delay)
+        db.session.add(self)
 
-        return data
+    def __repr__(self):
+        return '<Job {} {}>'.format(self.kind, self.status)
+
+
+class ChangeVersion(db.Model):
+    """Counter per resource (a model's change_resource), bumped in the same
+    transaction as any change to it, so endpoints can cheaply tell whether
+    anything changed. Calls being placed (last_called stamps) bump their own
+    resource, so they don't invalidate the panel."""
+    __tablename__ = 'change_versions'
+
+    name = db.Column(db.String(40), primary_key=True)
+    version = db.Column(db.BigInteger, nullable=False, default=0)
+
+    @classmethod
+    def bump(cls, *names, session=db.session):
+        # Sorted, so concurrent transactions lock rows in the same order
+        for name in sorted(set(names)):
+            session.execute(postgresql.insert(cls.__table__).values(name=name, version=1).on_conflict_do_update(
+                index_elements=['name'], set_={'version': cls.__table__.c.version + 1}))
+
+    @classmethod
+    def mark(cls, *names, session=db.session):
+        """Have names bumped when the current transaction commits."""
+        session.info.setdefault('changed_resources', set()).update(names)
+
+    @classmethod
+    def get(cls, *names):
+        versions = dict(db.session.query(cls.name, cls.version).filter(cls.name.in_(names)))
+        return tuple(versions.get(name, 0) for name in names)
+
+    def __repr__(self):
+        return '<ChangeVersion {}={}>'.format(self.name, self.version)
+
+
+# Changes are noted as they're flushed, and their versions bumped just before
+# commit, after the rest of the transaction's writes. So the few hot
+# change_versions rows are always locked last, in the same order, and only for
+# as long as the commit takes.
+@event.listens_for(Session, 'before_flush')
+def record_changed_resources(session, flush_context, instances):
+    changed = itertools.chain(
+        session.new, session.deleted, (obj for obj in session.dirty if session.is_modified(obj)))
+    ChangeVersion.mark(*{obj.change_resource for obj in changed if getattr(obj, 'change_resource', None)},
+                       session=session)
+
+
+@event.listens_for(Session, 'before_commit')
+def bump_change_versions(session):
+    # Commit flushes after this hook runs, so flush now to see everything
+    session.flush()
+    ChangeVersion.bump(*session.info.pop('changed_resources', ()), session=session)
+
+
+@event.listens_for(Session, 'after_rollback')
+def discard_changed_resources(session):
+    session.info.pop('changed_resources', None)
@@ -0,0 +1,106 @@
+from collections import defaultdict
+import select
+import threading
+
+from calls.models import db
+
+
+class PostgresListener:
+    """Background thread that LISTENs on Postgres channels and calls back with
+    each notification's payload. Callbacks are also called with None whenever
+    the connection is (re)established, since notifications may have been missed
+    while disconnected."""
+
+    def __init__(self, app, reconnect_delay=5):
+        self.app = app
+        self.reconnect_delay = reconnect_delay
+        self.connected = threading.Event()
+        self._callbacks = defaultdict(list)
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def subscribe(self, channel, callback):
+        with self._lock:
+            if callback not in self._callbacks[channel]:
+                self._callbacks[channel].append(callback)
+
+            # Started lazily, so each forked worker gets its own thread and connection
+            if not self._thread or not self._thread.is_alive():
+                self._stopped.clear()
+                self._thread = threading.Thread(target=self._run, name='postgres-listener', daemon=True)
+                self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread:
+            self._thread.join()
+
+    def _run(self):
+        while not self._stopped.is_set():
+            try:
+                self._listen()
+            except Exception:
+                self.app.logger.exception('Postgres listener disconnected')
+            self.connected.clear()
+            self._stopped.wait(self.reconnect_delay)
+
+    def _listen(self):
+        with self.app.app_context():
+            connection = db.engine.raw_connection()
+        # Take the connection out of the pool for good, it's ours now
+        connection.detach()
+        dbapi_connection = connection.connection
+        dbapi_connection.set_session(autocommit=True)
+
+        try:
+            listening = set()
+            while not self._stopped.is_set():
+                with self._lock:
+                    channels = {channel: list(callbacks) for channel, callbacks in self._callbacks.items()}
+
+                new_channels = set(channels) - listening
+                if new_channels:
+                    with dbapi_connection.cursor() as cursor:
+                        for channel in new_channels:
+                            cursor.execute('LISTEN "{}"'.format(channel))
+                    listening.update(new_channels)
+                    for channel in new_channels:
+                        self._dispatch(channels[channel], None)
+                    self.connected.set()
+
+                if select.select([dbapi_connection], [], [], 1) == ([], [], []):
+                    continue
+
+                dbapi_connection.poll()
+                while dbapi_connection.notifies:
+                    notification = dbapi_connection.notifies.pop(0)
+                    self._dispatch(channels.get(notification.channel, ()), notification.payload)
+        finally:
+            dbapi_connection.close()
+
+    def _dispatch(self, callbacks, payload):
+        for callback in callbacks:
+            try:
+                callback(payload)
+            except Exception:  # skip coverage
+                self.app.logger.exception('Postgres listener callback failed')
+
+
+class Signal:
+    """Listener callback that wakes up any threads waiting on it."""
+
+    def __init__(self):
+        self.version = 0
+        self._condition = threading.Condition()
+
+    def __call__(self, payload=None):
+        with self._condition:
+            self.version += 1
+            self._condition.notify_all()
+
+    def wait(self, version, timeout):
+        """Wait until signalled after version was read, returning the new version."""
+        with self._condition:
+            self._condition.wait_for(lambda: self.version != version, timeout)
+            return self.version
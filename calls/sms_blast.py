@@ -0,0 +1,111 @@
+from concurrent.futures import (
+    as_completed,
+    ThreadPoolExecutor,
+)
+import random
+import threading
+import time
+
+from twilio.base.exceptions import TwilioRestException
+
+from calls.models import (
+    db,
+    SmsBlastRecipient,
+)
+from calls.utils import is_retryable_twilio_error
+
+
+class TokenBucket:
+    """Thread-safe rate limiter, allowing `rate` acquisitions a second on average
+    and bursts of up to `capacity`."""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or max(rate, 1)
+        self.tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class SmsBlaster:
+    """Sends a blast's pending messages from a pool of threads, limited to `rate`
+    API calls a second. Only the calling thread touches the database: a batch of
+    recipients is marked sending and committed before any of them are sent to,
+    and each result is committed as it comes in. So after a crash, a recipient
+    still marked sending is the only kind that may or may not have the message,
+    and those are never retried."""
+
+    def __init__(self, app, blast, workers, rate, max_attempts=5, backoff=1):
+        self.app = app
+        self.blast_id = blast.id
+        self.body = blast.body
+        self.from_ = app.config['WEIRDNESS_NUMBER']
+        self.workers = workers
+        self.bucket = TokenBucket(rate)
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+
+    def send_message(self, phone_number):
+        # Runs in a worker thread, returning (status, attempts, message sid, error)
+        for attempt in range(1, self.max_attempts + 1):
+            self.bucket.acquire()
+            try:
+                message = self.app.twilio.messages.create(body=self.body, from_=self.from_, to=phone_number)
+            except TwilioRestException as e:
+                if attempt == self.max_attempts or not is_retryable_twilio_error(e):
+                    return 'failed', attempt, None, str(e)
+                # Exponential backoff with jitter, so workers don't retry in lockstep
+                time.sleep(self.backoff * 2 ** (attempt - 1) * random.uniform(0.5, 1.5))
+            except Exception as e:  # skip coverage
+                # Who knows if Twilio got it, so leave it marked sending
+                return 'sending', attempt, None, repr(e)
+            else:
+                return 'sent', attempt, message.sid, None
+
+    def run(self, progress=None):
+        """Send to every pending recipient, calling progress(phone_number, status,
+        error) after each one. Returns the number of recipients processed."""
+        num_processed = 0
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            while True:
+                # Locked, in case someone else is resuming the same blast
+                recipients = SmsBlastRecipient.query.filter_by(
+                    blast_id=self.blast_id, status='pending',
+                ).order_by(SmsBlastRecipient.id).limit(self.workers * 10).with_for_update(skip_locked=True).all()
+                if not recipients:
+                    break
+
+                batch = [(recipient.id, recipient.phone_number) for recipient in recipients]
+                for recipient in recipients:
+                    recipient.status = 'sending'
+                db.session.commit()
+
+                futures = {executor.submit(self.send_message, phone_number): (id, phone_number)
+                           for id, phone_number in batch}
+                for future in as_completed(futures):
+                    id, phone_number = futures[future]
+                    status, attempts, message_sid, error = future.result()
+                    SmsBlastRecipient.query.filter_by(id=id).update({
+                        'status': status, 'attempts': attempts,
+                        'message_sid': message_sid, 'error': error,
+                    })
+                    db.session.commit()
+
+                    num_processed += 1
+                    if progress:
+                        progress(phone_number, status, error)
+
+        return num_processed
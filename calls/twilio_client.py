@@ -0,0 +1,130 @@
+import threading
+from types import SimpleNamespace
+import uuid
+
+from calls.utils import normalize_phone_number
+
+
+class LazyTwilioClient:
+    """Stands in for the app's Twilio client, which is built the first time it's
+    used: a twilio.rest.Client, or a FakeTwilioClient with TWILIO_FAKE. Saves
+    importing the twilio package, which is slow, in processes that never need it."""
+
+    def __init__(self, app):
+        self._app = app
+        self._client = None
+        self._lock = threading.Lock()
+
+    def get_client(self):
+        if self._client is None:
+            with self._lock:
+                if self._client is None:
+                    config = self._app.config
+                    if config['TWILIO_FAKE']:  # skip coverage
+                        self._client = FakeTwilioClient(self._app.logger)
+                    else:
+                        from twilio.rest import Client as TwilioClient
+                        from calls.twilio_http import PooledTwilioHttpClient
+
+                        self._client = TwilioClient(
+                            config['TWILIO_ACCOUNT_SID'],
+                            config['TWILIO_AUTH_TOKEN'],
+                            http_client=PooledTwilioHttpClient(
+                                self._app.twilio_http_stats,
+                                pool_size=config['TWILIO_HTTP_POOL_SIZE'],
+                                timeouts=config['TWILIO_HTTP_TIMEOUTS'],
+                                default_timeout=config['TWILIO_HTTP_DEFAULT_TIMEOUT'],
+                                max_retries=config['TWILIO_HTTP_MAX_RETRIES'],
+                                retry_backoff=config['TWILIO_HTTP_RETRY_BACKOFF'],
+                            ),
+                        )
+        return self._client
+
+    def __getattr__(self, name):
+        return getattr(self.get_client(), name)
+
+
+class TwilioHttpStats:
+    """Thread-safe counts and timings of outbound Twilio requests, by operation."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._operations = {}
+
+    def record(self, operation, seconds, error=False):
+        with self._lock:
+            stats = self._get(operation)
+            stats['requests'] += 1
+            stats['errors'] += int(error)
+            stats['seconds'] += seconds
+            stats['max_seconds'] = max(stats['max_seconds'], seconds)
+
+    def record_retry(self, operation):
+        with self._lock:
+            self._get(operation)['retries'] += 1
+
+    def get(self):
+        with self._lock:
+            return {operation: dict(stats) for operation, stats in self._operations.items()}
+
+    def _get(self, operation):
+        stats = self._operations.get(operation)
+        if stats is None:
+            stats = self._operations[operation] = {
+                'requests': 0, 'errors': 0, 'retries': 0, 'seconds': 0.0, 'max_seconds': 0.0}
+        return stats
+
+
+class FakeTwilioClient:
+    """Offline stand-in for twilio.rest.Client, covering the parts the app uses.
+    Requests are logged and kept in `requests` as (resource, method, kwargs)
+    rather than sent anywhere."""
+
+    def __init__(self, logger=None):
+        self.logger = logger
+        self.requests = []
+        self.calls = FakeResource(self, 'calls', 'CA')
+        self.messages = FakeResource(self, 'messages', 'SM')
+        self.recordings = FakeResource(self, 'recordings', 'RE', duration='0')
+        self.lookups = SimpleNamespace(phone_numbers=FakePhoneNumberLookup(self))
+
+    def record(self, resource, method, **kwargs):
+        self.requests.append((resource, method, kwargs))
+        if self.logger:
+            self.logger.info('Fake Twilio request: {}.{}({})'.format(resource, method, ', '.join(
+                '{}={!r}'.format(key, value) for key, value in sorted(kwargs.items()))))
+
+
+class FakeResource:
+    def __init__(self, client, name, sid_prefix, **defaults):
+        self.client = client
+        self.name = name
+        self.sid_prefix = sid_prefix
+        self.defaults = defaults
+
+    def create(self, **kwargs):
+        self.client.record(self.name, 'create', **kwargs)
+        return SimpleNamespace(sid='{}{}'.format(self.sid_prefix, uuid.uuid4().hex), **kwargs)
+
+    def list(self, **kwargs):
+        self.client.record(self.name, 'list', **kwargs)
+        return []
+
+    def get(self, sid):
+        return SimpleNamespace(fetch=lambda: self.fetch(sid))
+
+    def fetch(self, sid):
+        self.client.record(self.name, 'fetch', sid=sid)
+        return SimpleNamespace(sid=sid, **self.defaults)
+
+
+class FakePhoneNumberLookup:
+    def __init__(self, client):
+        self.client = client
+
+    def __call__(self, phone_number):
+        def fetch(**kwargs):
+            self.client.record('lookups.phone_numbers', 'fetch', phone_number=phone_number, **kwargs)
+            phone_number_e164, country_code = normalize_phone_number(phone_number) or (None, None)
+            return SimpleNamespace(phone_number=phone_number_e164, country_code=country_code)
+        return SimpleNamespace(fetch=fetch)
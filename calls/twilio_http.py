@@ -0,0 +1,108 @@
+# Imported when the Twilio client is first built, since requests and twilio are
+# slow to import (see LazyTwilioClient)
+import random
+import time
+from urllib.parse import urlsplit
+
+from requests.adapters import HTTPAdapter
+from requests.exceptions import (
+    ConnectionError,
+    ConnectTimeout,
+    Timeout,
+)
+from twilio.http.http_client import TwilioHttpClient
+from urllib3.exceptions import NewConnectionError
+
+from calls.utils import get_remaining_latency_budget
+
+
+IDEMPOTENT_METHODS = {'GET', 'HEAD', 'OPTIONS'}
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+# Even with the latency budget spent, give a request this long (seconds)
+MIN_TIMEOUT = 0.1
+
+
+def is_unsent_request_error(exception):
+    """Whether a request failed before it could have reached Twilio, so making
+    it again can't repeat whatever it does. Read timeouts and dropped
+    connections are ambiguous, and aren't."""
+    if isinstance(exception, ConnectTimeout):
+        return True
+    if isinstance(exception, ConnectionError) and exception.args:
+        # Refused, or the name didn't resolve
+        return isinstance(getattr(exception.args[0], 'reason', None), NewConnectionError)
+    return False
+
+
+def get_subdomain(url):
+    # eg. 'lookups' for https://lookups.twilio.com/v1/PhoneNumbers/...
+    return urlsplit(url).hostname.split('.', 1)[0]
+
+
+class TimeoutHTTPAdapter(HTTPAdapter):
+    """Connection pool filling in (connect, read) timeouts by Twilio subdomain,
+    for requests made without one, and cut short to fit in what's left of the
+    current request's latency budget."""
+
+    def __init__(self, timeouts, default_timeout, **kwargs):
+        self.timeouts = timeouts
+        self.default_timeout = default_timeout
+        super().__init__(**kwargs)
+
+    def send(self, request, timeout=None, **kwargs):
+        if timeout is None:
+            timeout = self.timeouts.get(get_subdomain(request.url), self.default_timeout)
+            remaining = get_remaining_latency_budget()
+            if remaining is not None:
+                timeout = tuple(min(seconds, max(remaining, MIN_TIMEOUT)) for seconds in timeout)
+        return super().send(request, timeout=timeout, **kwargs)
+
+
+class PooledTwilioHttpClient(TwilioHttpClient):
+    """Twilio HTTP client that keeps connections alive in a bounded pool shared
+    by the process's threads, and never waits on Twilio indefinitely. Idempotent
+    requests (lookups, fetching recordings) are retried with jittered backoff on
+    connection errors, timeouts and 429/5xx responses. Every attempt is recorded
+    in stats, a TwilioHttpStats, by method and subdomain, eg. 'GET lookups'."""
+
+    def __init__(self, stats, pool_size, timeouts, default_timeout, max_retries, retry_backoff, **kwargs):
+        super().__init__(pool_connections=True, **kwargs)
+        self.session.mount('https://', TimeoutHTTPAdapter(
+            timeouts, default_timeout, pool_maxsize=pool_size, pool_block=True))
+        self.stats = stats
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+
+    def request(self, method, url, *args, **kwargs):
+        operation = '{} {}'.format(method.upper(), get_subdomain(url))
+        retryable = method.upper() in IDEMPOTENT_METHODS
+
+        attempt = 0
+        while True:
+            start = time.perf_counter()
+            try:
+                response = super().request(method, url, *args, **kwargs)
+            except (ConnectionError, Timeout):
+                self.stats.record(operation, time.perf_counter() - start, error=True)
+                delay = self.get_retry_delay(attempt) if retryable else None
+                if delay is None:
+                    raise
+            else:
+                failed = response.status_code in RETRY_STATUS_CODES
+                self.stats.record(operation, time.perf_counter() - start, error=failed)
+                delay = self.get_retry_delay(attempt) if failed and retryable else None
+                if delay is None:
+                    return response
+
+            attempt += 1
+            self.stats.record_retry(operation)
+            time.sleep(delay)
+
+    def get_retry_delay(self, attempt):
+        """Exponential backoff with jitter, or None if out of retries or there's
+        no time left in the latency budget to retry."""
+        delay = self.retry_backoff * 2 ** attempt * random.uniform(0.5, 1.5)
+        remaining = get_remaining_latency_budget()
+        if attempt < self.max_retries and (remaining is None or remaining > delay):
+            return delay
+        return None
@@ -1,42 +1,330 @@
-from functools import wraps
+from collections import (
+    Counter,
+    OrderedDict,
+)
+import datetime
+from functools import (
+    lru_cache,
+    wraps,
+)
+import hashlib
+import random
 import re
+import threading
+import time
 from urllib.parse import unquote
+from xml.sax.saxutils import escape as xml_escape
 
+from markupsafe import escape
+import pytz
 from twilio.base.exceptions import TwilioRestException
 
 from flask import (
     current_app as app,
+    g,
+    has_request_context,
     render_template,
     request,
     Response,
     url_for,
 )
 
+from calls import constants
+
+
+class PhoneLookupCache:
+    """Two-tier cache for Twilio Lookup results: an in-process LRU in front of
+    the phone_lookups table. Values are (phone_number, country_code) tuples.
+    Numbers Twilio rejected are only remembered in-process, for negative_ttl."""
+
+    def __init__(self, max_size, ttl, negative_ttl=0):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.stats = Counter()
+        self._entries = OrderedDict()
+
+    def get(self, phone_number):
+        from calls.models import PhoneLookup  # Avoid circular import
+
+        sanitized = self._get_from_memory(phone_number)
+        if sanitized:
+            return sanitized
+
+        sanitized = PhoneLookup.get(phone_number, max_age=self.ttl)
+        if sanitized:
+            self.stats['db_hits'] += 1
+            self._remember(phone_number, sanitized)
+            return sanitized
+
+        self.stats['misses'] += 1
+        return None
+
+    def get_many(self, phone_numbers):
+        """Like get() for several numbers, returning a dict of the ones found."""
+        from calls.models import PhoneLookup
+
+        found, remaining = {}, []
+        for phone_number in phone_numbers:
+            sanitized = self._get_from_memory(phone_number)
+            if sanitized:
+                found[phone_number] = sanitized
+            else:
+                remaining.append(phone_number)
+
+        if remaining:
+            from_db = PhoneLookup.get_many(remaining, max_age=self.ttl)
+            self.stats['db_hits'] += len(from_db)
+            self.stats['misses'] += len(remaining) - len(from_db)
+            for phone_number, sanitized in from_db.items():
+                self._remember(phone_number, sanitized)
+            found.update(from_db)
+        return found
+
+    def set(self, phone_number, sanitized):
+        from calls.models import PhoneLookup
+
+        PhoneLookup.set(phone_number, *sanitized)
+        self._remember(phone_number, sanitized)
+
+    def set_invalid(self, phone_number):
+        if self.negative_ttl > 0:
+            self._remember(phone_number, (None, None), ttl=self.negative_ttl)
+
+    def clear(self):
+        self._entries.clear()
+        self.stats.clear()
+
+    def _get_from_memory(self, phone_number):
+        entry = self._entries.get(phone_number)
+        if entry:
+            expires, sanitized = entry
+            if expires > time.monotonic():
+                self._entries.move_to_end(phone_number)
+                self.stats['memory_hits'] += 1
+                return sanitized
+            del self._entries[phone_number]
+            self.stats['expired'] += 1
+        return None
+
+    def _remember(self, phone_number, sanitized, ttl=None):
+        self._entries[phone_number] = (time.monotonic() + (self.ttl if ttl is None else ttl), sanitized)
+        self._entries.move_to_end(phone_number)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.stats['evictions'] += 1
+
+
+def normalize_phone_number(phone_number):
+    """Normalize a phone number to E.164 without a network round trip. Returns
+    (phone_number, country_code), or None if Twilio Lookup needs to decide."""
+    phone_number = re.sub(r'[\s().\-/]', '', phone_number)
+    is_international = phone_number.startswith('+')
+    digits = phone_number[1:] if is_international else phone_number
+    if not digits.isdigit():
+        return None
+
+    if not is_international and len(digits) == 10:
+        digits = '1' + digits
+
+    if digits.startswith('1'):
+        area_code, exchange = digits[1:4], digits[4:7]
+        if (
+            len(digits) == 11
+            # Area codes and exchanges are NXX, without N11 or reserved N9X area codes
+            and area_code[0] not in '01' and area_code[1] != '9' and area_code[1:] != '11'
+            and exchange[0] not in '01' and exchange[1:] != '11'
+        ):
+            return ('+' + digits, constants.NANP_AREA_CODE_COUNTRIES.get(area_code, 'US'))
+
+    elif is_international:
+        for code_length in (2, 3):
+            calling_code = digits[:code_length]
+            if calling_code in constants.INTERNATIONAL_CALLING_CODES:
+                country_code, lengths = constants.INTERNATIONAL_CALLING_CODES[calling_code]
+                if len(digits) - code_length in lengths:
+                    return ('+' + digits, country_code)
+                break
+
+    return None
+
+
+def guess_phone_number(phone_number):
+    """Looser normalize_phone_number() for when Twilio Lookup is unavailable:
+    takes anything shaped like a full international or North American number.
+    The country is None, marking it as a guess to look up later. Returns (None,
+    None) otherwise."""
+    phone_number = re.sub(r'[\s().\-/]', '', phone_number)
+    digits = phone_number.lstrip('+')
+    if digits.isdigit():
+        if phone_number.startswith('+') and 8 <= len(digits) <= 15:
+            return ('+' + digits, None)
+        elif len(digits) == 10:
+            return ('+1' + digits, None)
+        elif len(digits) == 11 and digits.startswith('1'):
+            return ('+' + digits, None)
+    return (None, None)
+
+
+class CircuitBreaker:
+    """Stops calling a flaky dependency after failure_threshold consecutive
+    failures, counting calls slower than slow_seconds as failures. Once open,
+    calls are refused for reset_seconds, then one probe call is let through
+    (half open) to decide whether to close again."""
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, failure_threshold, slow_seconds, reset_seconds):
+        self.failure_threshold = failure_threshold
+        self.slow_seconds = slow_seconds
+        self.reset_seconds = reset_seconds
+        self.state = self.CLOSED
+        self.failures = 0
+        self._changed = time.monotonic()
+        self._lock = threading.Lock()
+
+    def allow(self):
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            # Probe again if the last probe never reported back
+            if time.monotonic() - self._changed >= self.reset_seconds:
+                self._set_state(self.HALF_OPEN)
+                return True
+            return False
+
+    def record(self, seconds=0, failed=False):
+        with self._lock:
+            if failed or seconds > self.slow_seconds:
+                self.failures += 1
+                if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+                    self._set_state(self.OPEN)
+            else:
+                self.failures = 0
+                if self.state != self.CLOSED:
+                    self._set_state(self.CLOSED)
+
+    def _set_state(self, state):
+        self.state = state
+        self._changed = time.monotonic()
+
+
+def start_latency_budget():
+    g.latency_deadline = time.monotonic() + app.config['WEBHOOK_LATENCY_BUDGET']
+
+
+def get_remaining_latency_budget():
+    """Seconds left to answer the current request in, or None outside of one."""
+    if has_request_context() and 'latency_deadline' in g:
+        return g.latency_deadline - time.monotonic()
+    return None
+
+
+def strip_intl_prefix(phone_number):
+    # Replace double zero with plus, because I'm used to that shit!
+    for intl_prefix in ('00', '011'):
+        if phone_number.startswith(intl_prefix):
+            return '+' + phone_number[len(intl_prefix):]
+    return phone_number
+
+
+class PhoneLookupUnavailable(Exception):
+    pass
+
+
+def fetch_phone_number(phone_number):
+    """Twilio Lookup, through the circuit breaker. Returns (phone_number,
+    country_code), or (None, None) if Twilio says the number's no good. Raises
+    PhoneLookupUnavailable if Twilio can't say."""
+    breaker = app.lookup_circuit_breaker
+    if not breaker.allow():
+        raise PhoneLookupUnavailable('Circuit breaker open')
+
+    start = time.monotonic()
+    try:
+        lookup = app.twilio.lookups.phone_numbers(
+            phone_number).fetch(country_code='US')
+    # Network errors from requests are OSErrors
+    except (TwilioRestException, OSError) as e:
+        if isinstance(e, TwilioRestException) and not is_retryable_twilio_error(e):
+            # Twilio answered, the number's no good
+            breaker.record(time.monotonic() - start)
+            app.logger.warning('Invalid phone number: {}'.format(phone_number))
+            return (None, None)
+
+        breaker.record(failed=True)
+        raise PhoneLookupUnavailable(repr(e)) from e
+    breaker.record(time.monotonic() - start)
+
+    if not lookup.phone_number:
+        return (None, None)
+    # Twilio doesn't always know the country
+    return (lookup.phone_number, lookup.country_code or '??')
+
+
+def lookup_phone_number(phone_number):
+    remaining = get_remaining_latency_budget()
+    if remaining is not None and remaining < app.config['LOOKUP_MIN_BUDGET']:
+        app.logger.warning('No time for Twilio Lookup, guessing at phone number: {}'.format(phone_number))
+        return guess_phone_number(phone_number)
+
+    try:
+        sanitized = fetch_phone_number(phone_number)
+    except PhoneLookupUnavailable as e:
+        app.logger.warning('Twilio Lookup unavailable ({}), guessing at phone number: {}'.format(e, phone_number))
+        return guess_phone_number(phone_number)
+
+    if sanitized[0]:
+        app.phone_lookup_cache.set(phone_number, sanitized)
+    else:
+        app.phone_lookup_cache.set_invalid(phone_number)
+    return sanitized
+
 
 def sanitize_phone_number(phone_number, with_country_code=False):
-    sanitized = (None, None) if with_country_code else None
+    sanitized = (None, None)
 
     if isinstance(phone_number, str):
-        # Replace double zero with plus, because I'm used to that shit!
-        for intl_prefix in ('00', '011'):
-            if phone_number.startswith(intl_prefix):
-                phone_number = '+' + phone_number[len(intl_prefix):]
-
-        try:
-            lookup = app.twilio.lookups.phone_numbers(
-                phone_number).fetch(country_code='US')
-        except TwilioRestException:  # skip coverage
-            app.logger.warn('Invalid phone number: {}'.format(phone_number))
-            pass
+        phone_number = strip_intl_prefix(phone_number)
+        # Well-formed numbers skip the network, then try cached Twilio Lookups
+        sanitized = (normalize_phone_number(phone_number) or app.phone_lookup_cache.get(phone_number)
+                     or lookup_phone_number(phone_number))
+
+    return sanitized if with_country_code else sanitized[0]
+
+
+def sanitize_phone_numbers(phone_numbers):
+    """sanitize_phone_number(..., with_country_code=True) for many numbers at
+    once, returning a dict of them. Cached lookups are fetched in one query."""
+    sanitized = {}
+    unknown = {}
+    for raw_phone_number in set(phone_numbers):
+        if not isinstance(raw_phone_number, str):
+            sanitized[raw_phone_number] = (None, None)
+            continue
+        phone_number = strip_intl_prefix(raw_phone_number)
+        known = normalize_phone_number(phone_number)
+        if known:
+            sanitized[raw_phone_number] = known
         else:
-            if with_country_code:
-                sanitized = (lookup.phone_number, lookup.country_code)
-            else:
-                sanitized = lookup.phone_number
+            unknown.setdefault(phone_number, []).append(raw_phone_number)
+
+    cached = app.phone_lookup_cache.get_many(unknown)
+    for phone_number, raw_phone_numbers in unknown.items():
+        known = cached.get(phone_number) or lookup_phone_number(phone_number)
+        for raw_phone_number in raw_phone_numbers:
+            sanitized[raw_phone_number] = known
 
     return sanitized
 
 
+def is_retryable_twilio_error(exception):
+    # Rate limited, or a problem on Twilio's end
+    return isinstance(exception, TwilioRestException) and (exception.status == 429 or exception.status >= 500)
+
+
 def protected(route):
     @wraps(route)
     def protected_route(*args, **kwargs):
@@ -55,10 +343,224 @@ def protected(route):
     return protected_route
 
 
+def conditional(*resources):
+    """Tag responses with an ETag derived from the change versions of resources
+    (see calls.models.ChangeVersion), answering a matching If-None-Match with a
+    304 without running the route at all."""
+    def decorator(route):
+        @wraps(route)
+        def conditional_route(*args, **kwargs):
+            from calls.models import ChangeVersion  # Avoid circular import
+
+            etag = hashlib.sha1('{} {}'.format(
+                ChangeVersion.get(*resources), request.full_path).encode()).hexdigest()
+            if etag in request.if_none_match:
+                response = Response(status=304)
+            else:
+                response = app.make_response(route(*args, **kwargs))
+            response.set_etag(etag)
+            # Browsers should check with us every time, rather than guessing
+            response.cache_control.no_cache = True
+            return response
+        return conditional_route
+    return decorator
+
+
 def render_xml(template, *args, **kwargs):
     return Response(render_template(template, *args, **kwargs), content_type='text/xml')
 
 
+class UrlRootCache:
+    """Values built from external URLs, kept per URL root and the config url_for
+    reads, so they're built again when either changes."""
+
+    URL_CONFIG = ('SERVER_NAME', 'APPLICATION_ROOT', 'PREFERRED_URL_SCHEME')
+    # The URL root comes from the Host header, so don't let it grow unbounded
+    MAX_URL_ROOTS = 8
+
+    def __init__(self, factory):
+        self.factory = factory
+        self._values = {}  # (url root, url config) => value
+
+    def get(self):
+        url_key = (request.url_root, tuple(app.config.get(name) for name in self.URL_CONFIG))
+        value = self._values.get(url_key)
+        if value is None:
+            if len(self._values) >= self.MAX_URL_ROOTS:
+                self.clear()
+            value = self._values[url_key] = self.factory()
+        return value
+
+    def clear(self):
+        self._values = {}
+
+
+class StaticXmlCache:
+    """Pre-rendered bodies for TwiML responses that are the same every time apart
+    from the random song. Each one is rendered once per song the first time it's
+    served, then served as bytes with no template work. Song URLs are absolute,
+    so bodies are kept per URL root (see UrlRootCache). Only for templates that
+    use nothing from the template context besides song_url."""
+
+    def __init__(self, song_urls):
+        self.song_urls = song_urls
+        self._bodies = UrlRootCache(dict)  # {(template, context) => [body per song]}
+
+    def get(self, template, **context):
+        bodies = self._bodies.get()
+        key = (template, tuple(sorted(context.items())))
+        variants = bodies.get(key)
+        if variants is None:
+            variants = bodies[key] = [
+                render_template(template, song_url=song_url, **context).encode()
+                for song_url in self.song_urls.get()
+            ]
+        return random.choice(variants)
+
+    def clear(self):
+        self._bodies.clear()
+
+
+class LazyString:
+    """Template value that's only computed if it's rendered."""
+
+    def __init__(self, func):
+        self.func = func
+
+    def __str__(self):
+        return str(self.func())
+
+    def __html__(self):
+        return str(escape(self.func()))
+
+
+def render_static_xml(template, **context):
+    """Like render_xml(), for responses that only vary by song (see StaticXmlCache)."""
+    return Response(app.static_xml_cache.get(template, **context), content_type='text/xml')
+
+
+TWIML_ATTRIBUTE_ENTITIES = {'"': '&quot;'}
+
+
+class TwimlVerb:
+    """TwiML element, for building responses without going through Jinja. Verbs
+    nest like the XML they produce, eg. Dial(Number('+15555551234'), timeout=20).
+    Attributes are named like Twilio's, None attributes and children are left
+    out, and booleans are written as true/false."""
+
+    def __init__(self, *children, **attributes):
+        self.children = children
+        self.attributes = attributes
+
+    def write(self, out):
+        tag = type(self).__name__
+        out.append('<' + tag)
+        for name, value in self.attributes.items():
+            if value is not None:
+                if isinstance(value, bool):
+                    value = 'true' if value else 'false'
+                out.append(' {}="{}"'.format(name, xml_escape(str(value), TWIML_ATTRIBUTE_ENTITIES)))
+
+        children = [child for child in self.children if child is not None]
+        if children:
+            out.append('>')
+            for child in children:
+                if isinstance(child, TwimlVerb):
+                    child.write(out)
+                else:
+                    out.append(xml_escape(str(child)))
+            out.append('</{}>'.format(tag))
+        else:
+            out.append('/>')
+
+
+class Dial(TwimlVerb):
+    pass
+
+
+class Gather(TwimlVerb):
+    pass
+
+
+class Hangup(TwimlVerb):
+    pass
+
+
+class Message(TwimlVerb):
+    pass
+
+
+class Number(TwimlVerb):
+    pass
+
+
+class Play(TwimlVerb):
+    pass
+
+
+class Say(TwimlVerb):
+    pass
+
+
+class Sip(TwimlVerb):
+    pass
+
+
+def render_twiml(*verbs):
+    out = ['<?xml version="1.0" encoding="UTF-8"?><Response>']
+    for verb in verbs:
+        verb.write(out)
+    out.append('</Response>')
+    return Response(''.join(out), content_type='text/xml')
+
+
+# Builder equivalents of the hottest templates, taking the same arguments
+
+def render_call_twiml(from_number, to_number=None, to_numbers=None, to_sip_address=None, timeout=30,
+                      record=False, action_url=None, whisper_url=None):
+    """call.xml"""
+    if to_sip_address:
+        targets = [Sip(to_sip_address)]
+    else:
+        targets = [Number(number, url=whisper_url or None) for number in to_numbers or [to_number]]
+
+    recording = bool(app.config['RECORDING_ENABLED'] and record)
+    return render_twiml(Dial(
+        *targets,
+        answerOnBridge=True,
+        ringTone='us',
+        callerId=from_number,
+        timeout=timeout,
+        record='record-from-answer' if recording else None,
+        trim='trim-silence' if recording else None,
+        action=action_url or None,
+    ))
+
+
+def render_whisper_twiml(confirmed, has_gathered, action_url):
+    """whisper.xml"""
+    if confirmed:
+        return render_twiml(Say('Your call may be recorded for quality assurance purposes.'))
+    elif has_gathered:
+        return render_twiml(Hangup())
+    else:
+        # Announce three times and hang up
+        prompt = Say('Incoming call from Black Rock City, press any key to accept.')
+        return render_twiml(Gather(
+            prompt, prompt, prompt,
+            timeout=3, numDigits=1, finishOnKey='', actionOnEmptyResult=True, action=action_url))
+
+
+def render_sms_twiml(message):
+    """sms.xml"""
+    messages = [message] if isinstance(message, str) else message
+    return render_twiml(*(Message(msg) for msg in messages))
+
+
+def protected_url_for(endpoint, *args, **kwargs):
+    return url_for(endpoint, *args, password=app.config['API_PASSWORD'], **kwargs)
+
+
 def protected_external_url(endpoint, *args, **kwargs):
     kwargs.update({
         'password': app.config['API_PASSWORD'],
@@ -76,6 +578,89 @@ def parse_sip_address(address):
     return None
 
 
+def opt_in_hours_to_mask(hours):
+    mask = 0
+    for hour in hours:
+        mask |= 1 << hour
+    return mask
+
+
+def opt_in_mask_to_hours(mask):
+    return [hour for hour in range(24) if mask & (1 << hour)]
+
+
+@lru_cache(maxsize=1024)
+def get_timezone_name(timezone):
+    """Zone name from the form's timezone answer, eg "[GMT-07:00] Pacific Time //
+    Black Rock City Time (US/Pacific)", defaulting to the server's."""
+    try:
+        if timezone:
+            # Last word in string, trim out brackets
+            return pytz.timezone(timezone.split()[-1][1:-1]).zone
+    except (pytz.UnknownTimeZoneError, IndexError):
+        pass
+    return constants.SERVER_TZ.zone
+
+
+@lru_cache(maxsize=8192)
+def get_server_hour(timezone_name, label):
+    """Server hour an opt in hours label from the form, eg "9am - noon", starts at
+    for someone in the given zone."""
+    hour = label.split(' - ')[0]
+    if hour == 'midnight':
+        hour = 0
+    elif hour == 'noon':
+        hour = 12
+    else:
+        suffix = hour[-2:]
+        hour = int(hour[:-2], 10)
+        if suffix == 'pm':
+            hour += 12
+
+    # Localize hour on conversion date to user's timezone, then convert
+    # to server's timezone and take the hour
+    return pytz.timezone(timezone_name).localize(datetime.datetime.combine(
+        constants.DATE_FOR_TZ_CONVERSION, datetime.time(hour=hour),
+    )).astimezone(constants.SERVER_TZ).hour
+
+
+@lru_cache(maxsize=constants.OPT_IN_HOURS_CACHE_SIZE)
+def get_server_opt_in_hours(timezone_name, labels):
+    """Sorted server hours for a sorted tuple of lowercase opt in hours labels."""
+    opt_in_hours = []
+    for label in labels:
+        hour = get_server_hour(timezone_name, label)
+        for i in range(constants.FORM_HOUR_CHUNK_SIZE):
+            opt_in_hours.append((hour + i) % 24)
+    return tuple(sorted(opt_in_hours))
+
+
+def convert_opt_in_hours(timezone, labels):
+    """Server hours a form submission opted in to, from its answers."""
+    labels = tuple(sorted(label.strip().lower() for label in labels or ()))
+    return list(get_server_opt_in_hours(get_timezone_name(timezone), labels))
+
+
+def warm_opt_in_hours_cache(timezone_names):
+    for timezone_name in timezone_names:
+        for label in constants.FORM_OPT_IN_HOURS_LABELS:
+            get_server_hour(timezone_name, label)
+
+
+def get_opt_in_hours_cache_stats():
+    stats = {}
+    for name, func in (('labels', get_server_opt_in_hours), ('hours', get_server_hour),
+                       ('timezones', get_timezone_name)):
+        info = func.cache_info()
+        stats[name] = {
+            'hits': info.hits,
+            'misses': info.misses,
+            'size': info.currsize,
+            'hit_rate': round(info.hits / max(info.hits + info.misses, 1) * 100, 2),
+        }
+    return stats
+
+
 def get_gather_times():
     try:
         times = int(request.args.get('gather', '0'), 10) + 1
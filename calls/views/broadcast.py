@@ -11,6 +11,8 @@ from flask import (
 from calls import constants
 from calls.models import (
     db,
+    Job,
+    notify,
     Text,
     UserCodeConfig,
     Voicemail,
@@ -19,6 +21,8 @@ from calls.utils import (
     parse_sip_address,
     protected,
     protected_external_url,
+    render_call_twiml,
+    render_static_xml,
     render_xml,
     sanitize_phone_number,
 )
@@ -67,8 +71,7 @@ def outgoing():
         to_number = sanitize_phone_number(to_number)
         if to_number:
             app.logger.info('Outgoing broadcast call dialing: {}'.format(to_number))
-            return render_xml(
-                'call.xml',
+            return render_call_twiml(
                 record=True,
                 to_number=to_number,
                 from_number=app.config['BROADCAST_NUMBER'],
@@ -77,7 +80,7 @@ def outgoing():
     # Catch-all
     app.logger.warning("Outgoing broadcast call couldn't complete: {}".format(
         request.values.get('To')))
-    return render_xml('hang_up.xml', message=(
+    return render_static_xml('hang_up.xml', message=(
         'Your call cannot be completed as dialed. You dialed an invalid number. Please eat some cabbage, bring '
         'in your dry cleaning and try your call again. Good bye.'))
 
@@ -86,7 +89,7 @@ def outgoing():
 @protected
 def incoming():
     if request.args.get('voicemail'):
-        return render_xml(
+        return render_static_xml(
             'hang_up.xml', with_song=True,
             message='Did you want to re-record that? Too bad.')
 
@@ -95,7 +98,7 @@ def incoming():
 
     if call_status == 'completed':
         app.logger.info('Broadcast hung up on incoming caller')
-        return render_xml('hang_up.xml', with_song=True)
+        return render_static_xml('hang_up.xml', with_song=True)
 
     elif (
         call_status in ('busy', 'no-answer', 'failed')
@@ -123,8 +126,7 @@ def incoming():
 
     else:
         app.logger.info('Incoming broadcast call ringing')
-        return render_xml(
-            'call.xml',
+        return render_call_twiml(
             record=True,
             action_url=protected_external_url('broadcast.incoming'),
             from_number=app.config['BROADCAST_NUMBER'],
@@ -143,16 +145,16 @@ def transcribe():
         phone_number=from_number,
         transcription=request.values.get('TranscriptionText'),
         url=request.values.get('RecordingUrl'),
+        recording_sid=request.values.get('RecordingSid'),
     )
+    recording_duration = request.values.get('RecordingDuration', '')
+    if recording_duration.isdigit():
+        voicemail.duration = datetime.timedelta(seconds=int(recording_duration))
+    else:
+        # Looked up along with any others that come in soon
+        Job.enqueue('voicemail_durations', delay=app.config['VOICEMAIL_DURATION_BACKFILL_DELAY'])
     db.session.add(voicemail)
-    db.session.commit()
-
-    # This could fail, and we wouldn't want to lose the voicemail
-    voicemail.duration = datetime.timedelta(
-        seconds=int(app.twilio.recordings.get(
-            request.values.get('RecordingSid')).fetch().duration))
-    db.session.add(voicemail)
-    db.session.commit()
+    notify(constants.PANEL_NOTIFY_CHANNEL, 'voicemail')
 
     app.logger.info('Got voicemail from {}'.format(from_number))
     return Response(status=204)
@@ -164,7 +166,7 @@ def sms():
     from_number = request.values.get('From')
     text = Text(phone_number=from_number, body=request.values.get('Body'))
     db.session.add(text)
-    db.session.commit()
+    notify(constants.PANEL_NOTIFY_CHANNEL, 'text')
 
     app.logger.info('Received sms from {}'.format(from_number))
     return Response(status=204)
@@ -1,4 +1,10 @@
+import datetime
+import heapq
+import itertools
 import json
+import time
+
+import pytz
 
 from flask import (
     Blueprint,
@@ -6,16 +12,24 @@ from flask import (
     redirect,
     render_template,
     request,
+    Response,
+    stream_with_context,
     url_for,
 )
 
 from calls import constants
 from calls.models import (
+    db,
+    serialize_duration,
     Text,
     UserCodeConfig,
     Voicemail,
 )
-from calls.utils import protected
+from calls.notifications import Signal
+from calls.utils import (
+    conditional,
+    protected,
+)
 
 
 panel = Blueprint('panel', __name__, url_prefix='/panel')
@@ -33,39 +47,182 @@ def landing():
 
     return render_template(
         'panel.html',
-        show_all=bool(request.args.get('all')),
         codes=UserCodeConfig.CODES,
         outside_code=UserCodeConfig.BROADCAST_TO_WEIRDNESS_CODE,
+        poll_seconds=constants.PANEL_POLL_SECONDS,
+        stream=app.config['PANEL_STREAM'],
     )
 
 
-@panel.route('/data')
-@protected
-def data():
-    # Pool all texts and voicemails together, sorted by (created, id) reversed
-    items = []
-    for cls in (Text, Voicemail):
+FEED_MODELS = (Text, Voicemail)
+EPOCH = datetime.datetime(1970, 1, 1, tzinfo=pytz.utc)
+
+
+def encode_cursor(key):
+    created, id, type_name = key
+    return '{}-{}-{}'.format((created - EPOCH) // datetime.timedelta(microseconds=1), id, type_name)
+
+
+def decode_cursor(cursor):
+    try:
+        created, id, type_name = cursor.split('-')
+        return (EPOCH + datetime.timedelta(microseconds=int(created)), int(id), type_name)
+    except (AttributeError, ValueError):
+        return None
+
+
+def get_feed(limit, before=None, after=None, after_ids=None):
+    """Page of texts and voicemails merged in (created, id, type) order, newest
+    first from before (a cursor key), or oldest first after a cursor key or
+    per-type ids. Each table is read with a keyset query on its (created, id)
+    index, and the two sorted results are merged, so pages cost the same no
+    matter how much history there is. Returns (key, item) pairs."""
+    # Ids of -1 mean nothing seen yet, so they don't turn the page around
+    after_ids = {type_name: id for type_name, id in (after_ids or {}).items() if id > -1}
+    descending = bool(before) or not (after or after_ids)
+    cursor = before or after
+    results = []
+
+    for cls in FEED_MODELS:
         type_name = cls.__name__.lower()
-        after_id = int(request.args.get('after_{}_id'.format(type_name), -1))
+        query = cls.query
+
+        if cursor:
+            created, id, cursor_type_name = cursor
+            key = db.tuple_(cls.created, cls.id)
+            # Ties on (created, id) are broken by type name
+            if descending:
+                query = query.filter(cls.created <= created, (
+                    key <= (created, id) if type_name < cursor_type_name else key < (created, id)))
+            else:
+                query = query.filter(cls.created >= created, (
+                    key >= (created, id) if type_name > cursor_type_name else key > (created, id)))
+
+        if type_name in after_ids:
+            query = query.filter(cls.id > after_ids[type_name])
+
+        if descending:
+            query = query.order_by(cls.created.desc(), cls.id.desc())
+        else:
+            query = query.order_by(cls.created, cls.id)
+
+        results.append(((item.created, item.id, type_name), item) for item in query.limit(limit))
+
+    return list(itertools.islice(
+        heapq.merge(*results, key=lambda result: result[0], reverse=descending), limit))
+
+
+def serialize_feed(feed):
+    # Oldest first, like the panel expects
+    items = []
+    for key, item in sorted(feed, key=lambda result: result[0]):
+        data = item.serialize()
+        data['type'] = key[-1]
+        items.append(data)
+    return items
+
 
-        query = cls.query.order_by(cls.created.desc())
+def get_codes():
+    return [(code.name, UserCodeConfig.get(code.name)) for code in UserCodeConfig.CODES]
 
-        if after_id > -1:
-            query = query.filter(cls.id > after_id)
 
-        if request.args.get('all'):
-            query = query.limit(constants.MAX_PANEL_ITEMS)
+def get_durations(voicemail_ids):
+    """Durations of the given voicemails that are no longer pending."""
+    if not voicemail_ids:
+        return {}
+    return {voicemail.id: serialize_duration(voicemail.duration) for voicemail in Voicemail.query.filter(
+        Voicemail.id.in_(voicemail_ids), Voicemail.duration.isnot(None))}
 
-        for item in query.all():
-            data = item.serialize()
-            data['type'] = type_name
-            items.append((item.created, item.id, data))
-    items.sort(key=lambda item: (item[0], item[1]))
+
+def get_pending_voicemail_ids():
+    return {int(id) for id in request.args.get('pending_voicemails', '').split(',') if id.isdigit()}
+
+
+def get_after_ids():
+    # Malformed values are ignored, like malformed cursors
+    return {type_name: request.args.get('after_{}_id'.format(type_name), -1, type=int)
+            for type_name in ('text', 'voicemail')}
+
+
+@panel.route('/data')
+@protected
+@conditional('panel')
+def data():
+    limit = max(min(request.args.get('limit', constants.MAX_PANEL_ITEMS, type=int), constants.MAX_PANEL_ITEMS), 1)
+    before = decode_cursor(request.args.get('before'))
+    after = decode_cursor(request.args.get('after'))
+    feed = get_feed(limit, before=before, after=after, after_ids=get_after_ids())
+    keys = sorted(key for key, _ in feed)
 
     return {
-        'items': [item[-1] for item in items],
-        'codes': [
-            (code.name, UserCodeConfig.get(code.name))
-            for code in UserCodeConfig.CODES
-        ],
+        'items': serialize_feed(feed),
+        'codes': get_codes(),
+        # Voicemails the page is waiting on a duration for
+        'durations': get_durations(get_pending_voicemail_ids()),
+        # Cursors for the next older page, and for items newer than this page
+        'before': encode_cursor(keys[0]) if keys else request.args.get('before'),
+        'after': encode_cursor(keys[-1]) if keys else request.args.get('after'),
     }
+
+
+panel_changed = Signal()
+
+
+@panel.route('/stream')
+@protected
+def stream():
+    # Server-sent events with new items and code values. Event ids are
+    # "<text id>:<voicemail id>", so reconnecting browsers resume from the last
+    # event they saw via the Last-Event-ID header.
+    if not app.config['PANEL_STREAM']:
+        return Response(status=404)  # Panels poll instead, see base_config
+
+    after_ids = get_after_ids()
+    pending_voicemail_ids = get_pending_voicemail_ids()
+    last_event_id = request.headers.get('Last-Event-ID', '').split(':')
+    if len(last_event_id) == 2 and all(id.lstrip('-').isdigit() for id in last_event_id):
+        after_ids = dict(zip(('text', 'voicemail'), map(int, last_event_id)))
+
+    if app.config['POSTGRES_LISTEN']:
+        for channel in (constants.PANEL_NOTIFY_CHANNEL, UserCodeConfig.NOTIFY_CHANNEL):
+            app.postgres_listener.subscribe(channel, panel_changed)
+
+    def events():
+        deadline = time.monotonic() + app.config['PANEL_STREAM_MAX_DURATION']
+        codes = None
+        yield 'retry: {}\n\n'.format(constants.PANEL_POLL_SECONDS * 1000)
+
+        while True:
+            version = panel_changed.version
+            feed = get_feed(constants.MAX_PANEL_ITEMS, after_ids=after_ids)
+            items, new_codes = serialize_feed(feed), get_codes()
+            durations = get_durations(pending_voicemail_ids)
+            # Don't hold on to a database connection while waiting
+            db.session.close()
+
+            if items or new_codes != codes or durations:
+                codes = new_codes
+                pending_voicemail_ids.difference_update(durations)
+                for item in items:
+                    after_ids[item['type']] = max(after_ids[item['type']], item['id'])
+                    if item['type'] == 'voicemail' and item['duration'] is None:
+                        pending_voicemail_ids.add(item['id'])
+                yield 'id: {text}:{voicemail}\ndata: {data}\n\n'.format(
+                    data=json.dumps({'items': items, 'codes': codes, 'durations': durations}), **after_ids)
+            else:
+                yield ': keepalive\n\n'
+
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            elif len(feed) == constants.MAX_PANEL_ITEMS:
+                continue  # More to catch up on
+
+            # Fall back to polling if notifications aren't coming through
+            timeout = app.config['PANEL_STREAM_KEEPALIVE']
+            if not app.postgres_listener.connected.is_set():
+                timeout = min(timeout, constants.PANEL_POLL_SECONDS)
+            panel_changed.wait(version, timeout=min(timeout, remaining))
+
+    return Response(stream_with_context(events()), content_type='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
@@ -1,61 +1,77 @@
-from twilio.base.exceptions import TwilioRestException
+import csv
+import io
 
 from flask import (
     Blueprint,
     current_app as app,
     request,
     Response,
+    stream_with_context,
 )
+from flask.json import dumps
 
 from calls import constants
 from calls.models import (
     db,
+    Job,
     Submission,
     Volunteer,
 )
 from calls.utils import (
+    conditional,
     get_gather_times,
+    get_opt_in_hours_cache_stats,
     protected,
     protected_external_url,
+    render_static_xml,
     render_xml,
 )
 
 
 volunteers = Blueprint('volunteers', __name__, url_prefix='/volunteers')
 
+EXPORT_MIMETYPES = {'csv': 'text/csv', 'ndjson': 'application/x-ndjson'}
+EXPORT_MODELS = (('submission', Submission), ('volunteer', Volunteer))
+# Union of both tables' columns, in table order
+EXPORT_CSV_COLUMNS = ['type'] + list(dict.fromkeys(
+    column.name for _, model in EXPORT_MODELS for column in model.__table__.columns))
+
+# Every count in one round trip. Unique submissions can be read off the
+# submissions_valid_phone_number_key partial index, already in order.
+STATS_SQL = """
+    SELECT
+        (SELECT COUNT(*) FROM submissions) AS total_submissions,
+        (SELECT COUNT(DISTINCT phone_number) FROM submissions WHERE valid_phone) AS unique_submissions,
+        COUNT(*) AS num_volunteers,
+        COUNT(*) FILTER (WHERE last_called IS NOT NULL) AS num_volunteers_called
+    FROM volunteers
+"""
+
 
 @volunteers.route('/submit', methods=('POST',))
 @protected
 def submit():
+    # Flushed, for the id and column defaults that the volunteer and verify URL use
     submission = Submission.create_from_json(request.get_json())
 
     if submission.valid_phone:
-        # Do we already have a volunteer?
-        volunteer = Volunteer.query.filter_by(
-            phone_number=submission.phone_number).first()
+        # Update the volunteer for this phone number, if we already have one
+        volunteer = Volunteer.update_from_submission(submission)
 
-        # A volunteer already exists for this phone number
         if volunteer:
-            for attr, value in submission.get_volunteer_kwargs().items():
-                setattr(volunteer, attr, value)
-
-            db.session.add(volunteer)
-            db.session.commit()
+            Job.enqueue(
+                'sms',
+                body='Thanks for updating your BMIR Phone Experiment submission.',
+                from_=app.config['WEIRDNESS_NUMBER'],
+                to=submission.phone_number,
+            )
             app.logger.info('Volunteer {} updated by form'.format(volunteer.phone_number))
 
-            try:
-                app.twilio.messages.create(
-                    body='Thanks for updating your BMIR Phone Experiment submission.',
-                    from_=app.config['WEIRDNESS_NUMBER'],
-                    to=submission.phone_number,
-                )
-            except TwilioRestException:  # skip coverage
-                pass
-
         else:
             app.logger.info('Submission {} created (valid phone)'.format(
                 submission.phone_number))
-            app.twilio.calls.create(
+            Job.enqueue(
+                'call',
                 machine_detection='Enable',
                 machine_detection_silence_timeout=3000,
                 url=protected_external_url('volunteers.verify', id=submission.id),
@@ -78,7 +94,7 @@ def verify(id):
         app.logger.warning(
             "Couldn't verify submission id={} because of answering machine start".format(
                 submission.id))
-        return render_xml('hang_up.xml')
+        return render_static_xml('hang_up.xml')
 
     gather_times = get_gather_times()
 
@@ -101,9 +117,56 @@ def verify(id):
     )
 
 
+def get_export_rows():
+    # Server-side cursor fetching a batch at a time, so only one batch of rows
+    # is ever in memory
+    for type_name, model in EXPORT_MODELS:
+        query = model.query.order_by(model.id.desc()).execution_options(
+            stream_results=True).yield_per(constants.EXPORT_BATCH_SIZE)
+        for row in query:
+            data = {'type': type_name}
+            data.update(row.serialize())
+            yield data
+
+
+def export(export_format):
+    def generate():
+        buffer = io.StringIO()
+        if export_format == 'csv':
+            writer = csv.DictWriter(buffer, fieldnames=EXPORT_CSV_COLUMNS)
+            writer.writeheader()
+            write = writer.writerow
+        else:
+            def write(row):
+                buffer.write(dumps(row) + '\n')
+
+        def flush():
+            chunk = buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+            return chunk
+
+        yield flush()
+        for num, row in enumerate(get_export_rows(), 1):
+            write(row)
+            if num % constants.EXPORT_BATCH_SIZE == 0:
+                yield flush()
+        yield flush()
+
+    response = Response(stream_with_context(generate()), mimetype=EXPORT_MIMETYPES[export_format])
+    if export_format == 'csv':
+        response.headers['Content-Disposition'] = 'attachment; filename=volunteers.csv'
+    return response
+
+
 @volunteers.route('/')
 @protected
+@conditional('volunteers', 'volunteer_calls')
 def json():
+    export_format = request.args.get('format')
+    if export_format in EXPORT_MIMETYPES:
+        return export(export_format)
+
     return {
         'submissions': [s.serialize() for s in Submission.query.order_by(
             Submission.id.desc()).all()],
@@ -115,19 +178,34 @@ def json():
 
 @volunteers.route('/stats')
 @protected
+@conditional('volunteers', 'volunteer_calls')
 def json_stats():
-    unique_submissions = Submission.query.filter_by(
-        valid_phone=True).distinct('phone_number').count()
-    num_volunteers = Volunteer.query.count()
-    unique_unconfirmed = unique_submissions - num_volunteers
+    stats = db.session.execute(db.text(STATS_SQL)).first()
+    unique_unconfirmed = stats.unique_submissions - stats.num_volunteers
 
     return {
-        'total_submissions': Submission.query.count(),
-        'unique_submissions': unique_submissions,
+        'total_submissions': stats.total_submissions,
+        'unique_submissions': stats.unique_submissions,
         'unique_unconfirmed': unique_unconfirmed,
-        'num_volunteers': num_volunteers,
+        'num_volunteers': stats.num_volunteers,
         'conversion': round(
-            (num_volunteers / max(num_volunteers + unique_unconfirmed, 1)) * 100, 2),
-        'num_volunteers_called': Volunteer.query.filter(
-            Volunteer.last_called.isnot(None)).count(),
+            (stats.num_volunteers / max(stats.num_volunteers + unique_unconfirmed, 1)) * 100, 2),
+        'num_volunteers_called': stats.num_volunteers_called,
     }
+
+
+@volunteers.route('/stats/caches')
+@protected
+def cache_stats():
+    # For this worker process only
+    return {
+        'opt_in_hours': get_opt_in_hours_cache_stats(),
+        'phone_lookups': dict(app.phone_lookup_cache.stats),
+    }
+
+
+@volunteers.route('/stats/twilio')
+@protected
+def twilio_stats():
+    # Outbound requests made by this worker process
+    return app.twilio_http_stats.get()
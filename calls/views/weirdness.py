@@ -19,6 +19,10 @@ from calls.utils import (
     parse_sip_address,
     protected,
     protected_external_url,
+    render_call_twiml,
+    render_sms_twiml,
+    render_static_xml,
+    render_whisper_twiml,
     render_xml,
     sanitize_phone_number,
 )
@@ -49,7 +53,7 @@ def outgoing():
                 'with_song': True,
             }
         app.logger.info('Outgoing weirdness call completed')
-        return render_xml('hang_up.xml', **context)
+        return render_static_xml('hang_up.xml', **context)
     else:
         # 1 in 30 chance we're calling the BMIR broadcast phone (unless this
         # call came routed from the broadcast desk)
@@ -61,8 +65,7 @@ def outgoing():
             and UserCodeConfig.get('random_weirdness_to_broadcast')
         ):
             app.logger.info('Outgoing weirdness call won lottery, dialing broadcast phone')
-            return render_xml(
-                'call.xml',
+            return render_call_twiml(
                 timeout=20,
                 record=True,
                 from_number=app.config['WEIRDNESS_NUMBER'],
@@ -81,8 +84,7 @@ def outgoing():
             app.logger.info('Outgoing weirdness call to {}'.format(
                 to_numbers[0] if len(to_numbers) == 1 else to_numbers
             ))
-            return render_xml(
-                'call.xml',
+            return render_call_twiml(
                 record=True,
                 timeout=20,
                 from_number=app.config['WEIRDNESS_NUMBER'],
@@ -92,7 +94,7 @@ def outgoing():
             )
         else:
             app.logger.info('Outgoing weirdness call found no volunteers. Hanging up.')
-            return render_xml(
+            return render_static_xml(
                 'hang_up.xml',
                 message='You lose. Thanks for playing! Better luck next time!',
                 with_song=True,
@@ -106,8 +108,7 @@ def whisper():
     has_gathered = bool(request.args.get('has_gathered'))
     app.logger.info('Whispering to {} (confirmed = {}, gathered = {})'.format(
         request.values.get('To'), confirmed, has_gathered))
-    return render_xml(
-        'whisper.xml',
+    return render_whisper_twiml(
         confirmed=confirmed,
         has_gathered=has_gathered,
         action_url=protected_external_url(
@@ -121,7 +122,7 @@ def incoming():
     from_number = sanitize_phone_number(request.values.get('From'))
     if not from_number:
         app.logger.info('Incoming weirdness with caller ID blocked')
-        return render_xml(
+        return render_static_xml(
             'hang_up.xml',
             message='Call with your caller ID unblocked to get through. Goodbye!')
 
@@ -138,10 +139,9 @@ def incoming():
         if volunteer:
             if request.args.get('confirm'):
                 db.session.delete(volunteer)
-                db.session.commit()
 
                 app.logger.info('Volunteer {} removed by call'.format(from_number))
-                return render_xml(
+                return render_static_xml(
                     'hang_up.xml', with_song=True,
                     message=('You will no longer receive calls. To sign back up, '
                              'call this number or go to calls dot B M I R dot org.'))
@@ -152,7 +152,7 @@ def incoming():
         else:
             submission = Submission(phone_number=from_number)
             db.session.add(submission)
-            db.session.commit()
+            db.session.flush()
             app.logger.info('Volunteer {} added by call'.format(from_number))
             return redirect(protected_external_url(
                 'volunteers.verify', id=submission.id, phoned='y'))
@@ -178,7 +178,6 @@ def sms():
     if volunteer:
         if any(phrase in incoming_message for phrase in ('go away', 'goaway')):
             db.session.delete(volunteer)
-            db.session.commit()
             app.logger.info('Volunteer {} removed by sms'.format(from_number))
 
             message = ('You will no longer receive calls from the BMIR Phone Experiment.',
@@ -192,7 +191,8 @@ def sms():
             if any(phrase in incoming_message for phrase in ('sign up', 'signup')):
                 submission = Submission(phone_number=from_number)
                 db.session.add(submission)
-                db.session.commit()
+                # Fill in column defaults for the volunteer
+                db.session.flush()
                 submission.create_volunteer()
 
                 app.logger.info('Volunteer {} added by sms'.format(from_number))
@@ -208,4 +208,4 @@ def sms():
         else:
             message = 'Go to https://calls.bmir.org/ to sign up for BMIR Phone Experiment.'
 
-    return render_xml('sms.xml', message=message)
+    return render_sms_twiml(message)
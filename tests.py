@@ -1,21 +1,77 @@
+from contextlib import contextmanager
+import csv
 import datetime
+import io
+import json
 import re
-from unittest.mock import patch
+import tempfile
+import threading
+import time
+from unittest.mock import (
+    call,
+    MagicMock,
+    patch,
+)
 import unittest
 
+import requests
+from sqlalchemy import event
 from sqlalchemy.engine.url import make_url
+from twilio.base.exceptions import TwilioRestException
 
-from flask import url_for
+from flask import (
+    render_template,
+    url_for,
+)
 
 from calls import app
+from calls import create_app
+from calls import get_git_rev
+from calls import get_songs
 from calls import constants
+from calls import jobs
+from calls.benchmarks import (
+    generate_rows,
+    legacy_serialize,
+    TWIML_CASES,
+    twiml_tree,
+)
 from calls.models import (
+    ChangeVersion,
     db,
+    Job,
+    notify,
+    PhoneLookup,
+    SmsBlast,
+    SmsBlastRecipient,
     Submission,
     Text,
     UserCodeConfig,
     Voicemail,
     Volunteer,
+    VolunteerSchedule,
+)
+from calls.notifications import PostgresListener
+from calls.sms_blast import SmsBlaster
+from calls.twilio_client import (
+    FakeTwilioClient,
+    TwilioHttpStats,
+)
+from calls.twilio_http import PooledTwilioHttpClient
+from calls.views.panel import encode_cursor
+from calls.utils import (
+    CircuitBreaker,
+    convert_opt_in_hours,
+    Dial,
+    get_opt_in_hours_cache_stats,
+    normalize_phone_number,
+    Number,
+    opt_in_hours_to_mask,
+    opt_in_mask_to_hours,
+    render_twiml,
+    sanitize_phone_number,
+    Say,
+    start_latency_budget,
 )
 
 
@@ -33,6 +89,7 @@ class BMIRCallsTests(unittest.TestCase):
             'SERVER_NAME': 'example.com',
             'SQLALCHEMY_DATABASE_URI': str(testing_db_uri),
             'API_PASSWORD': '',
+            'POSTGRES_LISTEN': False,
             'BROADCAST_SIP_USERNAME': 'broadcast',
             'OUTGOING_SIP_USERNAME': 'outgoing',
             'TWILIO_SIP_DOMAIN': 'domain',
@@ -45,6 +102,8 @@ class BMIRCallsTests(unittest.TestCase):
 
         db.drop_all()
         db.create_all()
+        app.phone_lookup_cache.clear()
+        UserCodeConfig.invalidate_cache()
         self.client = app.test_client()
 
     def tearDown(self):
@@ -83,11 +142,32 @@ class BMIRCallsTests(unittest.TestCase):
         db.session.commit()
         return submission
 
+    @staticmethod
+    def run_jobs():
+        return jobs.run_pending()
+
     @classmethod
     def create_volunteer(cls, submission=None):
         if not submission:
             submission = cls.create_submission()
-        return submission.create_volunteer()
+        volunteer = submission.create_volunteer()
+        db.session.commit()
+        return volunteer
+
+    @contextmanager
+    def assert_commits(self, count):
+        # Counts transactions actually committed to the database
+        commits = []
+
+        def on_commit(connection):
+            commits.append(connection)
+
+        event.listen(db.engine, 'commit', on_commit)
+        try:
+            yield
+        finally:
+            event.remove(db.engine, 'commit', on_commit)
+        self.assertEqual(len(commits), count)
 
     def test_volunteer_form_submit(self):
         self.assertEqual(Submission.query.count(), 0)
@@ -106,8 +186,12 @@ class BMIRCallsTests(unittest.TestCase):
         self.assertEqual(
             submission.timezone,
             '[GMT-07:00] Pacific Time // Black Rock City Time (US/Pacific)')
-        self.assertEqual(submission.country_code, 'US')
+        # Resolved offline, so the country comes from the area code, not Twilio
+        self.assertEqual(submission.country_code, 'CA')
         self.assertTrue(submission.valid_phone)
+        # The verification call is made by a worker
+        self.assertEqual(self.twilio_mock.calls.create.call_count, 0)
+        self.assertEqual(self.run_jobs(), 1)
         self.assertEqual(self.twilio_mock.calls.create.call_count, 1)
 
     def test_form_submit_additional_cases(self):
@@ -123,6 +207,7 @@ class BMIRCallsTests(unittest.TestCase):
         self.assertEqual(submission.phone_number, '+14169671111')
         self.assertEqual(submission.opt_in_hours, [0, 1, 2])
         self.assertEqual(submission.timezone, '')
+        self.run_jobs()
         self.assertEqual(self.twilio_mock.calls.create.call_count, 1)
         self.assertEqual(self.twilio_mock.messages.create.call_count, 0)
 
@@ -136,6 +221,7 @@ class BMIRCallsTests(unittest.TestCase):
         self.assertEqual(Volunteer.query.count(), 0)
         submission = Submission.query.order_by(Submission.id.desc()).first()
         self.assertFalse(submission.valid_phone)
+        self.assertEqual(self.run_jobs(), 0)
         self.assertEqual(self.twilio_mock.calls.create.call_count, 1)
         self.assertEqual(self.twilio_mock.messages.create.call_count, 0)
 
@@ -155,9 +241,360 @@ class BMIRCallsTests(unittest.TestCase):
         self.assertEqual(Volunteer.query.count(), 1)
         volunteer = Volunteer.query.first()
         self.assertEqual(volunteer.opt_in_hours, [12, 13, 14])
+        self.run_jobs()
         self.assertEqual(self.twilio_mock.calls.create.call_count, 1)
         self.assertEqual(self.twilio_mock.messages.create.call_count, 1)
 
+    def test_create_volunteer_existing_phone_number(self):
+        volunteer = self.create_volunteer()
+
+        # A second sign up for the same number leaves the first volunteer alone.
+        # (Saving the submission itself bumps the version.)
+        submission = self.create_submission(opt_in_hours=[1, 2])
+        versions = ChangeVersion.get('volunteers')
+        self.assertIs(submission.create_volunteer(), False)
+        db.session.commit()
+        self.assertEqual(Volunteer.query.count(), 1)
+        self.assertEqual(Volunteer.query.one().submission_id, volunteer.submission_id)
+        self.assertEqual(ChangeVersion.get('volunteers'), versions)
+
+        updated = Volunteer.update_from_submission(submission)
+        db.session.commit()
+        self.assertEqual(updated.id, volunteer.id)
+        self.assertEqual((updated.submission_id, updated.opt_in_hours), (submission.id, [1, 2]))
+        self.assertNotEqual(ChangeVersion.get('volunteers'), versions)
+
+        self.assertIsNone(Volunteer.update_from_submission(self.create_submission(phone_number='+14155550000')))
+
+    def test_form_submit_existing_volunteer(self):
+        volunteer = self.create_volunteer()
+
+        response = self.client.post(
+            url_for('volunteers.submit'), json=self.get_submit_json(opt_in_hours=['noon - 3pm'], timezone=''))
+        self.assertEqual(response.status_code, 200)
+
+        submission = Submission.query.order_by(Submission.id.desc()).first()
+        self.assertNotEqual(submission.id, volunteer.submission_id)
+        volunteer = Volunteer.query.one()
+        self.assertEqual((volunteer.submission_id, volunteer.opt_in_hours), (submission.id, [12, 13, 14]))
+        self.assertEqual(Job.query.one().kind, 'sms')
+
+    def test_import_submissions(self):
+        existing = self.create_volunteer()
+        self.mock_sanitize_phone_number('+14155550000')
+        self.twilio_mock.lookups.phone_numbers.reset_mock()
+
+        with tempfile.NamedTemporaryFile('w', suffix='.csv') as file:
+            writer = csv.writer(file)
+            writer.writerow(['phone_number', 'opt_in_hours', 'timezone'])
+            writer.writerow([' 416-967-1111 ', '9am - noon,noon - 3pm', ''])
+            writer.writerow(['(415) 555-1234', 'midnight - 3am', '(US/Eastern)'])
+            writer.writerow(['(415) 555-1234', '3pm - 6pm', ''])
+            writer.writerow(['not a number', '3pm - 6pm', ''])
+            writer.writerow(['+33612345678', '', ''])
+            writer.writerow(['4169671111', '6pm - 9pm', ''])
+            file.flush()
+
+            result = app.test_cli_runner().invoke(
+                args=['import-submissions', file.name, '--promote', '--batch-size', '3'])
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertIn('Imported 6 submissions, 1 volunteers updated', result.output)
+
+        submissions = Submission.query.filter(Submission.id != existing.submission_id).order_by(Submission.id).all()
+        self.assertEqual([(s.phone_number, s.country_code, s.valid_phone, s.opt_in_hours, s.timezone)
+                          for s in submissions], [
+            ('+14169671111', 'CA', True, list(range(9, 15)), ''),
+            ('+14155551234', 'US', True, [21, 22, 23], '(US/Eastern)'),
+            ('+14155551234', 'US', True, [15, 16, 17], ''),
+            ('+14155550000', 'US', True, [15, 16, 17], ''),
+            ('+33612345678', 'FR', True, [], ''),
+            ('+14169671111', 'CA', True, [18, 19, 20], ''),
+        ])
+        self.assertEqual(submissions[1].opt_in_mask, opt_in_hours_to_mask([21, 22, 23]))
+
+        # Existing volunteers are updated, later rows win, and unverified numbers aren't promoted
+        volunteers = {v.phone_number: v for v in Volunteer.query}
+        self.assertEqual(set(volunteers), {'+14169671111'})
+        self.assertEqual(volunteers['+14169671111'].id, existing.id)
+        self.assertEqual(volunteers['+14169671111'].opt_in_hours, [18, 19, 20])
+        self.assertEqual(volunteers['+14169671111'].submission_id, submissions[5].id)
+
+        # Twilio looked up the one number, once
+        self.assertEqual(self.twilio_mock.lookups.phone_numbers.call_args_list, [call('not a number')])
+
+    def test_import_submissions_google_forms(self):
+        # Shaped like a Google Forms export, with columns named after the questions
+        export = (
+            'Timestamp,What is your phone number?,Which hours can we call you? (in your time zone),'
+            'What time zone are you in?,Anything else?\n'
+            '2023/08/01 10:00:00 AM PDT,416-967-1111,"9am - noon, noon - 3pm",(US/Eastern),\n'
+            '2023/08/01 10:05:12 AM PDT,(415) 555-1234,midnight - 3am,,"Call me, maybe"\n'
+        )
+        with tempfile.NamedTemporaryFile('w', suffix='.csv') as file:
+            file.write(export)
+            file.flush()
+            result = app.test_cli_runner().invoke(args=['import-submissions', file.name])
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertIn('Imported 2 submissions', result.output)
+        self.assertEqual([(s.phone_number, s.opt_in_hours, s.timezone) for s in Submission.query.order_by(
+            Submission.id)], [('+14169671111', list(range(6, 12)), '(US/Eastern)'),
+                              ('+14155551234', [0, 1, 2], '')])
+
+        # Columns that can't be told from the headers are named explicitly
+        with tempfile.NamedTemporaryFile('w', suffix='.csv') as file:
+            file.write('Timestamp,Cell,Home phone,When?\n2023/08/01 10:00:00 AM PDT,416-967-1112,,6pm - 9pm\n')
+            file.flush()
+            result = app.test_cli_runner().invoke(args=['import-submissions', file.name])
+            self.assertEqual(result.exit_code, 1)
+            self.assertIn('No column for opt_in_hours', result.output)
+            self.assertIn("'When?'", result.output)
+
+            result = app.test_cli_runner().invoke(args=[
+                'import-submissions', file.name, '--column', 'phone_number=Cell', '--column', 'opt_in_hours=When?'])
+            self.assertEqual(result.exit_code, 0, result.output)
+        self.assertEqual(Submission.query.filter_by(phone_number='+14169671112').one().opt_in_hours,
+                         [18, 19, 20])
+
+    def test_normalize_phone_number(self):
+        for phone_number, expected in (
+            ('+14169671111', ('+14169671111', 'CA')),
+            ('416-967-1111', ('+14169671111', 'CA')),
+            ('1 (415) 555-1234', ('+14155551234', 'US')),
+            ('+1 787 555 1234', ('+17875551234', 'PR')),
+            ('+44 7911 123456', ('+447911123456', 'GB')),
+            ('+33612345678', ('+33612345678', 'FR')),
+            # Ambiguous, left to Twilio
+            ('9671111', None),
+            ('+1 911 555 1234', None),
+            ('+4169671111', None),
+            ('+4917612345678', None),
+            ('anonymous', None),
+        ):
+            self.assertEqual(normalize_phone_number(phone_number), expected, phone_number)
+
+        # Twilio isn't consulted for well-formed numbers
+        self.twilio_mock.lookups.phone_numbers.reset_mock()
+        self.assertEqual(sanitize_phone_number('0014169671111', with_country_code=True),
+                         ('+14169671111', 'CA'))
+        self.assertEqual(sanitize_phone_number('011447911123456'), '+447911123456')
+        self.twilio_mock.lookups.phone_numbers.assert_not_called()
+
+    def test_sanitize_phone_number_cache(self):
+        self.mock_sanitize_phone_number('+14169671111', 'CA')
+        self.twilio_mock.lookups.phone_numbers.reset_mock()
+
+        # First lookup goes to Twilio and is stored in both tiers
+        self.assertEqual(sanitize_phone_number('9671111', with_country_code=True),
+                         ('+14169671111', 'CA'))
+        self.assertEqual(self.twilio_mock.lookups.phone_numbers.call_count, 1)
+        self.assertEqual(PhoneLookup.query.count(), 1)
+        self.assertEqual(app.phone_lookup_cache.stats['misses'], 1)
+
+        # Repeat lookup is served from memory
+        self.assertEqual(sanitize_phone_number('9671111'), '+14169671111')
+        self.assertEqual(self.twilio_mock.lookups.phone_numbers.call_count, 1)
+        self.assertEqual(app.phone_lookup_cache.stats['memory_hits'], 1)
+
+        # A fresh process would find it in the database
+        app.phone_lookup_cache.clear()
+        self.assertEqual(sanitize_phone_number('9671111'), '+14169671111')
+        self.assertEqual(self.twilio_mock.lookups.phone_numbers.call_count, 1)
+        self.assertEqual(app.phone_lookup_cache.stats['db_hits'], 1)
+
+        # Expired entries are looked up again, and pruned
+        app.phone_lookup_cache.clear()
+        self.assertIsNone(PhoneLookup.get('9671111', max_age=0))
+        self.assertEqual(PhoneLookup.prune(max_age=0), 1)
+        self.assertEqual(sanitize_phone_number('9671111'), '+14169671111')
+        self.assertEqual(self.twilio_mock.lookups.phone_numbers.call_count, 2)
+
+        # Resolved without a country
+        self.mock_sanitize_phone_number('+14169671112', None)
+        self.assertEqual(sanitize_phone_number('9671112', with_country_code=True), ('+14169671112', '??'))
+        self.assertEqual(PhoneLookup.get('9671112', max_age=60), ('+14169671112', '??'))
+
+        # Unresolvable numbers are only remembered in-process, briefly
+        self.mock_sanitize_phone_number(None)
+        calls = self.twilio_mock.lookups.phone_numbers.call_count
+        self.assertIsNone(sanitize_phone_number('hi mom!'))
+        self.assertIsNone(sanitize_phone_number('hi mom!'))
+        self.assertEqual(self.twilio_mock.lookups.phone_numbers.call_count, calls + 1)
+        self.assertIsNone(PhoneLookup.get('hi mom!', max_age=60))
+        with patch.object(app.phone_lookup_cache, 'negative_ttl', 0):
+            app.phone_lookup_cache.clear()
+            self.assertIsNone(sanitize_phone_number('hi mom!'))
+            self.assertIsNone(app.phone_lookup_cache.get('hi mom!'))
+
+    def test_lookup_circuit_breaker(self):
+        breaker = CircuitBreaker(failure_threshold=2, slow_seconds=1, reset_seconds=60)
+        fetch = self.twilio_mock.lookups.phone_numbers().fetch
+        fetch.side_effect = TwilioRestException(503, 'https://lookups.twilio.com/')
+
+        with patch.object(app, 'lookup_circuit_breaker', breaker):
+            # Failed lookups fall back to guessing, without a country, and aren't cached
+            for _ in range(2):
+                self.assertEqual(sanitize_phone_number('+999 123 456 789', with_country_code=True),
+                                 ('+999123456789', None))
+            self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+            self.assertIn(b'Twilio Lookup: open', self.client.get(url_for('health')).data)
+
+            # Open, so Twilio isn't asked at all
+            fetch.reset_mock()
+            self.assertIsNone(sanitize_phone_number('hi mom!'))
+            fetch.assert_not_called()
+
+            # Once reset_seconds pass, a successful probe closes it
+            breaker.reset_seconds = 0
+            fetch.side_effect = None
+            self.mock_sanitize_phone_number('+999123456789', 'ZZ')
+            self.assertEqual(sanitize_phone_number('+999 123 456 789', with_country_code=True),
+                             ('+999123456789', 'ZZ'))
+            self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+
+            # Twilio saying a number is invalid is fine, slow lookups aren't
+            fetch.side_effect = TwilioRestException(404, 'https://lookups.twilio.com/')
+            self.assertIsNone(sanitize_phone_number('hi mom?'))
+            self.assertEqual(breaker.failures, 0)
+            breaker.record(seconds=5)
+            breaker.record(seconds=5)
+            self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+
+        # Requests with their latency budget spent don't wait on lookups
+        fetch.reset_mock()
+        with patch.dict(app.config, {'WEBHOOK_LATENCY_BUDGET': 0}), app.test_request_context():
+            start_latency_budget()
+            self.assertEqual(sanitize_phone_number('+999 555 0000'), '+9995550000')
+        fetch.assert_not_called()
+
+    def test_verify_phone_numbers(self):
+        breaker = CircuitBreaker(failure_threshold=1, slow_seconds=1, reset_seconds=60)
+        fetch = self.twilio_mock.lookups.phone_numbers().fetch
+        fetch.side_effect = TwilioRestException(503, 'https://lookups.twilio.com/')
+
+        with patch.object(app, 'lookup_circuit_breaker', breaker):
+            # Guessed at while Twilio's down, and flagged to look up later
+            for phone_number in ('+999 123 456 789', '+999 555 0000'):
+                response = self.client.post(url_for('volunteers.submit'),
+                                            json=self.get_submit_json(phone_number=phone_number))
+                self.assertEqual(response.status_code, 200)
+            submissions = Submission.query.order_by(Submission.id).all()
+            self.assertEqual([(s.phone_number, s.country_code, s.valid_phone, s.phone_guessed) for s in submissions], [
+                ('+999123456789', '??', True, True),
+                ('+9995550000', '??', True, True),
+            ])
+            volunteer = self.create_volunteer(submissions[0])
+            self.assertEqual(Job.query.filter_by(kind='verify_phone_numbers').count(), 2)
+            Job.query.update({'run_after': db.func.now()})
+            db.session.commit()
+
+            # Still down, so they're left for a retry
+            with patch.dict(app.config, {'JOB_RETRY_DELAY': 60}):
+                jobs.run_pending()
+            self.assertEqual(Job.query.filter_by(kind='verify_phone_numbers', status='queued').count(), 2)
+            self.assertEqual(Submission.query.filter_by(phone_guessed=True).count(), 2)
+
+            # Once it's back, they're looked up for real
+            breaker.reset_seconds = 0
+            fetch.side_effect = None
+            self.mock_sanitize_phone_number('+999123456789', 'ZZ')
+            self.assertEqual(jobs.verify_phone_numbers(), None)
+            db.session.commit()
+
+        self.assertEqual([(s.phone_number, s.country_code, s.valid_phone, s.phone_guessed)
+                          for s in Submission.query.order_by(Submission.id)], [
+            ('+999123456789', 'ZZ', True, False),
+            ('+999123456789', 'ZZ', True, False),
+        ])
+        self.assertEqual(Volunteer.query.get(volunteer.id).country_code, 'ZZ')
+
+        # Numbers Twilio doesn't know are no longer valid
+        submission = self.create_submission(phone_number='+9990000000', country_code='??', phone_guessed=True)
+        fetch.side_effect = TwilioRestException(404, 'https://lookups.twilio.com/')
+        jobs.verify_phone_numbers()
+        db.session.commit()
+        submission = Submission.query.get(submission.id)
+        self.assertEqual((submission.valid_phone, submission.phone_guessed), (False, False))
+
+    def test_opt_in_mask(self):
+        self.assertEqual(opt_in_hours_to_mask(range(24)), constants.ALL_HOURS_MASK)
+        self.assertEqual(opt_in_mask_to_hours(opt_in_hours_to_mask([0, 12, 23])), [0, 12, 23])
+
+        response = self.client.post(
+            url_for('volunteers.submit'),
+            json=self.get_submit_json(opt_in_hours=['noon - 3pm'], timezone=None))
+        self.assertEqual(response.status_code, 200)
+        submission = Submission.query.first()
+        self.assertEqual(submission.opt_in_hours, [12, 13, 14])
+        self.assertEqual(submission.opt_in_mask, 0b111 << 12)
+        self.assertEqual(submission.serialize()['opt_in_mask'], 0b111 << 12)
+
+        # Volunteers inherit the mask, and are only picked in those hours
+        volunteer = submission.create_volunteer()
+        self.assertEqual(volunteer.opt_in_mask, submission.opt_in_mask)
+        self.assertEqual(Volunteer.get_random_opted_in(current_hour=11), [])
+        self.assertEqual(Volunteer.get_random_opted_in(current_hour=13), [volunteer])
+
+        # Defaults to all hours
+        self.assertEqual(self.create_submission().opt_in_mask, constants.ALL_HOURS_MASK)
+
+    def test_serialize(self):
+        voicemail = Voicemail(phone_number='+14169671111', url='http://example.com',
+                              duration=datetime.timedelta(minutes=2, seconds=5))
+        db.session.add(voicemail)
+        db.session.commit()
+        self.assertEqual(voicemail.serialize()['duration'], '2:05')
+        self.assertEqual(voicemail.serialize()['transcription'], '[Unable to transcribe]')
+
+        # Same output as before serializers were built per model
+        rows = generate_rows(400) + [self.create_submission(), voicemail]
+        for row in rows:
+            self.assertEqual(json.dumps(row.serialize()), json.dumps(legacy_serialize(row)))
+
+    def test_convert_opt_in_hours(self):
+        eastern = '[GMT-04:00] Eastern Time (US/Eastern)'
+        self.assertEqual(convert_opt_in_hours(eastern, ['9AM - noon ']), [6, 7, 8])
+        self.assertEqual(convert_opt_in_hours(None, ['midnight - 3am', 'noon - 3pm']), [0, 1, 2, 12, 13, 14])
+        self.assertEqual(convert_opt_in_hours('(Not/AZone)', ['9pm - midnight']), [21, 22, 23])
+
+        # Same answers in any order come straight from the cache
+        hits = get_opt_in_hours_cache_stats()['labels']['hits']
+        self.assertEqual(convert_opt_in_hours(eastern, ['6pm - 9pm', '9am - noon']), [6, 7, 8, 15, 16, 17])
+        self.assertEqual(convert_opt_in_hours(eastern, ['9am - noon', '6pm - 9pm']), [6, 7, 8, 15, 16, 17])
+        self.assertEqual(get_opt_in_hours_cache_stats()['labels']['hits'], hits + 1)
+
+        response = self.client.get(url_for('volunteers.cache_stats'))
+        self.assertEqual(response.status_code, 200)
+        self.assertGreater(response.json['opt_in_hours']['hours']['hit_rate'], 0)
+        self.assertIn('phone_lookups', response.json)
+
+    def test_twilio_http_client(self):
+        stats = TwilioHttpStats()
+        client = PooledTwilioHttpClient(stats, pool_size=2, timeouts={'lookups': (1, 2)}, default_timeout=(3, 4),
+                                        max_retries=1, retry_backoff=0)
+        ok = requests.Response()
+        ok.status_code, ok._content = 200, b'{}'
+
+        # Lookups are retried, with their own timeouts
+        with patch('requests.adapters.HTTPAdapter.send', side_effect=[requests.exceptions.ReadTimeout(), ok]) as send:
+            response = client.request('GET', 'https://lookups.twilio.com/v1/PhoneNumbers/+14169671111')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([kwargs['timeout'] for _, kwargs in send.call_args_list], [(1, 2), (1, 2)])
+
+        # Creating a call isn't
+        with patch('requests.adapters.HTTPAdapter.send', side_effect=requests.exceptions.ConnectionError()) as send:
+            with self.assertRaises(requests.exceptions.ConnectionError):
+                client.request('POST', 'https://api.twilio.com/2010-04-01/Accounts/AC/Calls.json', data={})
+        self.assertEqual(send.call_count, 1)
+        self.assertEqual(send.call_args[1]['timeout'], (3, 4))
+
+        self.assertEqual(
+            {operation: (s['requests'], s['errors'], s['retries']) for operation, s in stats.get().items()},
+            {'GET lookups': (2, 1, 1), 'POST api': (1, 1, 0)})
+
+        response = self.client.get(url_for('volunteers.twilio_stats'))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json, app.twilio_http_stats.get())
+
     def test_column_max_size(self):
         submission = self.create_submission(phone_number='1' * 500)
         self.assertEqual(len(submission.phone_number), 20)
@@ -225,6 +662,60 @@ class BMIRCallsTests(unittest.TestCase):
         self.assertEqual(response.json['total_submissions'], 5)
         self.assertEqual(response.json['unique_submissions'], 5)
         self.assertEqual(response.json['unique_unconfirmed'], 0)
+        self.assertEqual(response.json['num_volunteers_called'], 0)
+
+        # Duplicates and invalid phones don't count as unique
+        self.create_submission(phone_number='+14169671110')
+        self.create_submission(phone_number='+14169671119', valid_phone=False)
+        self.create_submission(phone_number='+14169671118')
+        Volunteer.get_random_opted_in(current_hour=0)
+        response = self.client.get(url_for('volunteers.json_stats'))
+        self.assertEqual(response.json['total_submissions'], 8)
+        self.assertEqual(response.json['unique_submissions'], 6)
+        self.assertEqual(response.json['unique_unconfirmed'], 1)
+        self.assertEqual(response.json['conversion'], 83.33)
+        self.assertEqual(response.json['num_volunteers_called'], 1)
+
+    def test_json_export(self):
+        for n in range(5):
+            submission = self.create_submission(phone_number='+1416967111{}'.format(n))
+            if n % 2:
+                submission.create_volunteer()
+        data = self.client.get(url_for('volunteers.json')).json
+
+        # Small batches, so rows arrive over several chunks
+        with patch('calls.constants.EXPORT_BATCH_SIZE', 2):
+            response = self.client.get(url_for('volunteers.json', format='ndjson'))
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.mimetype, 'application/x-ndjson')
+            self.assertTrue(response.is_streamed)
+            rows = [json.loads(line) for line in response.data.decode().splitlines()]
+            self.assertEqual(rows, [dict(item, type='submission') for item in data['submissions']]
+                             + [dict(item, type='volunteer') for item in data['volunteers']])
+
+            response = self.client.get(url_for('volunteers.json', format='csv'))
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.mimetype, 'text/csv')
+            rows = list(csv.DictReader(io.StringIO(response.data.decode())))
+            self.assertEqual([(row['type'], int(row['id'])) for row in rows],
+                             [('submission', item['id']) for item in data['submissions']]
+                             + [('volunteer', item['id']) for item in data['volunteers']])
+            self.assertEqual(rows[0]['phone_number'], '+14169671114')
+            self.assertEqual(rows[0]['last_called'], '')
+            self.assertEqual(rows[-1]['submission_id'], str(data['volunteers'][-1]['submission_id']))
+
+    def test_create_app(self):
+        other_app = create_app()
+        self.assertIsNot(other_app, app)
+        self.assertEqual(sorted(rule.endpoint for rule in other_app.url_map.iter_rules()),
+                         sorted(rule.endpoint for rule in app.url_map.iter_rules()))
+        # Twilio client isn't built until it's used
+        self.assertIsNone(other_app.twilio._client)
+        # Nor do caches of database values
+        self.assertIsNot(other_app.user_code_config_cache, app.user_code_config_cache)
+
+        response = self.client.get(url_for('health'))
+        self.assertEqual(response.headers['X-Calls-Git-Rev'], get_git_rev())
 
     def test_public_urls(self):
         response = self.client.get(url_for('health'))
@@ -244,10 +735,14 @@ class BMIRCallsTests(unittest.TestCase):
             ('broadcast.incoming', 'post', {}),
             ('broadcast.sms', 'post', {}),
             ('broadcast.transcribe', 'post', {}),
+            ('panel.data', 'get', {}),
+            ('panel.stream', 'get', {}),
             ('volunteers.submit', 'post', {}),
             ('volunteers.verify', 'get', {'id': 1}),
             ('volunteers.verify', 'post', {'id': 1}),
             ('volunteers.json', 'get', {}),
+            ('volunteers.cache_stats', 'get', {}),
+            ('volunteers.twilio_stats', 'get', {}),
             ('volunteers.json_stats', 'get', {}),
             ('weirdness.outgoing', 'post', {}),
             ('weirdness.whisper', 'post', {}),
@@ -279,6 +774,60 @@ class BMIRCallsTests(unittest.TestCase):
         self.assertEqual(response.status_code, 200)
         self.assertIn(b'Invalid SIP address.', response.data)
 
+    def test_twiml_builder(self):
+        # Builders are semantically equivalent to the templates they replace
+        for template, builder, kwargs in TWIML_CASES:
+            with self.subTest(template=template, **kwargs):
+                self.assertEqual(twiml_tree(builder(**kwargs).get_data()),
+                                 twiml_tree(render_template(template, **kwargs)))
+
+        recording_enabled = app.config['RECORDING_ENABLED']
+        app.config['RECORDING_ENABLED'] = False
+        try:
+            template, builder, kwargs = TWIML_CASES[1]
+            self.assertNotIn(b'record=', builder(**kwargs).get_data())
+            self.assertEqual(twiml_tree(builder(**kwargs).get_data()),
+                             twiml_tree(render_template(template, **kwargs)))
+        finally:
+            app.config['RECORDING_ENABLED'] = recording_enabled
+
+        self.assertEqual(
+            render_twiml(Say('<Tom & "Jerry">'), Dial(Number('+1', url='a?b=1&c="2"'), answerOnBridge=True)).get_data(),
+            b'<?xml version="1.0" encoding="UTF-8"?><Response><Say>&lt;Tom &amp; "Jerry"&gt;</Say>'
+            b'<Dial answerOnBridge="true"><Number url="a?b=1&amp;c=&quot;2&quot;">+1</Number></Dial></Response>')
+
+    def test_lazy_template_context(self):
+        app.song_urls.clear()
+        with patch('calls.url_for', wraps=url_for) as song_url_for, app.test_request_context():
+            # Templates that don't play a song never build its URL
+            render_template('call.xml', from_number='+15555551234', to_number='+14169671111')
+            self.assertEqual(song_url_for.call_count, 0)
+
+            body = render_template('verify.xml', confirmed=True)
+            render_template('verify.xml', confirmed=True)
+            self.assertEqual(song_url_for.call_count, len(get_songs()))
+        self.assertIn('<Play>http://example.com/static/songs/', body)
+
+    def test_static_xml_cache(self):
+        app.static_xml_cache.clear()
+        with patch('calls.utils.render_template', wraps=render_template) as render:
+            songs = set()
+            for _ in range(20):
+                response = self.client.post(url_for('broadcast.incoming', voicemail='y'))
+                self.assertEqual(response.status_code, 200)
+                self.assertEqual(response.content_type, 'text/xml')
+                self.assertIn(b'Did you want to re-record that? Too bad.', response.data)
+                songs.add(re.search(rb'<Play>http://example.com/static/songs/(.+)</Play>', response.data).group(1))
+            # Rendered once per song, and each one gets played
+            self.assertEqual(render.call_count, len(get_songs()))
+            self.assertEqual(songs, {song.encode() for song in get_songs()})
+
+            # Song URLs are absolute, so a config change renders them again
+            app.config['SERVER_NAME'] = 'calls.example.com'
+            response = self.client.post(url_for('broadcast.incoming', voicemail='y'))
+            self.assertIn(b'<Play>http://calls.example.com/static/songs/', response.data)
+            self.assertEqual(render.call_count, 2 * len(get_songs()))
+
     @patch('random.randint')
     def test_broadcast_outgoing(self, randint):
         # Invalid number
@@ -342,6 +891,35 @@ class BMIRCallsTests(unittest.TestCase):
         self.assertIn(b'Invalid code. Please try again.', response.data)
         self.assertIsNone(UserCodeConfig.get('invalid_code_name'))
 
+    def test_user_code_config_cache(self):
+        listener = PostgresListener(app, reconnect_delay=0)
+        listener.subscribe(UserCodeConfig.NOTIFY_CHANNEL, app.user_code_config_cache.invalidate)
+        try:
+            self.assertTrue(listener.connected.wait(5))
+            self.assertTrue(UserCodeConfig.get('broadcast_enable_incoming'))
+
+            # Changes made behind its back aren't seen, since reads are cached...
+            db.session.add(UserCodeConfig(name='broadcast_enable_incoming', value=False))
+            db.session.commit()
+            self.assertTrue(UserCodeConfig.get('broadcast_enable_incoming'))
+
+            # ...until a set() in any process sends a NOTIFY
+            notify(UserCodeConfig.NOTIFY_CHANNEL, 'broadcast_enable_incoming')
+            db.session.commit()
+            for _ in range(50):
+                if app.user_code_config_cache.values is None:
+                    break
+                time.sleep(0.1)
+            self.assertFalse(UserCodeConfig.get('broadcast_enable_incoming'))
+        finally:
+            listener.stop()
+
+        # Without a listener, the cache expires
+        with patch.dict(app.config, {'USER_CODE_CONFIG_CACHE_MAX_AGE': 0}):
+            UserCodeConfig.query.delete()
+            db.session.commit()
+            self.assertTrue(UserCodeConfig.get('broadcast_enable_incoming'))
+
     @patch('random.randint')
     def test_broadcast_incoming(self, randint):
         # Test basic incoming
@@ -387,19 +965,47 @@ class BMIRCallsTests(unittest.TestCase):
 
     def test_broadcast_transcribe(self):
         self.assertEqual(Voicemail.query.count(), 0)
-        self.twilio_mock.recordings.get().fetch().duration = 75
-        response = self.client.post(
-            url_for('broadcast.transcribe'),
-            data={'From': '+14164390000', 'TranscriptionText': 'this is my transcription',
-                  'RecordingUrl': 'http://example.com/my-url.mp3'})
-        self.assertEqual(response.status_code, 204)
+        # One recording shows up in the listing, the other has to be fetched
+        self.twilio_mock.recordings.list.return_value = [MagicMock(sid='RE2', duration='75')]
+        self.twilio_mock.recordings.get().fetch().duration = '30'
+        with patch.dict(app.config, {'VOICEMAIL_DURATION_BACKFILL_DELAY': 0}):
+            for recording_sid in ('RE1', 'RE2'):
+                response = self.client.post(
+                    url_for('broadcast.transcribe'),
+                    data={'From': '+14164390000', 'TranscriptionText': 'this is my transcription',
+                          'RecordingUrl': 'http://example.com/my-url.mp3', 'RecordingSid': recording_sid})
+                self.assertEqual(response.status_code, 204)
 
-        self.assertEqual(Voicemail.query.count(), 1)
-        voicemail = Voicemail.query.first()
+        self.assertEqual(Voicemail.query.count(), 2)
+        voicemail, other_voicemail = Voicemail.query.order_by(Voicemail.id).all()
         self.assertEqual(voicemail.phone_number, '+14164390000')
         self.assertEqual(voicemail.transcription, 'this is my transcription')
         self.assertEqual(voicemail.url, 'http://example.com/my-url.mp3')
-        self.assertEqual(voicemail.duration, datetime.timedelta(seconds=75))
+        self.assertEqual(voicemail.recording_sid, 'RE1')
+        self.assertIsNone(voicemail.duration)
+        self.assertIsNone(voicemail.serialize()['duration'])
+
+        pending = '{},{}'.format(voicemail.id, other_voicemail.id)
+        response = self.client.get(url_for('panel.data', pending_voicemails=pending))
+        self.assertEqual(response.json['durations'], {})
+
+        # Both resolved by the first job
+        self.assertEqual(self.run_jobs(), 2)
+        self.assertEqual(self.twilio_mock.recordings.list.call_count, 1)
+        db.session.refresh(voicemail)
+        self.assertEqual(voicemail.duration, datetime.timedelta(seconds=30))
+        response = self.client.get(url_for('panel.data', pending_voicemails=pending))
+        self.assertEqual(response.json['durations'], {str(voicemail.id): '0:30', str(other_voicemail.id): '1:15'})
+
+        # Duration sent by Twilio
+        response = self.client.post(
+            url_for('broadcast.transcribe'),
+            data={'From': '+14164390000', 'RecordingUrl': 'http://example.com/my-url.mp3',
+                  'RecordingSid': 'RE3', 'RecordingDuration': '12'})
+        self.assertEqual(response.status_code, 204)
+        voicemail = Voicemail.query.filter_by(recording_sid='RE3').one()
+        self.assertEqual(voicemail.duration, datetime.timedelta(seconds=12))
+        self.assertEqual(self.run_jobs(), 0)
 
     def test_broadcast_sms(self):
         self.assertEqual(Text.query.count(), 0)
@@ -489,11 +1095,191 @@ class BMIRCallsTests(unittest.TestCase):
         # Now we should get N numbers when it's enabled
         self.assertEqual(response.data.count(b'<Number'), constants.MULTIRING_COUNT)
 
+    def test_sms_blast(self):
+        for n in range(6):
+            self.create_submission(phone_number='+1416967111{}'.format(n)).create_volunteer()
+        blast = SmsBlast.create('hello')
+        self.assertEqual(blast.get_counts(), {'pending': 6, 'sending': 0, 'sent': 0, 'failed': 0})
+
+        # Pretend a previous run crashed mid-send to the first volunteer
+        recipient = SmsBlastRecipient.query.filter_by(phone_number='+14169671110').one()
+        recipient.status = 'sending'
+        db.session.commit()
+
+        rate_limited = set()
+
+        def create(to, **kwargs):
+            if to == '+14169671111':
+                raise TwilioRestException(400, 'uri', 'Invalid number')
+            if to == '+14169671112' and to not in rate_limited:
+                rate_limited.add(to)
+                raise TwilioRestException(429, 'uri', 'Too many requests')
+            return MagicMock(sid='SM{}'.format(to))
+
+        self.twilio_mock.messages.create.side_effect = create
+        progress = []
+        num_processed = SmsBlaster(app, blast, workers=3, rate=100, backoff=0).run(
+            progress=lambda *args: progress.append(args))
+        self.assertEqual(num_processed, 5)
+        self.assertCountEqual([phone_number for phone_number, _, _ in progress],
+                              ['+1416967111{}'.format(n) for n in range(1, 6)])
+        self.assertEqual(blast.get_counts(), {'pending': 0, 'sending': 1, 'sent': 4, 'failed': 1})
+        self.assertNotIn(call(body='hello', from_=app.config['WEIRDNESS_NUMBER'], to='+14169671110'),
+                         self.twilio_mock.messages.create.call_args_list)
+
+        recipient = SmsBlastRecipient.query.filter_by(phone_number='+14169671112').one()
+        self.assertEqual((recipient.status, recipient.attempts), ('sent', 2))
+        self.assertEqual(recipient.message_sid, 'SM+14169671112')
+        recipient = SmsBlastRecipient.query.filter_by(phone_number='+14169671111').one()
+        self.assertEqual((recipient.status, recipient.attempts), ('failed', 1))
+
+        # Resuming sends nothing more
+        self.twilio_mock.messages.create.reset_mock()
+        self.assertEqual(SmsBlaster(app, blast, workers=3, rate=100).run(), 0)
+        self.twilio_mock.messages.create.assert_not_called()
+
+    def test_job_queue(self):
+        fake_twilio = FakeTwilioClient()
+        failures = iter([TwilioRestException(429, 'uri'), TwilioRestException(400, 'uri')])
+
+        unreachable = [requests.exceptions.ConnectTimeout()]
+
+        def create_message(**kwargs):
+            # Rate limited, then rejected outright
+            if kwargs['to'] == '+14169671112':
+                raise next(failures)
+            # Twilio had a problem, maybe after sending it
+            if kwargs['to'] == '+14169671116':
+                raise TwilioRestException(503, 'uri')
+            # Twilio may or may not have sent it
+            if kwargs['to'] == '+14169671114':
+                raise requests.exceptions.ReadTimeout()
+            # Never got to Twilio, the first time
+            if kwargs['to'] == '+14169671115' and unreachable:
+                raise unreachable.pop()
+            return fake_twilio.messages.create(**kwargs)
+
+        Job.enqueue('sms', body='hi', to='+14169671111')
+        failing = Job.enqueue('sms', body='hi', to='+14169671112')
+        unknown = Job.enqueue('unknown')
+        timed_out = Job.enqueue('sms', body='hi', to='+14169671114')
+        unsent = Job.enqueue('sms', body='hi', to='+14169671115')
+        unavailable = Job.enqueue('sms', body='hi', to='+14169671116')
+        # Simulate a worker that died while running a job
+        Job.enqueue('call', url='http://example.com', to='+14169671113')
+        db.session.commit()
+        abandoned = Job.claim(lease=0)
+
+        with patch.object(app, 'twilio', fake_twilio), \
+                patch.object(fake_twilio.messages, 'create', side_effect=create_message), \
+                patch.dict(app.config, {'JOB_RETRY_DELAY': 0}):
+            self.assertEqual(jobs.run_pending(), 9)
+
+        self.assertEqual([(resource, kwargs['to']) for resource, _, kwargs in fake_twilio.requests],
+                         [('messages', '+14169671111'), ('calls', '+14169671113'), ('messages', '+14169671115')])
+        self.assertEqual(Job.query.get(abandoned.id).status, 'done')
+        self.assertEqual(Job.query.get(abandoned.id).attempts, 2)
+        failing = Job.query.get(failing.id)
+        self.assertEqual((failing.status, failing.attempts), ('failed', 2))
+        self.assertIn('400', failing.error)
+        self.assertEqual(Job.query.get(unknown.id).status, 'failed')
+        timed_out = Job.query.get(timed_out.id)
+        self.assertEqual((timed_out.status, timed_out.attempts), ('failed', 1))
+        self.assertIn('ReadTimeout', timed_out.error)
+        unsent = Job.query.get(unsent.id)
+        self.assertEqual((unsent.status, unsent.attempts), ('done', 2))
+        unavailable = Job.query.get(unavailable.id)
+        self.assertEqual((unavailable.status, unavailable.attempts), ('failed', 1))
+        self.assertIn('503', unavailable.error)
+        self.assertEqual(jobs.run_pending(), 0)
+
+    def test_volunteer_selection_concurrent(self):
+        num_workers = 4
+        for n in range(constants.VOLUNTEER_RANDOM_POOL_SIZE * num_workers):
+            self.create_volunteer(self.create_submission(phone_number='+1416967{:04d}'.format(n)))
+
+        barrier = threading.Barrier(num_workers)
+        picked = []
+
+        def pick():
+            with app.app_context():
+                barrier.wait()
+                picked.extend(v.id for v in Volunteer.get_random_opted_in(current_hour=0))
+                db.session.commit()
+                db.session.remove()
+
+        workers = [threading.Thread(target=pick) for _ in range(num_workers)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+
+        # Every simultaneous call got a different volunteer, and each was stamped
+        self.assertEqual(len(picked), num_workers)
+        self.assertEqual(len(set(picked)), num_workers)
+        self.assertEqual(Volunteer.query.filter(Volunteer.last_called.isnot(None)).count(), num_workers)
+
+        # Multiring picks several at once, without stamping when asked not to
+        volunteers = Volunteer.get_random_opted_in(current_hour=0, multiring=True,
+                                                   update_last_called=False)
+        self.assertEqual(len(volunteers), constants.MULTIRING_COUNT)
+        self.assertTrue(all(v.last_called is None for v in volunteers))
+
+        # Volunteers called in the last few seconds, like by a pick that committed
+        # after ours started, are passed over while there's anyone else...
+        Volunteer.query.update({'last_called': db.func.now()})
+        rested = Volunteer.query.order_by(Volunteer.id).first()
+        rested.last_called = db.func.now() - datetime.timedelta(minutes=1)
+        db.session.commit()
+        self.assertEqual(Volunteer.get_random_opted_in(current_hour=0), [rested])
+        db.session.commit()
+
+        # ...but still rung when there isn't
+        self.assertEqual(len(Volunteer.get_random_opted_in(current_hour=0)), 1)
+
+    def test_volunteer_schedule(self):
+        app.volunteer_schedule = schedule = VolunteerSchedule(max_age=60)
+        try:
+            early = self.create_volunteer(self.create_submission(
+                phone_number='+14169670001', opt_in_hours=[0, 1, 2]))
+            late = self.create_volunteer(self.create_submission(
+                phone_number='+14169670002', opt_in_hours=[12]))
+
+            self.assertEqual(Volunteer.get_random_opted_in(current_hour=12), [late])
+            self.assertTrue(schedule.is_loaded)
+            self.assertEqual(Volunteer.get_random_opted_in(current_hour=3), [])
+            self.assertEqual(Volunteer.get_random_opted_in(current_hour=1), [early])
+            db.session.commit()
+            self.assertEqual(schedule.least_recently_called(1, 5), [(early.id, early.last_called)])
+
+            # Changes committed by this process are applied to the schedule
+            early.opt_in_hours = [5]
+            db.session.commit()
+            self.assertEqual(schedule.least_recently_called(1, 5), [])
+            self.assertEqual([id for id, _ in schedule.least_recently_called(5, 5)], [early.id])
+            db.session.delete(late)
+            db.session.commit()
+            self.assertEqual(schedule.least_recently_called(12, 5), [])
+
+            # Rolled back changes aren't
+            early.opt_in_hours = [6]
+            db.session.flush()
+            db.session.rollback()
+            self.assertEqual(schedule.least_recently_called(6, 5), [])
+
+            # Another process called them, so we fall back to the database and reload
+            Volunteer.query.update({'last_called': db.func.now() - datetime.timedelta(hours=1)})
+            db.session.commit()
+            self.assertEqual(Volunteer.get_random_opted_in(current_hour=5), [early])
+            self.assertFalse(schedule.is_loaded)
+        finally:
+            app.volunteer_schedule = None
+
     def test_weirdness_incoming(self):
         # Unknown number
         self.mock_sanitize_phone_number(None)
         response = self.client.post(url_for('weirdness.incoming'),
-                                    data={'From': '+15555551234'})
+                                    data={'From': 'anonymous'})
         self.assertEqual(response.status_code, 200)
         self.assertIn(b'Call with your caller ID unblocked to get through', response.data)
 
@@ -582,6 +1368,37 @@ class BMIRCallsTests(unittest.TestCase):
         self.assertIn(b'You will no longer receive calls', response.data)
         self.assertIn(b'SIGN UP', response.data)
 
+    def test_one_commit_per_request(self):
+        self.mock_sanitize_phone_number('+14164390000')
+        with self.assert_commits(1):
+            response = self.client.post(url_for('weirdness.sms'),
+                                        data={'Body': 'sign up', 'From': '4164390000'})
+        self.assertIn(b'You have signed up', response.data)
+        volunteer = Volunteer.query.one()
+
+        with self.assert_commits(1):
+            response = self.client.post(url_for('volunteers.submit'),
+                                        json=self.get_submit_json(phone_number='416-439-0000'))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(Submission.query.count(), 2)
+
+        with self.assert_commits(1):
+            response = self.client.post(url_for('broadcast.transcribe'), data={
+                'From': '+14164390000', 'RecordingUrl': 'http://example.com/my-url.mp3',
+                'RecordingSid': 'RE1', 'RecordingDuration': '12'})
+        self.assertEqual(response.status_code, 204)
+
+        # Failed requests are rolled back instead
+        submission = Submission.query.order_by(Submission.id).first()
+        with self.assert_commits(0):
+            response = self.client.post(url_for('volunteers.verify', id=submission.id), data={'Digits': '1'})
+        self.assertEqual(response.status_code, 409)
+
+        # Jobs commit their changes along with their status
+        with self.assert_commits(3):
+            self.assertEqual(self.run_jobs(), 1)
+        self.assertEqual(Volunteer.query.one().id, volunteer.id)
+
     def test_panel_landing(self):
         response = self.client.get(url_for('panel.landing'))
         self.assertEqual(response.status_code, 200)
@@ -626,3 +1443,137 @@ class BMIRCallsTests(unittest.TestCase):
         self.assertCountEqual(
             [i.id for i in (texts[-3:] + voicemails[-2:])],
             [i['id'] for i in response.json['items']])
+
+    def test_panel_data_pages(self):
+        # Same transaction, so same created timestamp and overlapping ids
+        items = [Text(phone_number='+14169671111', body='message') for i in range(5)]
+        items += [Voicemail(phone_number='+14169671111', url='http://example.com') for i in range(3)]
+        db.session.add_all(items)
+        db.session.commit()
+        expected = sorted((item.created, item.id, item.__class__.__name__.lower()) for item in items)
+
+        # Walking backwards through pages sees everything once, in order
+        seen, before = [], None
+        for page_size in (3, 3, 2):
+            response = self.client.get(url_for('panel.data', limit=3, before=before))
+            self.assertEqual(response.status_code, 200)
+            page = [(item['id'], item['type']) for item in response.json['items']]
+            self.assertEqual(len(page), page_size)
+            seen = page + seen
+            before = response.json['before']
+        response = self.client.get(url_for('panel.data', limit=3, before=before))
+        self.assertEqual(response.json['items'], [])
+        self.assertEqual(seen, [(id, type_name) for _, id, type_name in expected])
+
+        # The first page is the newest items, even with unset ids
+        for args in ({}, {'after_text_id': -1, 'after_voicemail_id': -1}):
+            response = self.client.get(url_for('panel.data', limit=3, **args))
+            self.assertEqual([(item['id'], item['type']) for item in response.json['items']],
+                             [(id, type_name) for _, id, type_name in expected[-3:]])
+
+        # An explicit before pages backwards even alongside seen ids
+        response = self.client.get(url_for('panel.data', limit=3, before=encode_cursor(expected[-1]),
+                                           after_voicemail_id=1))
+        self.assertEqual([(item['id'], item['type']) for item in response.json['items']],
+                         [(id, type_name) for _, id, type_name in expected[:-1]
+                          if type_name == 'text' or id > 1][-3:])
+
+        # Nonsense limits and ids fall back to the defaults
+        response = self.client.get(url_for('panel.data', limit='abc', after_text_id='abc'))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.json['items']), len(items))
+        response = self.client.get(url_for('panel.data', after=encode_cursor(expected[1])))
+        self.assertEqual([(item['id'], item['type']) for item in response.json['items']],
+                         [(id, type_name) for _, id, type_name in expected[2:]])
+
+    def test_conditional_get(self):
+        response = self.client.get(url_for('panel.data'))
+        self.assertEqual(response.status_code, 200)
+        etag, _ = response.get_etag()
+        self.assertTrue(etag)
+
+        response = self.client.get(url_for('panel.data'), headers={'If-None-Match': '"{}"'.format(etag)})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.headers['ETag'], '"{}"'.format(etag))
+        self.assertEqual(response.data, b'')
+
+        # Different query string, different tag
+        response = self.client.get(url_for('panel.data', limit=5), headers={'If-None-Match': response.headers['ETag']})
+        self.assertEqual(response.status_code, 200)
+
+        # Writes to an unrelated table leave the tag alone
+        volunteers_etag = self.client.get(url_for('volunteers.json')).headers['ETag']
+        db.session.add(Text(phone_number='+14169671111', body='message'))
+        db.session.commit()
+        response = self.client.get(url_for('volunteers.json'), headers={'If-None-Match': volunteers_etag})
+        self.assertEqual(response.status_code, 304)
+
+        response = self.client.get(url_for('panel.data'), headers={'If-None-Match': '"{}"'.format(etag)})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response.get_etag()[0], etag)
+        self.assertEqual(len(response.json['items']), 1)
+
+        self.create_submission()
+        response = self.client.get(url_for('volunteers.json'), headers={'If-None-Match': volunteers_etag})
+        self.assertEqual(response.status_code, 200)
+
+        # Placing calls changes the volunteers' last called times, but not the panel
+        self.create_volunteer(self.create_submission(phone_number='+14169671112'))
+        volunteers_etag = self.client.get(url_for('volunteers.json')).headers['ETag']
+        stats_etag = self.client.get(url_for('volunteers.json_stats')).headers['ETag']
+        panel_version = ChangeVersion.get('panel')
+        self.assertEqual(len(Volunteer.get_random_opted_in()), 1)
+        db.session.commit()
+        response = self.client.get(url_for('volunteers.json'), headers={'If-None-Match': volunteers_etag})
+        self.assertEqual(response.status_code, 200)
+        response = self.client.get(url_for('volunteers.json_stats'), headers={'If-None-Match': stats_etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(ChangeVersion.get('panel'), panel_version)
+
+    def test_panel_stream(self):
+        texts = [Text(phone_number='+14169671111', body='message') for i in range(3)]
+        voicemail = Voicemail(phone_number='+14169671111', transcription='voicemail',
+                              url='http://example.com')
+        db.session.add_all(texts + [voicemail])
+        db.session.commit()
+
+        def get_events(**kwargs):
+            with patch.dict(app.config, {'PANEL_STREAM': True, 'PANEL_STREAM_MAX_DURATION': 0}):
+                response = self.client.get(url_for('panel.stream', **kwargs.pop('args', {})), **kwargs)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.mimetype, 'text/event-stream')
+            return [
+                {line.split(': ', 1)[0]: line.split(': ', 1)[1] for line in event.split('\n')}
+                for event in response.get_data(as_text=True).strip().split('\n\n')
+                if event.startswith('id:')
+            ]
+
+        # Off unless there are workers to spare
+        self.assertEqual(self.client.get(url_for('panel.stream')).status_code, 404)
+        self.assertNotIn(b'startStream();', self.client.get(url_for('panel.landing')).data)
+
+        # Everything from the start
+        events = get_events()
+        self.assertEqual(len(events), 1)
+        self.assertEqual(events[0]['id'], '{}:{}'.format(texts[-1].id, voicemail.id))
+        data = json.loads(events[0]['data'])
+        self.assertCountEqual([(item['type'], item['id']) for item in data['items']],
+                              [('text', text.id) for text in texts] + [('voicemail', voicemail.id)])
+        self.assertCountEqual(
+            [[code.name, UserCodeConfig.get(code.name)] for code in UserCodeConfig.CODES],
+            data['codes'])
+
+        # Resuming after what the browser saw, via query args or Last-Event-ID
+        events = get_events(args={'after_text_id': texts[0].id, 'after_voicemail_id': voicemail.id})
+        self.assertEqual([item['id'] for item in json.loads(events[0]['data'])['items']],
+                         [text.id for text in texts[1:]])
+        events = get_events(headers={'Last-Event-ID': '{}:-1'.format(texts[-1].id)})
+        self.assertEqual([item['id'] for item in json.loads(events[0]['data'])['items']],
+                         [voicemail.id])
+
+        # Durations of voicemails the browser is waiting on
+        voicemail.duration = datetime.timedelta(seconds=5)
+        db.session.commit()
+        events = get_events(args={'after_text_id': texts[-1].id, 'after_voicemail_id': voicemail.id,
+                                  'pending_voicemails': voicemail.id})
+        self.assertEqual(json.loads(events[0]['data'])['durations'], {str(voicemail.id): '0:05'})